@@ -3,6 +3,8 @@
 Scripts that parses a SAM or BAM file containing
 aligned/annotated reads and the spot coordinates,
 gene and UMI (X,Y,gene,UMI) as Tags (BZ).
+Reads that represent several collapsed duplicates (tag B4)
+are counted as many times as their multiplicity.
 
 It then generates a data frame (genes as columns) 
 with the ST data and a BED file with the unique transcripts. 
@@ -53,6 +55,7 @@ def parseUniqueEvents(filename, molecular_barcodes=False):
         strand = "-" if rec.is_reverse else "+"
         # Get taggd tags
         x,y,gene,seq = (None,None,None,None)
+        multiplicity = 1
         for (k, v) in rec.tags:
             if k == "B1":
                 x = int(v) ## The X coordinate
@@ -62,6 +65,8 @@ def parseUniqueEvents(filename, molecular_barcodes=False):
                 gene = str(v) ## The gene name
             elif k == "B3":
                 seq = str(v) ## The UMI (optional)
+            elif k == "B4":
+                multiplicity = int(v) ## The number of collapsed duplicates (optional)
             else:
                 continue
         # Check that all tags are present
@@ -70,8 +75,9 @@ def parseUniqueEvents(filename, molecular_barcodes=False):
             continue
         
         # Create a new transcript and add it to the dictionary
+        # (collapsed duplicates are added once for every read they represent)
         transcript = (chrom, start, end, clear_name, mapping_quality, strand, seq)
-        unique_events[(x,y)][gene].append(transcript)
+        unique_events[(x,y)][gene].extend([transcript] * multiplicity)
       
     sam_file.close()
     return unique_events
@@ -0,0 +1,76 @@
+#! /usr/bin/env python
+""" 
+Script that recovers the read pairs discarded by the pipeline
+from the input fastq files using the compact file of discarded reads
+written by the pipeline with the option --compact-discarded-files.
+The read pairs can be selected by the step that discarded them or 
+by the reason. It can also print a summary of the discarded reads.
+
+When the pipeline was given several lanes the fastq files of all the
+lanes must be given in the same order.
+
+Steps: filter_input, collapse_duplicates, contaminant_filter, mapping, filter_mapped,
+demultiplexing
+Reasons: umi_template, umi_quality, at_content, adaptors, quality_trimming,
+duplicate, contaminant, unmapped, barcode, too_short
+"""
+
+import argparse
+import sys
+import os
+import numpy as np
+from stpipeline.common.discards import readDiscards, rehydrateDiscards, STEPS, REASONS
+
+def main(discards_file, fastq_fw, fastq_rv, out_fw, out_rv, steps, reasons, summary):
+
+    if discards_file is None or not os.path.isfile(discards_file):
+        sys.stderr.write("Error, input file not present or invalid: {}\n".format(discards_file))
+        sys.exit(1)
+        
+    if summary:
+        discards = readDiscards(discards_file)
+        step_names = dict((code, name) for name, code in STEPS.iteritems())
+        reason_names = dict((code, name) for name, code in REASONS.iteritems())
+        codes, counts = np.unique(discards["step"].astype(np.int32) * 256 + discards["reason"],
+                                  return_counts=True)
+        print "Total discarded reads: {}".format(len(discards))
+        for code, count in zip(codes, counts):
+            print "{}\t{}\t{}".format(step_names[code // 256], reason_names[code % 256], count)
+        return
+        
+    if fastq_fw is None or fastq_rv is None or len(fastq_fw) != len(fastq_rv) \
+    or not all(os.path.isfile(fastq) for fastq in fastq_fw + fastq_rv):
+        sys.stderr.write("Error, input fastq files not present or invalid\n")
+        sys.exit(1)
+        
+    written = rehydrateDiscards(discards_file, fastq_fw, fastq_rv, out_fw, out_rv, steps, reasons)
+    print "Number of discarded read pairs written: {}".format(written)
+    
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--discarded', type=str, required=True,
+                        help="The file of discarded reads written by the pipeline")
+    parser.add_argument('--fastq-fw', type=str, default=None, nargs="+",
+                        help="The fastq file/s with the forward reads given to the pipeline (one per lane)")
+    parser.add_argument('--fastq-rv', type=str, default=None, nargs="+",
+                        help="The fastq file/s with the reverse reads given to the pipeline (one per lane)")
+    parser.add_argument('--output-fw', type=str, default="R1_discarded.fastq",
+                        help="Name of the output file for the forward reads (default: %(default)s)")
+    parser.add_argument('--output-rv', type=str, default="R2_discarded.fastq",
+                        help="Name of the output file for the reverse reads (default: %(default)s)")
+    parser.add_argument('--step', type=str, default=None, action="append", choices=STEPS.keys(),
+                        help="Write only the reads discarded in this step (it can be given several times)")
+    parser.add_argument('--reason', type=str, default=None, action="append", choices=REASONS.keys(),
+                        help="Write only the reads discarded for this reason (it can be given several times)")
+    parser.add_argument('--summary', action="store_true", default=False,
+                        help="Prints the number of discarded reads by step and reason")
+    args = parser.parse_args()
+    main(args.discarded,
+         args.fastq_fw,
+         args.fastq_rv,
+         args.output_fw,
+         args.output_rv,
+         args.step,
+         args.reason,
+         args.summary)
@@ -1,6 +1,11 @@
-""" 
+"""
 This module contains some functions to find and removes adaptors in fastq reads
 """
+import re
+import numpy as np
+
+# Max length of an adaptor (the adaptors are matched with 64 bits words)
+MAX_ADAPTOR_LENGTH = 64
 
 def removeAdaptor(sequence, quality, adaptor):
     """
@@ -24,3 +29,151 @@ def removeAdaptor(sequence, quality, adaptor):
         return sequence[:pos], quality[:pos]
     else:
         return sequence, quality
+
+class AdaptorFinder(object):
+    """
+    Finds several adaptors (homopolymers or any other sequence)
+    in one scan of the read. The position returned is the leftmost
+    position where any of the adaptors is found.
+    When error_rate is > 0 each adaptor is allowed to have
+    int(len(adaptor) * error_rate) mismatches. The approximate matching
+    is done with the bit-parallel Shift-And algorithm, all the adaptors
+    are packed in the same bit vectors so they are searched at the same time.
+    N bases in the adaptors match any base.
+    """
+    def __init__(self, adaptors, error_rate=0.0):
+        """
+        :param adaptors: a list of adaptor sequences
+        :param error_rate: the max allowed rate of mismatches in an adaptor
+        :type adaptors: list
+        :type error_rate: float
+        :raises: ValueError
+        """
+        self.adaptors = [adaptor.upper() for adaptor in adaptors]
+        if any(len(adaptor) == 0 or len(adaptor) > MAX_ADAPTOR_LENGTH for adaptor in self.adaptors):
+            raise ValueError("Error, adaptors must have a length between 1 and {}".format(MAX_ADAPTOR_LENGTH))
+        if error_rate < 0.0 or error_rate >= 1.0:
+            raise ValueError("Error, invalid adaptor error rate {}".format(error_rate))
+        self.mismatches = [int(len(adaptor) * error_rate) for adaptor in self.adaptors]
+        self.exact = all(mismatches == 0 for mismatches in self.mismatches) \
+        and not any("N" in adaptor for adaptor in self.adaptors)
+        self.max_mismatches = max(self.mismatches) if len(self.adaptors) > 0 else 0
+        # Exact search is done with one regular expression
+        self._regex = re.compile("|".join(re.escape(adaptor) for adaptor in self.adaptors)) \
+        if len(self.adaptors) > 0 else None
+        # The adaptors are packed in groups of 64 bits words for the Shift-And search
+        self._groups = []
+        group = []
+        for adaptor, mismatches in zip(self.adaptors, self.mismatches):
+            if sum(len(a) for a, _ in group) + len(adaptor) > 64:
+                self._groups.append(self._packGroup(group))
+                group = []
+            group.append((adaptor, mismatches))
+        if len(group) > 0:
+            self._groups.append(self._packGroup(group))
+
+    @staticmethod
+    def _packGroup(group):
+        """
+        Computes the Shift-And masks of a group of adaptors packed in one word.
+        :return: a tuple (masks by character, initial bits, list of (final bit, length, mismatches))
+        """
+        masks = [0] * 256
+        init = 0
+        finals = []
+        offset = 0
+        for adaptor, mismatches in group:
+            init |= 1 << offset
+            for i, base in enumerate(adaptor):
+                chars = "ACGTN" if base == "N" else base
+                for char in set(chars + chars.lower()):
+                    masks[ord(char)] |= 1 << (offset + i)
+            offset += len(adaptor)
+            finals.append((1 << (offset - 1), len(adaptor), mismatches))
+        return masks, init, finals
+
+    def find(self, sequence):
+        """
+        Finds the leftmost position of any of the adaptors in the sequence.
+        :param sequence: the sequence of the read
+        :type sequence: str
+        :return: the position of the adaptor or -1 if not found
+        """
+        if self._regex is None:
+            return -1
+        if self.exact:
+            match = self._regex.search(sequence)
+            return match.start() if match is not None else -1
+        best = len(sequence)
+        for masks, init, finals in self._groups:
+            states = [0] * (self.max_mismatches + 1)
+            for j, char in enumerate(sequence):
+                # Only a match starting before the best one found can improve it
+                if j - MAX_ADAPTOR_LENGTH >= best:
+                    break
+                mask = masks[ord(char)]
+                previous = states[0]
+                states[0] = ((previous << 1) | init) & mask
+                for d in xrange(1, len(states)):
+                    current = states[d]
+                    states[d] = (((current << 1) | init) & mask) | ((previous << 1) | init)
+                    previous = current
+                for final, length, mismatches in finals:
+                    if states[mismatches] & final:
+                        best = min(best, j - length + 1)
+        return best if best < len(sequence) else -1
+
+    def trim(self, sequence, quality):
+        """
+        Removes the adaptors and everything after them from the read.
+        :param sequence: the sequence of the read
+        :param quality: the quality of the read
+        :type sequence: str
+        :type quality: str
+        :return: a tuple (sequence,quality) with the adaptors trimmed
+        :rtype: tuple
+        """
+        if len(sequence) != len(quality):
+            return sequence, quality
+        pos = self.find(sequence)
+        if pos != -1:
+            return sequence[:pos], quality[:pos]
+        return sequence, quality
+
+    def findBatch(self, sequences, lengths):
+        """
+        Finds the leftmost position of the adaptors in a batch of reads
+        (the Shift-And search is vectorized over the reads).
+        :param sequences: a 2D numpy array (uint8) with the sequences (one per row)
+        :param lengths: a numpy array with the lengths of the sequences to search
+        :return: a numpy array with the positions of the adaptors
+        (the length of the sequence when not found)
+        """
+        best = np.array(lengths, dtype=np.int64)
+        if self._regex is None or sequences.shape[0] == 0:
+            return best
+        columns = min(sequences.shape[1], int(np.max(lengths)))
+        for masks, init, finals in self._groups:
+            masks = np.array(masks, dtype=np.uint64)
+            init = np.uint64(init)
+            one = np.uint64(1)
+            states = [np.zeros(sequences.shape[0], dtype=np.uint64) for _ in xrange(self.max_mismatches + 1)]
+            finals_by_mismatches = {}
+            for final, length, mismatches in finals:
+                finals_by_mismatches.setdefault(mismatches, []).append((np.uint64(final), length))
+            for j in xrange(columns):
+                mask = masks[sequences[:, j]]
+                previous = states[0]
+                states[0] = ((previous << one) | init) & mask
+                for d in xrange(1, len(states)):
+                    current = states[d]
+                    states[d] = (((current << one) | init) & mask) | ((previous << one) | init)
+                    previous = current
+                valid = j < lengths
+                for mismatches, group_finals in finals_by_mismatches.iteritems():
+                    state = states[mismatches]
+                    for final, length in group_finals:
+                        hits = np.flatnonzero(((state & final) != 0) & valid)
+                        if len(hits) > 0:
+                            best[hits] = np.minimum(best[hits], j - length + 1)
+        return best
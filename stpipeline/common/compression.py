@@ -0,0 +1,297 @@
+"""
+This module contains functions to detect compressed
+input files (gzip and bzip2) and to open them as streams
+so they can be parsed without decompressing them to disk first.
+The decompression is done outside of the main thread, either
+by external tools (pigz/pbzip2) or by a prefetch thread, so
+the caller can consume the stream while it is being decompressed.
+"""
+
+import io
+import os
+import zlib
+import bz2
+import struct
+import threading
+import subprocess
+import Queue
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from stpipeline.common.utils import which_program
+
+# Magic bytes found at the beginning of compressed files
+GZIP_MAGIC = "\x1f\x8b"
+BZIP2_MAGIC = "BZh"
+# Size of the read buffer used for the compressed streams
+BUFFER_SIZE = 4 * 1024 * 1024
+# Number of decompressed chunks the prefetch thread can keep in memory
+PREFETCH_CHUNKS = 8
+# Number of BGZF blocks (64KB each at most) decompressed in one task
+BGZF_BLOCKS_BATCH = 64
+
+def compressionFormat(filename):
+    """
+    Detects the compression format of a file by
+    looking at its first bytes (the file suffix is ignored).
+    :param filename: the path of the file
+    :type filename: str
+    :return: "bgzf", "gzip", "bzip2" or None if the file is not compressed
+    """
+    with open(filename, "rb") as filehandler:
+        header = filehandler.read(18)
+    if header.startswith(GZIP_MAGIC):
+        return "bgzf" if _isBGZFHeader(header) else "gzip"
+    elif header.startswith(BZIP2_MAGIC):
+        return "bzip2"
+    return None
+
+def _isBGZFHeader(header):
+    """
+    Returns True if the given gzip header contains the
+    BC extra sub-field that identifies BGZF blocks.
+    """
+    # FLG.FEXTRA must be set and the first sub-field must be BC
+    return len(header) >= 16 and ord(header[3]) & 4 \
+    and header[12:14] == "BC" and struct.unpack("<H", header[14:16])[0] == 2
+
+def _gzipChunks(filehandler):
+    """
+    Generator that decompresses a gzip file (it can contain multiple members)
+    and yields the decompressed chunks.
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    while True:
+        data = filehandler.read(BUFFER_SIZE)
+        if not data:
+            break
+        while data:
+            chunk = decompressor.decompress(data)
+            if chunk:
+                yield chunk
+            data = decompressor.unused_data
+            if data:
+                # A new member starts after the end of the current one
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunk = decompressor.flush()
+    if chunk:
+        yield chunk
+
+def _bzip2Chunks(filehandler):
+    """
+    Generator that decompresses a bzip2 file (it can contain multiple streams)
+    and yields the decompressed chunks.
+    """
+    decompressor = bz2.BZ2Decompressor()
+    while True:
+        data = filehandler.read(BUFFER_SIZE)
+        if not data:
+            break
+        while data:
+            try:
+                chunk = decompressor.decompress(data)
+            except EOFError:
+                # The current stream ended exactly at the end of the previous block
+                decompressor = bz2.BZ2Decompressor()
+                continue
+            if chunk:
+                yield chunk
+            data = decompressor.unused_data
+            if data:
+                # A new stream starts after the end of the current one
+                decompressor = bz2.BZ2Decompressor()
+
+def _bgzfBlocks(filehandler):
+    """
+    Generator that yields the raw BGZF blocks (complete gzip members) of a file.
+    """
+    while True:
+        header = filehandler.read(12)
+        if not header:
+            break
+        xlen = struct.unpack("<H", header[10:12])[0]
+        extra = filehandler.read(xlen)
+        block_size = None
+        pos = 0
+        while pos < xlen:
+            slen = struct.unpack("<H", extra[pos + 2:pos + 4])[0]
+            if extra[pos:pos + 2] == "BC":
+                block_size = struct.unpack("<H", extra[pos + 4:pos + 6])[0] + 1
+            pos += 4 + slen
+        if block_size is None:
+            raise IOError("Error, invalid BGZF block found\n")
+        yield header + extra + filehandler.read(block_size - 12 - xlen)
+
+def _inflateBlocks(blocks):
+    """
+    Decompresses a list of BGZF blocks. zlib releases the GIL
+    so several calls can run in parallel in different threads.
+    """
+    return "".join(zlib.decompress(block, 16 + zlib.MAX_WBITS) for block in blocks)
+
+def _bgzfChunks(filehandler, threads):
+    """
+    Generator that decompresses a BGZF file by decompressing
+    batches of blocks in parallel in a pool of threads.
+    The chunks are yielded in the original order.
+    """
+    pool = ThreadPool(max(threads, 1))
+    pending = deque()
+    batch = []
+    try:
+        for block in _bgzfBlocks(filehandler):
+            batch.append(block)
+            if len(batch) == BGZF_BLOCKS_BATCH:
+                pending.append(pool.apply_async(_inflateBlocks, (batch,)))
+                batch = []
+                # Keep a bounded number of batches in flight
+                if len(pending) > 2 * max(threads, 1):
+                    yield pending.popleft().get()
+        if len(batch) > 0:
+            pending.append(pool.apply_async(_inflateBlocks, (batch,)))
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+class DecompressedStream(io.RawIOBase):
+    """
+    Base class for the decompressed streams.
+    Subclasses must define the method nextChunk() that
+    returns the next chunk of decompressed data and an
+    empty string at the end of the stream.
+    """
+    def __init__(self, filename):
+        io.RawIOBase.__init__(self)
+        self.filename = filename
+        self._chunk = ""
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._pos >= len(self._chunk):
+            self._chunk = self.nextChunk()
+            self._pos = 0
+            if not self._chunk:
+                return 0
+        n = min(len(b), len(self._chunk) - self._pos)
+        b[:n] = self._chunk[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+class ProcessStream(DecompressedStream):
+    """
+    Decompressed stream that reads the output of an external
+    decompression tool (pigz -dc, pbzip2 -dc) running in its own process.
+    """
+    def __init__(self, filename, args):
+        DecompressedStream.__init__(self, filename)
+        self._proc = subprocess.Popen(args + [filename],
+                                      stdout=subprocess.PIPE,
+                                      stderr=subprocess.PIPE,
+                                      close_fds=True, shell=False)
+        self._fd = self._proc.stdout.fileno()
+
+    def nextChunk(self):
+        chunk = os.read(self._fd, BUFFER_SIZE)
+        if not chunk:
+            errmsg = self._proc.stderr.read()
+            if self._proc.wait() != 0:
+                raise IOError("Error decompressing {}\n{}\n".format(self.filename, errmsg))
+        return chunk
+
+    def close(self):
+        if not self.closed:
+            if self._proc.poll() is None:
+                self._proc.kill()
+            self._proc.stdout.close()
+            self._proc.stderr.close()
+            self._proc.wait()
+        DecompressedStream.close(self)
+
+class ThreadedStream(DecompressedStream):
+    """
+    Decompressed stream that runs the decompression in a
+    prefetch thread. Decompressed chunks are handed over through a
+    bounded queue so the decompression overlaps with the consumer.
+    """
+    def __init__(self, filename, chunks_func, *args):
+        DecompressedStream.__init__(self, filename)
+        self._queue = Queue.Queue(PREFETCH_CHUNKS)
+        self._stop = threading.Event()
+        self._filehandler = open(filename, "rb")
+        self._thread = threading.Thread(target=self._prefetch, args=(chunks_func, args))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                continue
+
+    def _prefetch(self, chunks_func, args):
+        try:
+            for chunk in chunks_func(self._filehandler, *args):
+                if self._stop.is_set():
+                    return
+                self._put(chunk)
+            self._put("")
+        except Exception as e:
+            self._put(e)
+
+    def nextChunk(self):
+        chunk = self._queue.get()
+        if isinstance(chunk, Exception):
+            self._queue.put(chunk)
+            raise IOError("Error decompressing {}\n{}\n".format(self.filename, str(chunk)))
+        if not chunk:
+            # Keep returning the end of the stream on later calls
+            self._queue.put(chunk)
+        return chunk
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._filehandler.close()
+        DecompressedStream.close(self)
+
+def openInputFile(filename, threads=2, use_external_tools=True):
+    """
+    Opens a file for reading. If the file is compressed (gzip or bzip2)
+    it is decompressed on the fly so it can be iterated line by line
+    as a normal text file. The decompression is done by pigz/pbzip2 if
+    they are present in the system or by a prefetch thread otherwise.
+    BGZF files (multiple gzip blocks) are decompressed in parallel.
+    :param filename: the path of the file
+    :param threads: the number of threads to use to decompress
+    :param use_external_tools: if False pigz/pbzip2 will not be used
+    :type filename: str
+    :type threads: integer
+    :type use_external_tools: bool
+    :return: the file descriptor
+    :raises: IOError
+    """
+    if filename is None or not os.path.isfile(filename):
+        raise IOError("Error, the file does not exist {}\n".format(filename))
+    file_format = compressionFormat(filename)
+    threads = max(threads, 1)
+    if file_format == "bgzf":
+        stream = ThreadedStream(filename, _bgzfChunks, threads)
+    elif file_format == "gzip":
+        if use_external_tools and which_program("pigz") is not None:
+            stream = ProcessStream(filename, ["pigz", "-dc", "-p", str(threads)])
+        else:
+            stream = ThreadedStream(filename, _gzipChunks)
+    elif file_format == "bzip2":
+        if use_external_tools and which_program("pbzip2") is not None:
+            stream = ProcessStream(filename, ["pbzip2", "-dc", "-p{}".format(threads)])
+        else:
+            stream = ThreadedStream(filename, _bzip2Chunks)
+    else:
+        return open(filename, "rU")
+    return io.BufferedReader(stream, BUFFER_SIZE)
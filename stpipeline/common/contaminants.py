@@ -0,0 +1,100 @@
+"""
+This module contains a k-mer based screen of contaminant
+sequences (for instance rRNA). The k-mers of the contaminant
+sequences are kept in a sorted array of 2-bit encoded integers
+and the reads are screened in batches with vectorized look-ups.
+"""
+
+from stpipeline.common.fastq_utils import readfq, to_uint8_array
+from stpipeline.common.compression import openInputFile
+import numpy as np
+
+# The max size of the k-mers (they are encoded in 64 bits)
+MAX_KMER_SIZE = 32
+
+# Bases are encoded in 2 bits, other characters (N) are encoded as 4
+_BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate("ACGT"):
+    _BASE_CODES[ord(_base)] = _code
+    _BASE_CODES[ord(_base.lower())] = _code
+
+# Length of the pieces in which the contaminant sequences are encoded
+_PIECE_LENGTH = 100000
+
+def kmer_codes_batch(sequences, lengths, k):
+    """
+    Computes the canonical code (the minimum of the codes of the
+    k-mer and its reverse complement) of every k-mer of many reads at once.
+    :param sequences: matrix of uint8 with the bases of the reads (see to_uint8_array())
+    :param lengths: array with the length of every read (bases after it are ignored)
+    :param k: the size of the k-mers
+    :return: a tuple (codes, valid) of matrices with one row per read and one
+    column per k-mer start, valid is False for k-mers that contain
+    other bases than ACGT or that go beyond the length of the read
+    """
+    num_reads, width = sequences.shape
+    positions = max(width - k + 1, 0)
+    codes = _BASE_CODES[sequences]
+    forward = np.zeros((num_reads, positions), dtype=np.uint64)
+    reverse = np.zeros((num_reads, positions), dtype=np.uint64)
+    invalid = np.zeros((num_reads, positions), dtype=np.bool)
+    two = np.uint64(2)
+    for i in xrange(k):
+        window = codes[:, i:i + positions]
+        invalid |= window > 3
+        window = (window & 3).astype(np.uint64)
+        forward = (forward << two) | window
+        reverse |= (np.uint64(3) - window) << np.uint64(2 * i)
+    valid = ~invalid & (np.arange(positions) <= (np.asarray(lengths) - k)[:, np.newaxis])
+    return np.minimum(forward, reverse), valid
+
+class KmerScreen(object):
+    """
+    The set of k-mers (both strands) of a list of contaminant sequences.
+    It counts how many k-mers of every read are present in the set.
+    """
+    def __init__(self, sequences, k=25):
+        if k < 1 or k > MAX_KMER_SIZE:
+            raise ValueError("The size of the k-mers must be between 1 and {}".format(MAX_KMER_SIZE))
+        self.k = k
+        kmers = [np.empty(0, dtype=np.uint64)]
+        for sequence in sequences:
+            # Long sequences are encoded in overlapping pieces to save memory
+            pieces = [sequence[start:start + _PIECE_LENGTH + k - 1]
+                      for start in xrange(0, max(len(sequence) - k + 1, 0), _PIECE_LENGTH)]
+            if len(pieces) > 0:
+                codes, valid = kmer_codes_batch(*to_uint8_array(pieces), k=k)
+                kmers.append(codes[valid])
+        self.kmers = np.unique(np.concatenate(kmers))
+
+    @classmethod
+    def fromFasta(cls, filename, k=25):
+        """
+        Creates the screen from the sequences of a fasta file
+        (it can be gzip or bzip2 compressed)
+        """
+        filehandler = openInputFile(filename)
+        try:
+            sequences = [sequence for _, sequence, _ in readfq(filehandler)]
+        finally:
+            filehandler.close()
+        return cls(sequences, k)
+
+    def __len__(self):
+        return len(self.kmers)
+
+    def hits(self, sequences, lengths):
+        """
+        Counts the k-mers of the reads present in the contaminant sequences
+        :param sequences: matrix of uint8 with the bases of the reads (see to_uint8_array())
+        :param lengths: array with the length of every read (bases after it are ignored)
+        :return: a tuple (hits, total) of arrays with the number of k-mers
+        found and the number of valid k-mers of every read
+        """
+        codes, valid = kmer_codes_batch(sequences, lengths, self.k)
+        total = valid.sum(axis=1)
+        if len(self.kmers) == 0:
+            return np.zeros(len(total), dtype=total.dtype), total
+        index = np.minimum(np.searchsorted(self.kmers, codes), len(self.kmers) - 1)
+        found = (self.kmers[index] == codes) & valid
+        return found.sum(axis=1), total
@@ -0,0 +1,403 @@
+"""
+This module contains an in-process demultiplexer of the forward
+reads against the barcodes of the array (IDs file). Every variant of
+the barcodes within the allowed number of mismatches is precomputed
+into an index of 2-bit encoded integers that maps the variant to its
+spot (or flags it as ambiguous when it is as close to several barcodes).
+The index is saved to a cache file keyed by the checksum of the IDs file
+so it is only built once. The reads are looked up in vectorized batches.
+"""
+
+from stpipeline.common.fastq_utils import readfq_fast, to_uint8_array, _orderedImap, FILTER_CHUNK_SIZE
+from stpipeline.common.utils import safeOpenFile
+from stpipeline.common.stats import qa_stats
+from stpipeline.common.tag_store import ReadTagStore, MappedReadTagStore, PartitionedReadTags, \
+parseCoordinate
+from itertools import combinations, product, islice, imap
+import multiprocessing
+import numpy as np
+import hashlib
+import logging
+import tempfile
+import os
+
+# The max length of the barcodes (they are encoded in 64 bits)
+MAX_BARCODE_LENGTH = 32
+# Reads whose barcode contains a homopolymer of this length are not demultiplexed
+HOMOPOLYMER_LENGTH = 8
+# Look-up results of the reads that are not matched and of the ambiguous reads
+UNMATCHED = -1
+AMBIGUOUS = -2
+
+# Bases are encoded in 2 bits (N is encoded as A)
+_BASE_CODES = np.zeros(256, dtype=np.uint64)
+for _code, _base in enumerate("ACGT"):
+    _BASE_CODES[ord(_base)] = _code
+    _BASE_CODES[ord(_base.lower())] = _code
+
+def encode_barcodes_batch(bases):
+    """
+    Encodes many barcodes at once in 2 bits per base
+    :param bases: matrix of uint8 with the bases of the barcodes (see to_uint8_array())
+    :return: an array of uint64 with the code of every barcode
+    """
+    codes = np.zeros(len(bases), dtype=np.uint64)
+    two = np.uint64(2)
+    for i in xrange(bases.shape[1]):
+        codes = (codes << two) | _BASE_CODES[bases[:, i]]
+    return codes
+
+def homopolymer_batch(bases, length):
+    """
+    Finds the barcodes that contain a homopolymer of the given length
+    :param bases: matrix of uint8 with the bases of the barcodes (see to_uint8_array())
+    :param length: the length of the homopolymer
+    :return: an array of bools
+    """
+    if length < 2 or bases.shape[1] < length:
+        return np.zeros(len(bases), dtype=np.bool)
+    same = np.zeros((len(bases), bases.shape[1]), dtype=np.int32)
+    same[:, 1:] = np.cumsum(bases[:, 1:] == bases[:, :-1], axis=1)
+    # A homopolymer of n bases has n-1 equal consecutive bases
+    runs = same[:, length - 1:] - same[:, :-(length - 1)]
+    return (runs == length - 1).any(axis=1)
+
+class BarcodeIndex(object):
+    """
+    The index of every variant of the barcodes within the given
+    number of mismatches (Hamming distance). Every variant is mapped to
+    the index of its closest barcode or to AMBIGUOUS when it is
+    at the same distance of several barcodes.
+    """
+    def __init__(self, barcodes, coordinates, mismatches, codes=None, spots=None):
+        self.barcodes = list(barcodes)
+        self.coordinates = list(coordinates)
+        self.mismatches = mismatches
+        lengths = set(len(barcode) for barcode in self.barcodes)
+        if len(lengths) != 1 or not 0 < lengths.pop() <= MAX_BARCODE_LENGTH:
+            raise ValueError("The barcodes must have the same length (max {})".format(MAX_BARCODE_LENGTH))
+        self.length = len(self.barcodes[0])
+        if codes is None or spots is None:
+            codes, spots = self._build()
+        self.codes = codes
+        self.spots = spots
+
+    def _build(self):
+        barcode_codes = encode_barcodes_batch(to_uint8_array(self.barcodes)[0])
+        barcode_spots = np.arange(len(self.barcodes), dtype=np.int32)
+        variants = []
+        spots = []
+        distances = []
+        for distance in xrange(self.mismatches + 1):
+            for positions in combinations(xrange(self.length), distance):
+                shifts = [np.uint64(2 * (self.length - 1 - position)) for position in positions]
+                # A different base is obtained with a xor of a non zero 2-bit value
+                for changes in product([1, 2, 3], repeat=distance):
+                    mask = np.uint64(0)
+                    for shift, change in zip(shifts, changes):
+                        mask |= np.uint64(change) << shift
+                    variants.append(barcode_codes ^ mask)
+                    spots.append(barcode_spots)
+                    distances.append(np.full(len(barcode_codes), distance, dtype=np.int8))
+        variants = np.concatenate(variants)
+        spots = np.concatenate(spots)
+        distances = np.concatenate(distances)
+        # The closest barcodes of every variant come first
+        order = np.lexsort((spots, distances, variants))
+        variants, spots, distances = variants[order], spots[order], distances[order]
+        first = np.ones(len(variants), dtype=np.bool)
+        first[1:] = variants[1:] != variants[:-1]
+        # A variant is ambiguous when the next closest barcode is at the same distance
+        ambiguous = np.zeros(len(variants), dtype=np.bool)
+        ambiguous[:-1] = ~first[1:] & (distances[1:] == distances[:-1]) & (spots[1:] != spots[:-1])
+        spots = np.where(ambiguous, AMBIGUOUS, spots).astype(np.int32)
+        return variants[first], spots[first]
+
+    @classmethod
+    def fromIdsFile(cls, ids_file, mismatches, cache_folder=None):
+        """
+        Creates the index of the barcodes of an IDs file (BARCODE - X - Y).
+        When a cache folder is given the index is loaded from it or saved
+        to it (the cache file is keyed by the checksum of the IDs file).
+        """
+        with safeOpenFile(ids_file, "rU") as filehandler:
+            content = filehandler.read()
+        rows = [line.split() for line in content.splitlines() if line.strip()]
+        barcodes = [row[0] for row in rows]
+        coordinates = [(row[1], row[2]) for row in rows]
+        cache_file = None
+        if cache_folder is not None:
+            checksum = hashlib.md5(content + "\t{}".format(mismatches)).hexdigest()
+            cache_file = os.path.join(cache_folder, "barcodes_index_{}.npz".format(checksum))
+            if os.path.isfile(cache_file):
+                cached = np.load(cache_file)
+                return cls(barcodes, coordinates, mismatches, cached["codes"], cached["spots"])
+        index = cls(barcodes, coordinates, mismatches)
+        if cache_file is not None:
+            # Written to a temporary file first so other runs never see a partial file
+            fd, temp_file = tempfile.mkstemp(dir=cache_folder, suffix=".npz")
+            with os.fdopen(fd, "wb") as filehandler:
+                np.savez(filehandler, codes=index.codes, spots=index.spots)
+            os.rename(temp_file, cache_file)
+        return index
+
+    def __len__(self):
+        return len(self.codes)
+
+    def lookup(self, codes):
+        """
+        Looks up the codes of many barcodes at once
+        :param codes: an array of uint64 (see encode_barcodes_batch())
+        :return: an array with the index of the spot of every barcode,
+        UNMATCHED or AMBIGUOUS
+        """
+        position = np.minimum(np.searchsorted(self.codes, codes), len(self.codes) - 1)
+        return np.where(self.codes[position] == codes, self.spots[position], UNMATCHED)
+
+def _initDemultiplexWorker(index, settings):
+    """
+    Stores the barcode index and the settings in the process
+    that will run _demultiplexChunk() (a worker or the main process)
+    """
+    global _barcode_index, _demultiplex_settings
+    _barcode_index = index
+    _demultiplex_settings = settings
+
+def _demultiplexChunk(windows):
+    """
+    Demultiplexes a chunk of reads. The barcode is searched at its
+    start position and then shifted up to the overhang in both
+    directions for the reads that were not matched.
+    :param windows: a list with the region of every read around the barcode
+    :return: an array with the index of the spot of every read, UNMATCHED or AMBIGUOUS
+    """
+    length = _barcode_index.length
+    spots = np.full(len(windows), UNMATCHED, dtype=np.int32)
+    for offset in _demultiplex_settings["offsets"]:
+        pending = np.flatnonzero(spots == UNMATCHED)
+        if len(pending) == 0:
+            break
+        barcodes = [windows[i][offset:offset + length] for i in pending.tolist()]
+        bases, lengths = to_uint8_array(barcodes)
+        found = _barcode_index.lookup(encode_barcodes_batch(bases))
+        valid = (lengths == length) & ~homopolymer_batch(bases, HOMOPOLYMER_LENGTH)
+        spots[pending] = np.where(valid, found, UNMATCHED)
+    return spots
+
+def _demultiplexedReads(reads, index, offsets, window, has_umi, umi_start, umi_end,
+                        integer_ids, whitelist, threads):
+    """
+    Generator of the demultiplexed reads in the order of the file
+    (see demultiplexBarcodes()). The stats are logged when it finishes.
+    :return: yields (read key, spot, umi, multiplicity)
+    """
+    logger = logging.getLogger("STPipeline")
+    window_start, window_end = window
+    kept = [whitelist is None or barcode in whitelist for barcode in index.barcodes]
+    counts = {"total" : 0, "matched" : 0, "ambiguous" : 0, "unmatched" : 0, "whitelist" : 0}
+    total_reads = 0
+    fastq_file = safeOpenFile(reads, "rU")
+    records = readfq_fast(fastq_file)
+    chunks = iter(lambda: list(islice(records, FILTER_CHUNK_SIZE)), [])
+    # The chunks are kept with their results to build the hash in the main process
+    pending = []
+    def windows():
+        for chunk in chunks:
+            pending.append(chunk)
+            yield [sequence[window_start:window_end] for _, sequence, _ in chunk]
+    settings = {"offsets" : offsets}
+    if threads > 1:
+        pool = multiprocessing.Pool(threads, _initDemultiplexWorker, (index, settings))
+        results = _orderedImap(pool, _demultiplexChunk, windows(), 2 * threads)
+    else:
+        pool = None
+        _initDemultiplexWorker(index, settings)
+        results = imap(_demultiplexChunk, windows())
+    try:
+        for spots in results:
+            chunk = pending.pop(0)
+            counts["total"] += len(chunk)
+            counts["ambiguous"] += int(np.sum(spots == AMBIGUOUS))
+            counts["unmatched"] += int(np.sum(spots == UNMATCHED))
+            for (name, sequence, _), spot in zip(chunk, spots.tolist()):
+                if spot < 0:
+                    continue
+                if not kept[spot]:
+                    counts["whitelist"] += 1
+                    continue
+                counts["matched"] += 1
+                header_tokens = name.split()
+                umi = sequence[umi_start:umi_end] if has_umi else None
+                # Add the multiplicity of collapsed duplicates if present
+                multiplicity = 1
+                for token in header_tokens[1:]:
+                    if token.startswith("B4:i:"):
+                        multiplicity = int(token[5:])
+                total_reads += multiplicity
+                key = int(header_tokens[0]) if integer_ids else hash(header_tokens[0])
+                yield key, spot, umi, multiplicity
+        if pool is not None:
+            pool.close()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        fastq_file.close()
+
+    logger.info("Barcode Mapping stats:")
+    logger.info("Total reads: {}".format(counts["total"]))
+    logger.info("Total reads written: {}".format(counts["matched"]))
+    logger.info("Ambiguous matches: {}".format(counts["ambiguous"]))
+    logger.info("Unmatched: {}".format(counts["unmatched"]))
+    if whitelist is not None:
+        logger.info("Demultiplexed reads with a barcode not present " \
+                    "in the spot whitelist: {}".format(counts["whitelist"]))
+    # Collapsed reads count as many times as their multiplicity
+    qa_stats.reads_after_demultiplexing = total_reads
+
+def demultiplexBarcodes(reads,
+                        ids_file,
+                        mismatches,
+                        barcode_start,
+                        overhang,
+                        has_umi,
+                        umi_start,
+                        umi_end,
+                        low_memory,
+                        integer_ids=False,
+                        whitelist=None,
+                        threads=1,
+                        cache_folder=None,
+                        compact=False,
+                        stream=False,
+                        partitions=0,
+                        temp_folder=None):
+    """
+    Demultiplexes the forward reads against the barcodes of an IDs file
+    in process (without taggd) and returns a hash with the clean read name as
+    key and (x,y,umi) as values like hashDemultiplexedReads().
+    When compact is True the tags are kept in a ReadTagStore instead of a
+    dictionary and when low_memory is True they are kept on disk in a
+    MappedReadTagStore (the coordinates must be integers). When partitions
+    is given the tags are spilled to disk in that number of partitions
+    (PartitionedReadTags) to be joined to the alignments partition by partition.
+    When stream is True a generator of the tags in the order of the reads
+    is returned instead (like iterDemultiplexedTags()).
+    Only mismatches are allowed in the barcodes (Hamming distance) and the
+    barcode can be shifted up to overhang bases.
+    :param reads: path to a file with the fastq reads (forward reads)
+    :param ids_file: a tab delimited file (BARCODE - X - Y) with all the barcodes
+    :param mismatches: the number of allowed mismatches
+    :param barcode_start: the start position of the barcode
+    :param overhang: the max number of bases the barcode can be shifted
+    :param has_umi: True if the read sequence contains UMI
+    :param umi_start: the start position of the UMI
+    :param umi_end: the end position of the UMI
+    :param low_memory: True to keep the tags on disk (MappedReadTagStore)
+    :param integer_ids: True if the reads were renamed to integer ids (used as keys)
+    :param whitelist: a set with the barcodes of the spots to keep (optional)
+    :param threads: the number of processes to use
+    :param cache_folder: the folder where the index of the barcodes is cached (optional)
+    :param compact: True to use a ReadTagStore instead of dict
+    :param stream: True to return a generator of (read id, tags) where tags
+    is a list of (tag, value, type) tuples (the reads must have integer ids)
+    :param partitions: the number of partitions of a PartitionedReadTags (0 to disable)
+    :param temp_folder: the folder where the tags are kept on disk (default: the folder of the reads)
+    :type reads: str
+    :type ids_file: str
+    :type mismatches: integer
+    :type barcode_start: integer
+    :type overhang: integer
+    :type has_umi: boolean
+    :type umi_start: integer
+    :type umi_end: integer
+    :type low_memory: boolean
+    :type integer_ids: boolean
+    :type whitelist: set
+    :type threads: integer
+    :type compact: boolean
+    :type stream: boolean
+    :type partitions: integer
+    :type temp_folder: str
+    :return: a dictionary of read_name -> (x,y,umi,multiplicity) tags where umi
+    and multiplicity are optional
+    :raises: RuntimeError
+    """
+    logger = logging.getLogger("STPipeline")
+
+    if not os.path.isfile(reads):
+        error = "Error, input file not present {}\n".format(reads)
+        logger.error(error)
+        raise RuntimeError(error)
+
+    try:
+        index = BarcodeIndex.fromIdsFile(ids_file, mismatches, cache_folder)
+    except ValueError as e:
+        error = "Error demultiplexing reads.\nInvalid IDs file {}\n{}".format(ids_file, e)
+        logger.error(error)
+        raise RuntimeError(error)
+    logger.info("Barcode index with {} barcodes and {} variants".format(len(index.barcodes), len(index)))
+
+    # The coordinates are checked before any read is demultiplexed
+    compact = not stream and (compact or low_memory or partitions > 0)
+    if compact:
+        try:
+            spot_coordinates = [(parseCoordinate(x), parseCoordinate(y)) for x, y in index.coordinates]
+        except ValueError:
+            error = "Error demultiplexing reads.\nThe coordinates of the IDs file {} " \
+            "are not valid 16 bits integers".format(ids_file)
+            logger.error(error)
+            raise RuntimeError(error)
+
+    # The barcode is searched first at its position and
+    # then shifted one base at a time in both directions
+    window_start = max(barcode_start - overhang, 0)
+    window_end = barcode_start + index.length + overhang
+    offsets = [barcode_start - window_start]
+    for shift in xrange(1, overhang + 1):
+        offsets += [offset for offset in [barcode_start - window_start - shift,
+                                          barcode_start - window_start + shift] if offset >= 0]
+    matches = _demultiplexedReads(reads, index, offsets, (window_start, window_end),
+                                  has_umi, umi_start, umi_end,
+                                  integer_ids or stream, whitelist, threads)
+
+    if stream:
+        spot_tags = [[("B1", x, "Z"), ("B2", y, "Z")] for x, y in index.coordinates]
+        def tags():
+            for key, spot, umi, multiplicity in matches:
+                read_tags = list(spot_tags[spot])
+                if has_umi:
+                    read_tags.append(("B3", umi, "Z"))
+                if multiplicity > 1:
+                    read_tags.append(("B4", multiplicity, "i"))
+                yield key, read_tags
+        return tags()
+
+    if temp_folder is None:
+        temp_folder = os.path.dirname(os.path.abspath(reads))
+    if compact:
+        umi_length = umi_end - umi_start if has_umi else 0
+        if partitions > 0:
+            hash_reads = PartitionedReadTags(partitions, temp_folder, umi_length)
+        elif low_memory:
+            hash_reads = MappedReadTagStore(temp_folder, umi_length)
+        else:
+            hash_reads = ReadTagStore(umi_length)
+    else:
+        hash_reads = dict()
+
+    spot_tags = [["B1:Z:{}".format(x), "B2:Z:{}".format(y)] for x, y in index.coordinates]
+    for key, spot, umi, multiplicity in matches:
+        if compact:
+            hash_reads.add(key, spot_coordinates[spot][0], spot_coordinates[spot][1],
+                           umi, multiplicity)
+        else:
+            tags = list(spot_tags[spot])
+            if has_umi:
+                # Add the UMI as an extra tag
+                tags.append("B3:Z:%s" % umi)
+            if multiplicity > 1:
+                tags.append("B4:i:{}".format(multiplicity))
+            hash_reads[key] = tags
+    if compact: hash_reads.freeze()
+    return hash_reads
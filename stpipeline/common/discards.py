@@ -0,0 +1,179 @@
+"""
+This module contains functions to keep a compact record
+of the reads discarded by the pipeline. Instead of writing
+copies of the discarded reads a binary file is written with one
+record per discarded read: the read id (the ordinal of the read pair
+in the input files), the step that discarded it and the reason.
+The discarded reads can be recovered from the input files with
+rehydrateDiscards().
+"""
+
+from stpipeline.common.fastq_utils import readfq_fast, FastqWriter, LANE_ORDINAL_SHIFT, READ_TAGS_SEPARATOR, \
+DUPLICATE_DTYPE
+from stpipeline.common.compression import openInputFile
+from itertools import izip
+import numpy as np
+import pysam
+import os
+
+# Record of a discarded read (ordinal, step, reason)
+DISCARD_DTYPE = np.dtype([("ordinal", "<u8"), ("step", "u1"), ("reason", "u1")])
+
+# Codes of the steps that discard reads
+STEPS = {"filter_input" : 1,
+         "collapse_duplicates" : 2,
+         "contaminant_filter" : 3,
+         "mapping" : 4,
+         "filter_mapped" : 5,
+         "demultiplexing" : 6}
+
+# Codes of the reasons to discard a read (the names of the
+# input filters are used for the filter_input step)
+REASONS = {"umi_template" : 1,
+           "umi_quality" : 2,
+           "at_content" : 3,
+           "adaptors" : 4,
+           "quality_trimming" : 5,
+           "duplicate" : 6,
+           "contaminant" : 7,
+           "unmapped" : 8,
+           "barcode" : 9,
+           "too_short" : 10}
+
+def discardRecords(ordinals, step, reason):
+    """
+    Creates the binary records of the given discarded reads
+    :param ordinals: a list or array with the ids of the reads
+    :param step: the name of the step that discarded the reads
+    :param reason: the name of the reason
+    :return: the records as a string of bytes
+    """
+    records = np.empty(len(ordinals), dtype=DISCARD_DTYPE)
+    records["ordinal"] = ordinals
+    records["step"] = STEPS[step]
+    records["reason"] = REASONS[reason]
+    return records.tostring()
+
+def writeDiscards(filename, ordinals, step, reason):
+    """
+    Appends the records of the given discarded reads to a file
+    :param filename: the path of the binary file of discarded reads
+    :param ordinals: a list or array with the ids of the reads
+    :param step: the name of the step that discarded the reads
+    :param reason: the name of the reason
+    """
+    with open(filename, "ab") as filehandler:
+        filehandler.write(discardRecords(ordinals, step, reason))
+
+def readDiscards(filename):
+    """
+    Reads the records of discarded reads of a file
+    :param filename: the path of the binary file of discarded reads
+    :return: a numpy structured array with the fields ordinal, step and reason
+    """
+    return np.fromfile(filename, dtype=DISCARD_DTYPE)
+
+def _readOrdinal(name):
+    """
+    Returns the id of a read from its name (the tags
+    carried in the name are removed, see embedTagsInName())
+    """
+    return int(name.split(READ_TAGS_SEPARATOR, 1)[0])
+
+def _expandOrdinals(ordinals, index_file):
+    """
+    Adds to the given ids the ids of the reads that have the same
+    sequence (binary index file of writeUniqueSequences()).
+    """
+    if index_file is None or os.path.getsize(index_file) == 0:
+        return ordinals
+    index = np.fromfile(index_file, dtype=DUPLICATE_DTYPE)
+    return np.concatenate((ordinals, index["ordinal"][np.in1d(index["first"], ordinals)]))
+
+def discardsFromAlignments(alignments, filename, step, reason, index_file=None):
+    """
+    Appends a record for every read present in a SAM/BAM file
+    (every read is written once even if it has several alignments)
+    :param alignments: the path of the SAM/BAM file (read names must be integer ids
+    optionally followed by the tags, see embedTagsInName())
+    :param filename: the path of the binary file of discarded reads
+    :param step: the name of the step that discarded the reads
+    :param reason: the name of the reason
+    :param index_file: the index of reads with the same sequence when only
+    unique sequences were mapped (optional)
+    :return: the number of records written
+    """
+    flag = "r" if os.path.splitext(alignments)[1].lower() == ".sam" else "rb"
+    infile = pysam.AlignmentFile(alignments, flag)
+    ordinals = np.fromiter((_readOrdinal(record.query_name) for record in infile.fetch(until_eof=True)),
+                           dtype=np.uint64)
+    infile.close()
+    ordinals = _expandOrdinals(np.unique(ordinals), index_file)
+    writeDiscards(filename, ordinals, step, reason)
+    return len(ordinals)
+
+def discardsFromReads(reads, filename, step, reason, index_file=None):
+    """
+    Appends a record for every read present in a fastq file
+    :param reads: the path of the fastq file (read names must be integer ids
+    optionally followed by the tags, see embedTagsInName())
+    :param filename: the path of the binary file of discarded reads
+    :param step: the name of the step that discarded the reads
+    :param reason: the name of the reason
+    :param index_file: the index of reads with the same sequence when only
+    unique sequences were mapped (optional)
+    :return: the number of records written
+    """
+    with open(reads, "rU") as filehandler:
+        ordinals = np.fromiter((_readOrdinal(header.split(None, 1)[0]) for header, _, _ in readfq_fast(filehandler)),
+                               dtype=np.uint64)
+    ordinals = _expandOrdinals(ordinals, index_file)
+    writeDiscards(filename, ordinals, step, reason)
+    return len(ordinals)
+
+def rehydrateDiscards(filename, fw, rw, out_fw, out_rw, steps=None, reasons=None):
+    """
+    Writes the original read pairs of the discarded reads by
+    reading them from the input files of the pipeline.
+    :param filename: the path of the binary file of discarded reads
+    :param fw: the fastq file with the forward reads given to the pipeline
+    (or a list of files, one per lane)
+    :param rw: the fastq file with the reverse reads given to the pipeline
+    (or a list of files, one per lane)
+    :param out_fw: the name of the output file for the forward reads
+    :param out_rw: the name of the output file for the reverse reads
+    :param steps: only the reads discarded by these steps are written (optional)
+    :param reasons: only the reads discarded by these reasons are written (optional)
+    :return: the number of read pairs written
+    """
+    lanes_fw = [fw] if isinstance(fw, basestring) else list(fw)
+    lanes_rw = [rw] if isinstance(rw, basestring) else list(rw)
+    discards = readDiscards(filename)
+    if steps is not None:
+        discards = discards[np.in1d(discards["step"], [STEPS[step] for step in steps])]
+    if reasons is not None:
+        discards = discards[np.in1d(discards["reason"], [REASONS[reason] for reason in reasons])]
+    ordinals = np.unique(discards["ordinal"])
+    # The index of the lane is in the high bits of the ordinal
+    lanes = ordinals >> np.uint64(LANE_ORDINAL_SHIFT)
+    indexes = ordinals & np.uint64((1 << LANE_ORDINAL_SHIFT) - 1)
+    written = 0
+    with FastqWriter(out_fw) as out_fw_writer, FastqWriter(out_rw) as out_rw_writer:
+        for lane, (lane_fw, lane_rw) in enumerate(izip(lanes_fw, lanes_rw)):
+            lane_indexes = indexes[lanes == lane].tolist()
+            if len(lane_indexes) == 0:
+                continue
+            lane_written = 0
+            fw_file = openInputFile(lane_fw)
+            rw_file = openInputFile(lane_rw)
+            for index, (record_fw, record_rw) in enumerate(izip(readfq_fast(fw_file), readfq_fast(rw_file))):
+                if lane_written == len(lane_indexes):
+                    break
+                if index == lane_indexes[lane_written]:
+                    out_fw_writer.write(record_fw)
+                    out_rw_writer.write(record_rw)
+                    lane_written += 1
+            fw_file.close()
+            rw_file.close()
+            written += lane_written
+    return written
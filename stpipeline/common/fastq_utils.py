@@ -3,24 +3,47 @@ This module contains some specific functionalities for
 ST fastq files, mainly quality filtering functions.
 """
 
-from stpipeline.common.utils import safeOpenFile, fileOk
-from stpipeline.common.adaptors import removeAdaptor
+from stpipeline.common.utils import safeOpenFile, safeRemove, fileOk
+from stpipeline.common.compression import openInputFile
 from stpipeline.common.stats import qa_stats
+from stpipeline.common.tag_store import ReadTagStore, MappedReadTagStore, PartitionedReadTags, \
+OrdinalTagJoin, lookupTags
 import logging 
-from itertools import izip
+from itertools import izip, chain, islice, imap
+from array import array
+from collections import deque
 from sqlitedict import SqliteDict
 import os
 import re
+import time
+import threading
+import shutil
+import Queue
+import multiprocessing
+import numpy as np
 
-def coroutine(func):
-    """ 
-    Coroutine decorator, starts coroutines upon initialization.
-    """
-    def start(*args, **kwargs):
-        cr = func(*args, **kwargs)
-        cr.next()
-        return cr
-    return start
+# Size of the blocks read by the block based fastq parser
+FASTQ_BLOCK_SIZE = 4 * 1024 * 1024
+# Number of records per batch when falling back to readfq
+FASTQ_BATCH_SIZE = 50000
+# Number of records per chunk written by the fastq writer
+FASTQ_WRITER_BATCH_SIZE = 20000
+# Number of chunks waiting to be written by the fastq writer
+FASTQ_WRITER_QUEUE_SIZE = 8
+# Number of read pairs per chunk when filtering the input reads
+FILTER_CHUNK_SIZE = 20000
+# Number of chunks of read pairs parsed ahead by the reader process of every lane
+FILTER_LANE_QUEUE_SIZE = 4
+# The ordinal of a read pair is its index in its lane plus
+# the index of the lane shifted by these bits
+LANE_ORDINAL_SHIFT = 40
+# Separator of the read id and the tags when they are carried in the read name
+READ_TAGS_SEPARATOR = "|"
+# Record of the index of reads with the same sequence (id of the read
+# that is mapped and id of the read with the same sequence)
+DUPLICATE_DTYPE = np.dtype([("first", "<u8"), ("ordinal", "<u8")])
+# Number of records buffered before they are written to the index of duplicates
+DUPLICATE_BUFFER_SIZE = 100000
 
 def readfq(fp): # this is a generator function
     """ 
@@ -62,21 +85,178 @@ def readfq(fp): # this is a generator function
                 yield name, seq, None  # yield a fasta record instead
                 break
 
-@coroutine
-def writefq(fp):  # This is a coroutine
+def readfq_blocks(fp, block_size=FASTQ_BLOCK_SIZE):
+    """
+    Fast fastq parser for strict 4-line fastq files.
+    It reads the file in large blocks and splits every block
+    in records at once instead of walking the file line by line.
+    It falls back to readfq() if the input is not strict 4-line fastq
+    (for instance multi-line fasta records).
+    Blank lines at the end of the file are ignored.
+    :param fp: opened file descriptor
+    :param block_size: the number of bytes to read in every block
+    :returns an iterator over lists (batches) of tuples (name,sequence,quality)
+    :raises: RuntimeError if a record is invalid or the last record is truncated
+    """
+    block = fp.read(block_size)
+    if not block:
+        return
+    # Complete the last line of the block
+    block += fp.readline()
+    lines = block.split("\n")
+    if not lines[0].startswith("@") or len(lines) < 4 or not lines[2].startswith("+"):
+        # Not a strict fastq file, use the generic parser
+        batch = []
+        for record in readfq(chain(block.splitlines(True), fp)):
+            batch.append(record)
+            if len(batch) == FASTQ_BATCH_SIZE:
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            yield batch
+        return
+    records = 0
+    while True:
+        # The next block is read first to know if this is the last one
+        block = fp.read(block_size)
+        if block:
+            block += fp.readline()
+        # The last element is the (empty) remainder after the last new line
+        # or a record line without new line at the end of the file
+        if lines[-1] == "":
+            lines.pop()
+        end = len(lines)
+        if not block:
+            # Blank lines are allowed at the end of the file (one of them
+            # is the quality of the last record when the read is empty)
+            while end > 0 and lines[end - 1] == "":
+                end -= 1
+            if end % 4 == 3 and end < len(lines):
+                end += 1
+        num_lines = end - (end % 4)
+        headers = lines[0:num_lines:4]
+        if [header for header in headers if header[:1] != "@"] \
+        or [separator for separator in lines[2:num_lines:4] if separator[:1] != "+"]:
+            invalid = next(i for i in xrange(0, num_lines, 4)
+                           if lines[i][:1] != "@" or lines[i + 2][:1] != "+")
+            raise RuntimeError("Error parsing fastq file, invalid record {} " \
+                               "{}\n".format(records + invalid // 4 + 1, lines[invalid:invalid + 4]))
+        if num_lines > 0:
+            yield zip([header[1:] for header in headers],
+                      lines[1:num_lines:4],
+                      lines[3:num_lines:4])
+            records += len(headers)
+        if not block:
+            break
+        lines = lines[num_lines:] + block.split("\n")
+    if num_lines != end:
+        raise RuntimeError("Error parsing fastq file, the last record {} " \
+                           "is truncated {}\n".format(records + 1, lines[num_lines:end]))
+
+def readfq_fast(fp, block_size=FASTQ_BLOCK_SIZE):
     """ 
-    Fastq writing generator sink.
-    Send a (header, sequence, quality) triple to the instance to write it to
-    the specified file pointer.
+    Generator over the records of a fastq file
+    using the block based parser readfq_blocks().
+    :param fp: opened file descriptor
+    :param block_size: the number of bytes to read in every block
+    :returns an iterator over tuples (name,sequence,quality)
     """
-    fq_format = '@{header}\n{sequence}\n+\n{quality}\n'
-    try:
+    return chain.from_iterable(readfq_blocks(fp, block_size))
+
+class FastqWriter(object):
+    """ 
+    Buffered fastq writer. The records are collected in batches
+    that are formatted, joined in one chunk and written to the file
+    by a background thread, so the formatting and the disk writes
+    overlap with the processing of the reads in the caller.
+    The number of bytes written and the time the caller
+    spent waiting for the writer thread are kept as attributes.
+    When append is True the records are added to the end of the file.
+    """
+    def __init__(self, filename, batch_size=FASTQ_WRITER_BATCH_SIZE, append=False):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.bytes_written = 0
+        self.time_blocked = 0.0
+        self._records = []
+        self._error = None
+        self._handle = open(filename, 'a') if append else safeOpenFile(filename, 'w')
+        self._queue = Queue.Queue(FASTQ_WRITER_QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._writeBatches)
+        self._thread.daemon = True
+        self._thread.start()
+        
+    def _writeBatches(self):
         while True:
-            record = yield
-            read = fq_format.format(header=record[0], sequence=record[1], quality=record[2])
-            fp.write(read)
-    except GeneratorExit:
-        return
+            batch = self._queue.get()
+            if batch is None:
+                break
+            if self._error is not None:
+                continue
+            try:
+                if isinstance(batch, list):
+                    batch = "".join(["@%s\n%s\n+\n%s\n" % record for record in batch])
+                self._handle.write(batch)
+                self.bytes_written += len(batch)
+            except Exception as e:
+                self._error = e
+            
+    def _put(self, item):
+        if self._error is not None:
+            raise IOError("Error writing to {}\n{}\n".format(self.filename, str(self._error)))
+        start = time.time()
+        self._queue.put(item)
+        self.time_blocked += time.time() - start
+        
+    def write(self, record):
+        """
+        Adds a (header, sequence, quality) record to the file
+        """
+        self._records.append(record)
+        if len(self._records) >= self.batch_size:
+            self._put(self._records)
+            self._records = []
+            
+    def writeRecords(self, records):
+        """
+        Adds a list of (header, sequence, quality) records to the file
+        """
+        self.flush()
+        self._put(records)
+        
+    def writeText(self, text):
+        """
+        Adds already formatted fastq records to the file
+        """
+        self.flush()
+        self._put(text)
+            
+    def flush(self):
+        if len(self._records) > 0:
+            self._put(self._records)
+            self._records = []
+            
+    def close(self):
+        """
+        Writes the pending records, waits for the writer
+        thread to finish and closes the file
+        """
+        if self._handle.closed:
+            return
+        self.flush()
+        start = time.time()
+        self._queue.put(None)
+        self._thread.join()
+        self.time_blocked += time.time() - start
+        self._handle.close()
+        if self._error is not None:
+            raise IOError("Error writing to {}\n{}\n".format(self.filename, str(self._error)))
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
     
 def quality_trim_index(bases, qualities, cutoff, base=33):
     """
@@ -135,6 +315,73 @@ def quality_trim_index(bases, qualities, cutoff, base=33):
             max_i = i
     return max_i
 
+def to_uint8_array(strings):
+    """
+    Converts a list of strings (sequences or qualities) into
+    a fixed-width matrix of uint8 (one row per string, shorter
+    strings are padded with zeroes) and an array with the lengths.
+    :param strings: a list of strings
+    :type strings: list
+    :return: a tuple (matrix, lengths)
+    """
+    lengths = np.fromiter(imap(len, strings), dtype=np.int64, count=len(strings))
+    width = max(int(lengths.max()) if len(strings) > 0 else 0, 1)
+    matrix = np.array(strings, dtype="S{}".format(width)).view(np.uint8)
+    return matrix.reshape(len(strings), width), lengths
+
+def quality_trim_index_batch(bases, qualities, lengths, cutoff, base=33):
+    """
+    Vectorized version of quality_trim_index() that computes the trimming
+    position of many reads at once. The results are identical
+    to calling quality_trim_index() on every read.
+    :param bases: matrix of uint8 with the bases of the reads (see to_uint8_array())
+    :param qualities: matrix of uint8 with the qualities of the reads
+    :param lengths: array with the length of every read (bases after it are ignored)
+    :param cutoff: the quality threshold to trim
+    :param base: the format of the quality string (33 or 64)
+    :return: an array with the position at which to trim every read
+    """
+    num_reads, width = qualities.shape
+    positions = np.arange(width)
+    valid = positions < lengths[:, np.newaxis]
+    diff = cutoff - (qualities.astype(np.int32) - base)
+    # G bases count as quality cutoff - 1 (NextSeq)
+    diff[bases == ord("G")] = 1
+    diff[~valid] = 0
+    # Partial sums from every index to the end of the read
+    sums = np.cumsum(diff[:, ::-1], axis=1)[:, ::-1]
+    # The walk from the end of the read stops at the last negative sum
+    negative = (sums < 0) & valid
+    stop = np.where(negative.any(axis=1), 
+                    width - 1 - np.argmax(negative[:, ::-1], axis=1), -1)
+    candidates = np.where(valid & (positions > stop[:, np.newaxis]), sums, 0)
+    # In case of ties the highest index wins (it is the first found from the end)
+    best = width - 1 - np.argmax(candidates[:, ::-1], axis=1)
+    best_sum = candidates[np.arange(num_reads), best]
+    return np.where(best_sum > 0, best, lengths)
+
+def umi_low_quality_bases_batch(qualities, mc_start, mc_end, min_qual, base=33):
+    """
+    Computes the number of low quality bases in the UMIs of many reads at once.
+    :param qualities: matrix of uint8 with the qualities of the reads (see to_uint8_array())
+    :param mc_start: the start position of the UMI
+    :param mc_end: the end position of the UMI
+    :param min_qual: bases with quality lower than this are low quality bases
+    :param base: the format of the quality string (33 or 64)
+    :return: an array with the number of low quality bases in every UMI
+    """
+    # Padding (zeroes) are not counted, like slicing beyond the end of the read
+    umis = qualities[:, mc_start:mc_end].astype(np.int32)
+    return np.sum((umis > 0) & ((umis - base) < min_qual), axis=1)
+
+def at_count_batch(bases):
+    """
+    Computes the number of A and T bases of many reads at once.
+    :param bases: matrix of uint8 with the bases of the reads (see to_uint8_array())
+    :return: an array with the number of A and T bases of every read
+    """
+    return np.sum((bases == ord("A")) | (bases == ord("T")), axis=1)
+
 def trim_quality(sequence,
                  quality,
                  min_qual=20, 
@@ -169,20 +416,370 @@ def trim_quality(sequence,
     else:
         return None, None
   
-def check_umi_template(umi, template):
+def _orderedImap(pool, func, iterable, max_pending):
     """
-    Checks that the UMI (molecular barcode) given as input complies
-    with the pattern given in template.
-    Returns True if the UMI complies
-    :param umi: a molecular barcode
-    :param template: a reg-based template with the same
-                    distance of the UMI that should tell how the UMI should be formed
-    :type umi: str
-    :type template: str
-    :return: True if the given molecular barcode fits the pattern given
+    Like pool.imap() but it keeps at most max_pending tasks
+    in flight so the input is not consumed faster than the
+    results are used. The results are returned in order.
     """
-    p = re.compile(template)
-    return p.match(umi) is not None
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+def _initFilterWorker(plan, settings):
+    """
+    Stores the plan of filters and the output settings in the 
+    process that will run _filterReadPairs() (a worker or the main process)
+    """
+    global _filter_plan, _filter_settings
+    _filter_plan = plan
+    _filter_settings = settings
+
+def _filterReadPairs(chunk):
+    """
+    Applies the plan of filters to a chunk of read pairs.
+    The plan is given to the process with _initFilterWorker().
+    :param chunk: a tuple with an array of the ordinals of the read pairs in the input
+    and a list of ((header,sequence,quality), (header,sequence,quality)) tuples
+    :return: a tuple with the fastq formatted R1 kept reads, R2 kept reads, 
+    R2 discarded reads, the read ids of the kept reads (compact ids), the
+    binary records of the discarded reads, the number of read pairs and 
+    the stats of every filter
+    """
+    from stpipeline.common.filters import ReadBatch
+    fq_format = "@%s\n%s\n+\n%s\n"
+    ordinals, pairs = chunk
+    batch = ReadBatch(pairs)
+    
+    if not all(batch.sequences_fw) or not all(batch.sequences_rv):
+        # The lane of the read pairs is in the high bits of their ordinals
+        fw, rw = _filter_settings["lanes"][int(ordinals[0]) >> LANE_ORDINAL_SHIFT]
+        error = "Error doing quality trimming checks of raw reads.\n" \
+        "The input files {},{} are not of the same length".format(fw, rw)
+        raise RuntimeError(error)
+    
+    names_fw = [header.split(None, 1)[0] for header in batch.headers_fw]
+    names_rv = [header.split(None, 1)[0] for header in batch.headers_rv]
+    if names_fw != names_rv:
+        for header_fw, header_rv, name_fw, name_rv in izip(batch.headers_fw, batch.headers_rv, 
+                                                           names_fw, names_rv):
+            if name_fw != name_rv:
+                logging.getLogger("STPipeline").warning("Pair reads found with different " \
+                                                        "names {} and {}".format(header_fw,header_rv))
+    
+    stats = _filter_plan.run(batch)
+    
+    # Write the reads to the output (reverse reads are trimmed and 
+    # forward reads are truncated if a length is given)
+    kept = np.flatnonzero(~batch.discard).tolist()
+    lengths = batch.trimmed_lengths.tolist()
+    sequences_fw, qualities_fw = batch.sequences_fw, batch.qualities_fw
+    sequences_rv, qualities_rv = batch.sequences_rv, batch.qualities_rv
+    fw_length = _filter_settings["fw_length"]
+    if _filter_settings["compact_ids"]:
+        # The reads are renamed to their ordinal in the input files
+        headers_fw = headers_rv = ordinals.tolist()
+        out_ids = ["%d\t%s\n" % (headers_fw[i], names_fw[i]) for i in kept]
+    else:
+        headers_fw, headers_rv = batch.headers_fw, batch.headers_rv
+        out_ids = []
+    if fw_length is not None:
+        out_fw = [fq_format % (headers_fw[i], sequences_fw[i][:fw_length], qualities_fw[i][:fw_length])
+                  for i in kept]
+    else:
+        out_fw = [fq_format % (headers_fw[i], sequences_fw[i], qualities_fw[i]) for i in kept]
+    out_rw = [fq_format % (headers_rv[i], sequences_rv[i][:lengths[i]], qualities_rv[i][:lengths[i]]) 
+              for i in kept]
+    out_rw_discarded = [fq_format % batch.records_rv[i] for i in np.flatnonzero(batch.discard).tolist()]
+    # Records of the discarded reads (ordinal, step and reason)
+    out_discards = []
+    if _filter_settings["discards"]:
+        from stpipeline.common.discards import discardRecords
+        for index, read_filter in enumerate(_filter_plan.filters):
+            dropped = np.flatnonzero(batch.dropped_by == index)
+            if len(dropped) > 0:
+                out_discards.append(discardRecords(ordinals[dropped], "filter_input", read_filter.name))
+    return "".join(out_fw), "".join(out_rw), "".join(out_rw_discarded), "".join(out_ids), \
+    "".join(out_discards), batch.size, stats
+
+def _readPairChunks(pairs, chunk_size, fraction=None, max_reads=None, seed=None, counter=None, offset=0,
+                    sample_size=None):
+    """
+    Generator that splits the read pairs in chunks of the given size.
+    It yields tuples with the array of the ordinals of the read pairs
+    in the input and the list of read pairs.
+    A random subset of the read pairs can be selected with Bernoulli 
+    sampling (fraction) or with reservoir sampling (max_reads). The selected 
+    read pairs keep their ordinals and they are yielded in the input order.
+    :param pairs: an iterator of read pairs
+    :param chunk_size: the number of read pairs in a chunk
+    :param fraction: the probability of selecting every read pair (optional)
+    :param max_reads: the number of read pairs to select (optional)
+    :param seed: the seed of the random number generator
+    :param counter: a dictionary where the number of read pairs 
+    read from the input is stored with the key "pairs"
+    :param offset: the ordinal of the first read pair
+    :param sample_size: a function that is given the number of read pairs
+    in the input and that returns the number of read pairs of the reservoir
+    to keep (a random subset of the reservoir is kept), used to select 
+    a random subset of several inputs (see _splitSample())
+    """
+    counter = counter if counter is not None else dict()
+    counter["pairs"] = 0
+    random_state = np.random.RandomState(seed)
+    reservoir = []
+    for chunk in iter(lambda: list(islice(pairs, chunk_size)), []):
+        first_index = counter["pairs"]
+        counter["pairs"] += len(chunk)
+        indexes = np.arange(first_index, first_index + len(chunk), dtype=np.int64)
+        ordinals = indexes + offset
+        if fraction is not None:
+            selected = np.flatnonzero(random_state.random_sample(len(chunk)) < fraction)
+            if len(selected) > 0:
+                yield ordinals[selected], [chunk[i] for i in selected.tolist()]
+        elif max_reads is not None:
+            # Algorithm R, the read pair with index t replaces a random
+            # position of the reservoir with probability max_reads / (t + 1)
+            positions = (random_state.random_sample(len(chunk)) * (indexes + 1)).astype(np.int64)
+            for i in xrange(len(chunk)):
+                if indexes[i] < max_reads:
+                    reservoir.append((ordinals[i], chunk[i]))
+                elif positions[i] < max_reads:
+                    reservoir[positions[i]] = (ordinals[i], chunk[i])
+        else:
+            yield ordinals, chunk
+    if max_reads is not None and fraction is None:
+        if sample_size is not None:
+            size = sample_size(counter["pairs"])
+            if size < len(reservoir):
+                selected = random_state.choice(len(reservoir), size, replace=False)
+                reservoir = [reservoir[i] for i in selected.tolist()]
+        reservoir.sort(key=lambda item: item[0])
+        for start in xrange(0, len(reservoir), chunk_size):
+            items = reservoir[start:start + chunk_size]
+            yield np.array([item[0] for item in items], dtype=np.int64), [item[1] for item in items]
+
+def _splitSample(sizes, sample_size, seed=None):
+    """
+    Draws the number of items of every input in a random subset of the
+    given size of the concatenated inputs (multivariate hypergeometric
+    distribution drawn as a sequence of hypergeometric distributions).
+    :param sizes: the number of items of every input
+    :param sample_size: the number of items to select
+    :param seed: the seed of the random number generator
+    :return: a list with the number of items to select from every input
+    """
+    random_state = np.random.RandomState(seed)
+    remaining = sum(sizes)
+    sample_size = min(sample_size, remaining)
+    split = []
+    for size in sizes:
+        remaining -= size
+        if size == 0 or sample_size == 0:
+            selected = 0
+        elif remaining == 0:
+            selected = sample_size
+        else:
+            selected = int(random_state.hypergeometric(size, remaining, sample_size))
+        split.append(selected)
+        sample_size -= selected
+    return split
+
+def _readLane(lane, fw, rw, subsampling, chunks_queue, sizes_queue):
+    """
+    Decompresses and parses the read pairs of a lane in a reader process
+    and puts the chunks of read pairs (see _readPairChunks()) in the given
+    queue followed by the number of read pairs in the input of the lane
+    and None. When a number of read pairs is selected (reservoir sampling)
+    the number of read pairs in the input is put before the chunks and
+    the number of read pairs to keep from the reservoir is taken from
+    sizes_queue. The error message is put when the files cannot be parsed.
+    """
+    fraction, max_reads, seed = subsampling
+    def sampleSize(pairs):
+        chunks_queue.put(pairs)
+        return sizes_queue.get()
+    try:
+        fw_file = openInputFile(fw)
+        rw_file = openInputFile(rw)
+        try:
+            counter = dict()
+            pairs = izip(readfq_fast(fw_file), readfq_fast(rw_file))
+            for chunk in _readPairChunks(pairs, FILTER_CHUNK_SIZE, fraction, max_reads, seed,
+                                         counter, lane << LANE_ORDINAL_SHIFT, sampleSize):
+                chunks_queue.put(chunk)
+        finally:
+            fw_file.close()
+            rw_file.close()
+        if fraction is not None or max_reads is None:
+            chunks_queue.put(counter["pairs"])
+        chunks_queue.put(None)
+    except Exception as e:
+        chunks_queue.put("Error reading the lane {} {} {}\n{}".format(lane, fw, rw, str(e)))
+
+def _interleavedChunks(chunks_queues, counters, sizes_queues=None, max_reads=None, seed=None):
+    """
+    Generator of (lane, chunk) tuples that takes the chunks of the
+    reader processes of the lanes in turns (see _readLane()) and
+    stores the number of read pairs of every lane in counters.
+    When sizes_queues is given the number of read pairs of every lane
+    is taken first and the random subset of max_reads read pairs of all
+    the lanes is split between the lanes (see _splitSample()).
+    """
+    def nextItem(lane):
+        item = chunks_queues[lane].get()
+        if isinstance(item, basestring):
+            raise RuntimeError(item)
+        return item
+    if sizes_queues is not None:
+        for lane in xrange(len(chunks_queues)):
+            counters[lane] = nextItem(lane)
+        for sizes_queue, size in izip(sizes_queues, _splitSample(counters, max_reads, seed)):
+            sizes_queue.put(size)
+    active = range(len(chunks_queues))
+    while active:
+        for lane in list(active):
+            item = nextItem(lane)
+            if isinstance(item, tuple):
+                yield lane, item
+            elif item is None:
+                active.remove(lane)
+            else:
+                counters[lane] = item
+
+def _filterLanes(lanes, outputs, plan, settings, subsampling, threads):
+    """
+    Filters the read pairs of the lanes (pairs of fastq files) with a pool
+    of processes and writes the kept reads to the given files in the order
+    of the lanes. When there are several lanes every lane is decompressed
+    and parsed by its own reader process (see _readLane()) and the chunks
+    of the lanes are filtered in turns by the same pool. The first lane is
+    written to the output files and the other lanes to lane files that
+    are appended to them at the end.
+    :param lanes: a list of (fw, rw) tuples with the input files of every lane
+    :param outputs: a dictionary with the output files (fw, rw, rw_discarded, ids
+    and discards, None when not written)
+    :param plan: the plan of filters
+    :param settings: the output settings (see _filterReadPairs())
+    :param subsampling: the subsampling parameters (fraction, max_reads, seed),
+    the max_reads read pairs are a random subset of all the lanes
+    :param threads: the number of processes to use
+    :return: a list with a dictionary for every lane with the number of read pairs
+    in the input (pairs), the number of read pairs filtered (reads), the stats of
+    every filter (stats) and the stats of the writers (bytes_fw, bytes_rw, time_blocked)
+    """
+    num_lanes = len(lanes)
+    lane_outputs = [dict((key, filename if lane == 0 or filename is None
+                          else "{}.lane{}".format(filename, lane))
+                         for key, filename in outputs.iteritems())
+                    for lane in xrange(num_lanes)]
+    counters = [None] * num_lanes
+    input_files = []
+    readers = []
+    writers = []
+    pool = None
+    try:
+        if num_lanes == 1:
+            # The reads are parsed in this process
+            input_files = [openInputFile(lanes[0][0]), openInputFile(lanes[0][1])]
+            input_counter = dict()
+            fraction, max_reads, seed = subsampling
+            chunks = ((0, chunk) for chunk in 
+                      _readPairChunks(izip(readfq_fast(input_files[0]), readfq_fast(input_files[1])),
+                                      FILTER_CHUNK_SIZE, fraction, max_reads, seed, input_counter))
+        else:
+            fraction, max_reads, seed = subsampling
+            chunks_queues = [multiprocessing.Queue(FILTER_LANE_QUEUE_SIZE) for _ in xrange(num_lanes)]
+            sizes_queues = [multiprocessing.Queue() for _ in xrange(num_lanes)]
+            for lane, (fw, rw) in enumerate(lanes):
+                lane_subsampling = (fraction, max_reads, None if seed is None else seed + lane)
+                reader = multiprocessing.Process(target=_readLane,
+                                                 args=(lane, fw, rw, lane_subsampling,
+                                                       chunks_queues[lane], sizes_queues[lane]))
+                reader.daemon = True
+                reader.start()
+                readers.append(reader)
+            split = fraction is None and max_reads is not None
+            chunks = _interleavedChunks(chunks_queues, counters, 
+                                        sizes_queues if split else None, max_reads,
+                                        None if seed is None else seed + num_lanes)
+        
+        for lane in xrange(num_lanes):
+            if num_lanes > 1 and lane_outputs[lane]["discards"] is not None:
+                safeRemove(lane_outputs[lane]["discards"])
+            writers.append(dict((key, FastqWriter(filename) if key != "discards" else open(filename, "ab"))
+                                for key, filename in lane_outputs[lane].iteritems() if filename is not None))
+        
+        # The lane of every chunk in the order they are given to the pool
+        chunk_lanes = deque()
+        def laneChunks():
+            for lane, chunk in chunks:
+                chunk_lanes.append(lane)
+                yield chunk
+        if threads > 1:
+            pool = multiprocessing.Pool(threads, _initFilterWorker, (plan, settings))
+            results = _orderedImap(pool, _filterReadPairs, laneChunks(), 2 * threads)
+        else:
+            _initFilterWorker(plan, settings)
+            results = imap(_filterReadPairs, laneChunks())
+        
+        total_reads = [0] * num_lanes
+        stats = [[(0, 0, 0.0)] * len(plan.filters) for _ in xrange(num_lanes)]
+        for chunk_fw, chunk_rw, chunk_rw_discarded, chunk_ids, chunk_discards, \
+        chunk_reads, chunk_stats in results:
+            lane = chunk_lanes.popleft()
+            lane_writers = writers[lane]
+            lane_writers["fw"].writeText(chunk_fw)
+            lane_writers["rw"].writeText(chunk_rw)
+            if "rw_discarded" in lane_writers:
+                lane_writers["rw_discarded"].writeText(chunk_rw_discarded)
+            if "ids" in lane_writers:
+                lane_writers["ids"].writeText(chunk_ids)
+            if "discards" in lane_writers:
+                lane_writers["discards"].write(chunk_discards)
+            total_reads[lane] += chunk_reads
+            stats[lane] = [(reads_in + chunk_in, dropped + chunk_dropped, elapsed + chunk_elapsed)
+                           for (reads_in, dropped, elapsed), (chunk_in, chunk_dropped, chunk_elapsed) 
+                           in izip(stats[lane], chunk_stats)]
+        if pool is not None:
+            pool.close()
+        if num_lanes == 1:
+            counters[0] = input_counter["pairs"]
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        for reader in readers:
+            if reader.is_alive():
+                reader.terminate()
+            reader.join()
+        for input_file in input_files:
+            input_file.close()
+        for lane_writers in writers:
+            for writer in lane_writers.itervalues():
+                writer.close()
+    
+    # Append the files of the other lanes in the order of the lanes
+    for key, filename in outputs.iteritems():
+        if filename is None:
+            continue
+        with open(filename, "ab") as out_file:
+            for lane in xrange(1, num_lanes):
+                with open(lane_outputs[lane][key], "rb") as lane_file:
+                    shutil.copyfileobj(lane_file, out_file)
+                os.remove(lane_outputs[lane][key])
+    
+    return [{"pairs" : counters[lane],
+             "reads" : total_reads[lane],
+             "stats" : stats[lane],
+             "bytes_fw" : writers[lane]["fw"].bytes_written,
+             "bytes_rw" : writers[lane]["rw"].bytes_written,
+             "time_blocked" : writers[lane]["fw"].time_blocked + writers[lane]["rw"].time_blocked}
+            for lane in xrange(num_lanes)]
 
 def filterInputReads(fw, 
                      rw,
@@ -204,16 +801,39 @@ def filterInputReads(fw,
                      qual64=False,
                      umi_filter=False,
                      umi_filter_template="WSNNWSNNV",
-                     umi_quality_bases=3):
+                     umi_quality_bases=3,
+                     adaptor_sequences=[],
+                     adaptor_error_rate=0.0,
+                     out_ids=None,
+                     fw_length=None,
+                     out_discards=None,
+                     subsample_fraction=None,
+                     subsample_reads=None,
+                     seed=None,
+                     contaminant_fasta=None,
+                     contaminant_kmer_size=25,
+                     contaminant_kmer_fraction=0.5,
+                     threads=1):
     """
-    This function does four things (all done in one loop for performance reasons)
+    This function does five things (all done in one loop for performance reasons)
       - It performs a sanity check (forward and reverse reads same length and order)
       - It performs a BWA quality trimming discarding very short reads
       - It removes adaptors from the reads (optional)
       - It performs a sanity check on the UMI (optional)
+      - It discards reads of contaminant sequences, e.g. rRNA (optional)
     Reads that do not pass the filters are discarded (both R1 and R2)
-    :param fw: the fastq file with the forward reads
-    :param rw: the fastq file with the reverse reads
+    When more than one thread is given the read pairs are split in chunks
+    that are filtered by a pool of processes. The output files keep
+    the order of the input files.
+    Several lanes (pairs of fastq files) can be given, every lane is
+    decompressed and parsed by its own process, the read pairs of all the
+    lanes are filtered by the same pool of processes and the reads are
+    written in the order of the lanes (see _filterLanes()). The ordinal of a read pair (compact ids) is its index
+    in its lane plus the index of the lane shifted by LANE_ORDINAL_SHIFT bits.
+    :param fw: the fastq file with the forward reads (it can be gzip or bzip2 compressed)
+    or a list of files (one per lane)
+    :param rw: the fastq file with the reverse reads (it can be gzip or bzip2 compressed)
+    or a list of files (one per lane)
     :param out_fw: the name of the output file for the forward reads
     :param out_rw: the name of the output file for the reverse reads
     :param out_rw_discarded: the name of the output file for descarded reads
@@ -227,50 +847,51 @@ def filterInputReads(fw,
     :param polyA_min_distance: if >0 we remove PolyA adaptors from the reads
     :param polyT_min_distance: if >0 we remove PolyT adaptors from the reads
     :param polyG_min_distance: if >0 we remove PolyG adaptors from the reads
+    :param polyC_min_distance: if >0 we remove PolyC adaptors from the reads
     :param qual64: true of qualities are in phred64 format
     :param umi_filter performs: a UMI quality filter when True
     :param umi_filter_template: the template to use for the UMI filter
     :param umi_quality_bases: the number of low quality bases allowed in an UMI
+    :param adaptor_sequences: a list of other adaptors to remove from the reads
+    :param adaptor_error_rate: the max allowed rate of mismatches in the adaptors
+    :param out_ids: when given the reads are renamed to compact integer ids (their ordinal 
+    in the input files) and the original names are written to this file (tab separated)
+    :param fw_length: when given the forward reads are truncated to this length
+    :param out_discards: when given a binary record (ordinal, step, reason) of every
+    discarded read is appended to this file (see stpipeline.common.discards)
+    :param subsample_fraction: when given only a random subset of the read pairs is filtered,
+    every read pair is selected with this probability (Bernoulli sampling)
+    :param subsample_reads: when given only a random subset of this number of read pairs
+    is filtered (reservoir sampling), the read pairs are a random subset of all the lanes
+    :param seed: the seed used to select the random subset of read pairs
+    :param contaminant_fasta: when given the reads whose k-mers are found in the 
+    sequences of this fasta file are discarded
+    :param contaminant_kmer_size: the size of the k-mers used to screen the contaminants
+    :param contaminant_kmer_fraction: the min fraction of the k-mers of a read found 
+    in the contaminant sequences to discard the read
+    :param threads: the number of processes to use to filter the reads
     """
     logger = logging.getLogger("STPipeline")
     
-    if not os.path.isfile(fw) or not os.path.isfile(rw):
-        error = "Error, input file/s not present {}\n{}\n".format(fw,rw)
+    lanes_fw = [fw] if isinstance(fw, basestring) else list(fw)
+    lanes_rw = [rw] if isinstance(rw, basestring) else list(rw)
+    if len(lanes_fw) == 0 or len(lanes_fw) != len(lanes_rw):
+        error = "Error, the number of forward and reverse input files " \
+        "is not the same {}\n{}\n".format(fw,rw)
         logger.error(error)
         raise RuntimeError(error)
     
-    # Check if discarded files must be written out 
-    keep_discarded_files = out_rw_discarded is not None
-    
-    # Create output file writers
-    out_rw_handle = safeOpenFile(out_rw, 'w')
-    out_rw_writer = writefq(out_rw_handle)
-    out_fw_handle = safeOpenFile(out_fw, 'w')
-    out_fw_writer = writefq(out_fw_handle)
-    if keep_discarded_files:
-        out_rw_handle_discarded = safeOpenFile(out_rw_discarded, 'w')
-        out_rw_writer_discarded = writefq(out_rw_handle_discarded)
-    
-    # Some counters
-    total_reads = 0
-    dropped_rw = 0
-    dropped_umi = 0
-    dropped_umi_template = 0
-    dropped_AT = 0
-    dropped_adaptor = 0
+    for lane_fw, lane_rw in izip(lanes_fw, lanes_rw):
+        if not os.path.isfile(lane_fw) or not os.path.isfile(lane_rw):
+            error = "Error, input file/s not present {}\n{}\n".format(lane_fw,lane_rw)
+            logger.error(error)
+            raise RuntimeError(error)
     
     # Build fake sequence adaptors with the parameters given
-    adaptorA = "".join("A" for k in xrange(polyA_min_distance))
-    adaptorT = "".join("T" for k in xrange(polyT_min_distance))
-    adaptorG = "".join("G" for k in xrange(polyG_min_distance))
-    adaptorC = "".join("C" for k in xrange(polyC_min_distance))
-    do_adaptorA = polyA_min_distance > 0
-    do_adaptorT = polyT_min_distance > 0
-    do_adaptorG = polyG_min_distance > 0
-    do_adaptorC = polyC_min_distance > 0
-    
-    # Quality format
-    phred = 64 if qual64 else 33
+    adaptors = ["".join(base for k in xrange(distance))
+                for base, distance in [("A", polyA_min_distance), ("T", polyT_min_distance),
+                                       ("G", polyG_min_distance), ("C", polyC_min_distance)]
+                if distance > 0] + list(adaptor_sequences)
     
     # Check if barcode settings are correct
     iscorrect_mc = molecular_barcodes
@@ -279,113 +900,86 @@ def filterInputReads(fw,
         logger.warning("Your UMI sequences overlap with the barcodes sequences")
         iscorrect_mc = False
     
-    # Open fastq files with the fastq parser
-    fw_file = safeOpenFile(fw, "rU")
-    rw_file = safeOpenFile(rw, "rU")
-    for (header_fw, sequence_fw, quality_fw), (header_rv, sequence_rv, quality_rv) \
-    in izip(readfq(fw_file), readfq(rw_file)):
-        
-        if not sequence_fw or not sequence_fw:
-            error = "Error doing quality trimming checks of raw reads.\n" \
-            "The input files {},{} are not of the same length".format(fw,rw)
-            logger.error(error)
-            fw_file.close()
-            rw_file.close()
-            out_rw_handle.flush()
-            out_rw_writer.close()
-            out_fw_handle.flush()
-            out_fw_writer.close()
-            if keep_discarded_files:
-                out_rw_handle_discarded.flush()
-                out_rw_writer_discarded.close()
-            raise RuntimeError(error)
-        
-        if header_fw.split()[0] != header_rv.split()[0]:
-            logger.warning("Pair reads found with different " \
-                           "names {} and {}".format(header_fw,header_rv))
-            
-        # Increase reads counter
-        total_reads += 1
-        discard_read = False
-        
-        # If we want to check for UMI quality and the UMI is incorrect
-        # then we discard the reads
-        if iscorrect_mc and umi_filter \
-        and not check_umi_template(sequence_fw[mc_start:mc_end], umi_filter_template):
-            dropped_umi_template += 1
-            discard_read = True
-        
-        # Check if the UMI has any low quality base
-        if not discard_read and iscorrect_mc and \
-        len([b for b in quality_fw[mc_start:mc_end] if (ord(b) - phred) < min_qual]) > umi_quality_bases:
-            dropped_umi += 1
-            discard_read = True
-                                                            
-        # If reverse read has a high AT content discard...
-        if not discard_read and \
-        ((sequence_rv.count("A") + sequence_rv.count("T")) / len(sequence_rv)) * 100 >= filter_AT_content:
-            dropped_AT += 1
-            discard_read = True
-        
-        # Store the original reads to write them to the discarded output if applies
-        if keep_discarded_files:    
-            orig_sequence_rv = sequence_rv
-            orig_quality_rv = quality_rv 
-            
-        if not discard_read:  
-            # if indicated we remove the artifacts PolyA from reverse reads
-            if do_adaptorA: 
-                sequence_rv, quality_rv = removeAdaptor(sequence_rv, quality_rv, adaptorA) 
-            # if indicated we remove the artifacts PolyT from reverse reads
-            if do_adaptorT: 
-                sequence_rv, quality_rv = removeAdaptor(sequence_rv, quality_rv, adaptorT) 
-            # if indicated we remove the artifacts PolyG from reverse reads
-            if do_adaptorG: 
-                sequence_rv, quality_rv = removeAdaptor(sequence_rv, quality_rv, adaptorG) 
-            # if indicated we remove the artifacts PolyC from reverse reads
-            if do_adaptorC: 
-                sequence_rv, quality_rv = removeAdaptor(sequence_rv, quality_rv, adaptorC)
-            # Check if the read is smaller than the minimum after removing artifacts   
-            if len(sequence_rv) < min_length:
-                dropped_adaptor += 1
-                discard_read = True
-            else:              
-                # Trim reverse read (will return None if length of trimmed sequence is lower than min)
-                sequence_rv, quality_rv = trim_quality(sequence_rv, quality_rv, 
-                                                       min_qual, min_length, phred)
-                if not sequence_rv or not quality_rv:
-                    discard_read = True
-
-                
-        # Write reverse read to output
-        if not discard_read:
-            out_rw_writer.send((header_rv, sequence_rv, quality_rv))
-            out_fw_writer.send((header_fw, sequence_fw, quality_fw))
-        else:
-            dropped_rw += 1  
-            if keep_discarded_files:
-                out_rw_writer_discarded.send((header_rv, orig_sequence_rv, orig_quality_rv))
-    
-    fw_file.close()
-    rw_file.close()
-    out_rw_handle.flush()
-    out_rw_writer.close()
-    out_fw_handle.flush()
-    out_fw_writer.close()
-    if keep_discarded_files:
-        out_rw_handle_discarded.flush()
-        out_rw_writer_discarded.close()
-        
+    # Assemble the plan of filters (shared with the workers)
+    from stpipeline.common.filters import createFilterPlan
+    plan = createFilterPlan(umi_filter,
+                            umi_filter_template,
+                            iscorrect_mc,
+                            mc_start,
+                            mc_end,
+                            umi_quality_bases,
+                            filter_AT_content,
+                            adaptors,
+                            min_qual,
+                            min_length,
+                            64 if qual64 else 33,
+                            adaptor_error_rate,
+                            contaminant_fasta,
+                            contaminant_kmer_size,
+                            contaminant_kmer_fraction)
+    
+    outputs = {"fw" : out_fw,
+               "rw" : out_rw,
+               "rw_discarded" : out_rw_discarded,
+               "ids" : out_ids,
+               "discards" : out_discards}
+    settings = {"compact_ids" : out_ids is not None,
+                "fw_length" : fw_length,
+                "discards" : out_discards is not None,
+                "lanes" : zip(lanes_fw, lanes_rw)}
+    num_lanes = len(lanes_fw)
+    
+    try:
+        lane_results = _filterLanes(zip(lanes_fw, lanes_rw), outputs, plan, settings,
+                                    (subsample_fraction, subsample_reads, seed), threads)
+    except RuntimeError as e:
+        logger.error(str(e))
+        raise
+    
+    total_reads = 0
+    input_pairs = 0
+    qa_stats.input_lanes = []
+    for lane, lane_result in enumerate(lane_results):
+        plan.update(lane_result["stats"])
+        lane_dropped = sum(dropped for _, dropped, _ in lane_result["stats"])
+        total_reads += lane_result["reads"]
+        input_pairs += lane_result["pairs"]
+        qa_stats.input_lanes.append({"lane" : lane,
+                                     "fastq_fw" : lanes_fw[lane],
+                                     "fastq_rv" : lanes_rw[lane],
+                                     "input_reads" : lane_result["reads"],
+                                     "reads_after_trimming" : lane_result["reads"] - lane_dropped})
+        if num_lanes > 1:
+            logger.info("Trimming stats lane {} total reads (pair): {} reads remaining: {}".format(
+                lane, lane_result["reads"], lane_result["reads"] - lane_dropped))
+    
+    dropped_rw = sum(read_filter.reads_dropped for read_filter in plan.filters)
     # Write info to the log
+    if subsample_fraction is not None or subsample_reads is not None:
+        logger.info("Trimming stats read pairs in the input: {}".format(input_pairs))
+        logger.info("Trimming stats read pairs selected randomly: {}".format(total_reads))
     logger.info("Trimming stats total reads (pair): {}".format(total_reads))
     logger.info("Trimming stats {} reads have been dropped!".format(dropped_rw)) 
-    perc2 = '{percent:.2%}'.format(percent= float(dropped_rw) / float(total_reads) )
+    perc2 = '{percent:.2%}'.format(percent= float(dropped_rw) / float(max(total_reads, 1)) )
     logger.info("Trimming stats you just lost about {} of your data".format(perc2))
     logger.info("Trimming stats reads remaining: {}".format(total_reads - dropped_rw))
-    logger.info("Trimming stats dropped pairs due to incorrect UMI: {}".format(dropped_umi_template))
-    logger.info("Trimming stats dropped pairs due to low quality UMI: {}".format(dropped_umi))
-    logger.info("Trimming stats dropped pairs due to high AT content: {}".format(dropped_AT))
-    logger.info("Trimming stats dropped pairs due to presence of artifacts: {}".format(dropped_adaptor))
+    logger.info("Trimming stats dropped pairs due to incorrect UMI: {}".format(plan.dropped("umi_template")))
+    logger.info("Trimming stats dropped pairs due to low quality UMI: {}".format(plan.dropped("umi_quality")))
+    logger.info("Trimming stats dropped pairs due to high AT content: {}".format(plan.dropped("at_content")))
+    logger.info("Trimming stats dropped pairs due to presence of artifacts: {}".format(plan.dropped("adaptors")))
+    if contaminant_fasta is not None:
+        logger.info("Trimming stats dropped pairs due to contaminant sequences: {}".format(plan.dropped("contaminant")))
+    for read_filter in plan.filters:
+        logger.info("Trimming stats filter {} ({}): reads in {}, reads dropped {}, " \
+                    "time {:.2f} seconds".format(read_filter.name,
+                                                 read_filter.description,
+                                                 read_filter.reads_in,
+                                                 read_filter.reads_dropped,
+                                                 read_filter.time))
+    logger.debug("Trimming stats bytes written {} (R1) {} (R2), time waiting " \
+                 "for the writers {:.2f} seconds".format(sum(r["bytes_fw"] for r in lane_results),
+                                                         sum(r["bytes_rw"] for r in lane_results),
+                                                         sum(r["time_blocked"] for r in lane_results)))
     
     # Check that output file was written ok
     if not fileOk(out_rw):
@@ -399,31 +993,232 @@ def filterInputReads(fw,
     qa_stats.input_reads_reverse = total_reads
     qa_stats.reads_after_trimming_forward = total_reads
     qa_stats.reads_after_trimming_reverse = total_reads - dropped_rw
+    if contaminant_fasta is not None:
+        qa_stats.reads_after_rRNA_trimming = total_reads - dropped_rw
+    qa_stats.input_filters = plan.stats()
+    qa_stats.subsample_fraction = float(total_reads) / float(max(input_pairs, 1))
+
+def collapseDuplicateReads(fw,
+                           rw,
+                           out_fw,
+                           out_rw,
+                           key_length,
+                           low_memory=False,
+                           out_discards=None):
+    """
+    Collapses the read pairs that are exact duplicates (same
+    forward sequence up to key_length, which includes the spatial barcode
+    and the UMI, and same reverse sequence) into one read pair.
+    The number of reads collapsed (multiplicity) is added to the header 
+    of the forward read as the tag B4:i:N when it is bigger than 1 so it can be
+    carried to the mapped reads. The first read pair of every group is kept.
+    :param fw: the fastq file with the forward reads (after filtering)
+    :param rw: the fastq file with the reverse reads (after filtering)
+    :param out_fw: the name of the output file for the forward reads
+    :param out_rw: the name of the output file for the reverse reads
+    :param key_length: the number of bases of the forward reads to use in the key
+    :param low_memory: True to use a key-value db instead of dict
+    :param out_discards: when given a binary record of every collapsed read is appended to this
+    file (the reads must have integer ids)
+    :type fw: str
+    :type rw: str
+    :type out_fw: str
+    :type out_rw: str
+    :type key_length: integer
+    :type low_memory: boolean
+    :type out_discards: str
+    :return: a tuple with the number of read pairs before and after collapsing
+    :raises: RuntimeError
+    """
+    logger = logging.getLogger("STPipeline")
+    
+    if not os.path.isfile(fw) or not os.path.isfile(rw):
+        error = "Error, input file/s not present {}\n{}\n".format(fw,rw)
+        logger.error(error)
+        raise RuntimeError(error)
+    
+    if low_memory:
+        multiplicities = SqliteDict(autocommit=False, flag='c', journal_mode='OFF')
+    else:
+        multiplicities = dict()
+    
+    # First pass counts the occurrences of every key
+    # The probability of a collision is very very low
+    total_reads = 0
+    with safeOpenFile(fw, "rU") as fw_file, safeOpenFile(rw, "rU") as rw_file:
+        for (_, sequence_fw, _), (_, sequence_rw, _) in izip(readfq_fast(fw_file), readfq_fast(rw_file)):
+            key = hash((sequence_fw[:key_length], sequence_rw))
+            multiplicities[key] = multiplicities.get(key, 0) + 1
+            total_reads += 1
+    if low_memory: multiplicities.commit()
+    
+    # Second pass writes the first read pair of every key
+    unique_reads = 0
+    collapsed = []
+    with safeOpenFile(fw, "rU") as fw_file, safeOpenFile(rw, "rU") as rw_file, \
+    FastqWriter(out_fw) as out_fw_writer, FastqWriter(out_rw) as out_rw_writer:
+        for (header_fw, sequence_fw, quality_fw), record_rw in izip(readfq_fast(fw_file), 
+                                                                    readfq_fast(rw_file)):
+            key = hash((sequence_fw[:key_length], record_rw[1]))
+            multiplicity = multiplicities.pop(key, 0)
+            if multiplicity == 0:
+                if out_discards is not None:
+                    collapsed.append(int(header_fw.split(None, 1)[0]))
+                continue
+            if multiplicity > 1:
+                header_fw = "{} B4:i:{}".format(header_fw, multiplicity)
+            out_fw_writer.write((header_fw, sequence_fw, quality_fw))
+            out_rw_writer.write(record_rw)
+            unique_reads += 1
+    if low_memory: multiplicities.close()
+    if out_discards is not None:
+        from stpipeline.common.discards import writeDiscards
+        writeDiscards(out_discards, collapsed, "collapse_duplicates", "duplicate")
+    
+    if not fileOk(out_fw) or not fileOk(out_rw):
+        error = "Error collapsing duplicated reads.\n" \
+        "Output file is not present {}\n{}\n".format(out_fw, out_rw)
+        logger.error(error)
+        raise RuntimeError(error)
+    
+    logger.info("Duplicates collapsing stats total read pairs: {}".format(total_reads))
+    logger.info("Duplicates collapsing stats unique read pairs: {}".format(unique_reads))
+    logger.info("Duplicates collapsing stats collapsed read pairs: {}".format(total_reads - unique_reads))
+    return total_reads, unique_reads
+
+def _writeDuplicates(duplicates, index_file):
+    """
+    Writes the buffered (first, ordinal) pairs of ids of reads with the
+    same sequence as records of DUPLICATE_DTYPE (see writeUniqueSequences())
+    """
+    if len(duplicates) == 0:
+        return
+    pairs = np.frombuffer(duplicates, dtype="u{}".format(duplicates.itemsize)).astype("<u8")
+    pairs.view(DUPLICATE_DTYPE).tofile(index_file)
+
+def writeUniqueSequences(reads,
+                         out_reads,
+                         out_index,
+                         low_memory=False):
+    """
+    Writes only the first read of every distinct sequence present 
+    in the input file so identical sequences are mapped only once.
+    The ids of the other reads with the same sequence are written
+    to a binary index file (one record of DUPLICATE_DTYPE per read with
+    the id of the read that was kept and the id of the read)
+    so the alignments can be expanded back with expandMappedReads().
+    The reads must have integer ids. When the tags are carried in the
+    read names (see embedTagsInName()) only the reads with the same
+    sequence and the same tags are collapsed.
+    :param reads: the fastq file with the reads
+    :param out_reads: the name of the output file for the unique reads
+    :param out_index: the name of the output index file
+    :param low_memory: True to use a key-value db instead of dict
+    :type reads: str
+    :type out_reads: str
+    :type out_index: str
+    :type low_memory: boolean
+    :return: a tuple with the number of reads and the number of unique sequences
+    :raises: RuntimeError
+    """
+    logger = logging.getLogger("STPipeline")
+    
+    if not os.path.isfile(reads):
+        error = "Error, input file not present {}\n".format(reads)
+        logger.error(error)
+        raise RuntimeError(error)
+    
+    if low_memory:
+        sequences = SqliteDict(autocommit=False, flag='c', journal_mode='OFF')
+    else:
+        sequences = dict()
+    
+    total_reads = 0
+    unique_reads = 0
+    duplicates = array("L")
+    with safeOpenFile(reads, "rU") as in_file, safeOpenFile(out_index, "wb") as index_file, \
+    FastqWriter(out_reads) as out_writer:
+        for header, sequence, quality in readfq_fast(in_file):
+            total_reads += 1
+            # Assumes STAR will only output the first token of the read name
+            read_id, _, tags = header.split(None, 1)[0].partition(READ_TAGS_SEPARATOR)
+            try:
+                ordinal = int(read_id)
+            except ValueError:
+                error = "Error writing unique sequences.\n" \
+                "The read {} does not have an integer id".format(header)
+                logger.error(error)
+                raise RuntimeError(error)
+            # The probability of a collision is very very low
+            key = hash((tags, sequence)) if tags else hash(sequence)
+            first = sequences.get(key)
+            if first is None:
+                sequences[key] = ordinal
+                out_writer.write((header, sequence, quality))
+                unique_reads += 1
+            else:
+                duplicates.extend((first, ordinal))
+                if len(duplicates) >= 2 * DUPLICATE_BUFFER_SIZE:
+                    _writeDuplicates(duplicates, index_file)
+                    duplicates = array("L")
+        _writeDuplicates(duplicates, index_file)
+    if low_memory: sequences.close()
+    
+    if not fileOk(out_reads):
+        error = "Error writing unique sequences.\n" \
+        "Output file is not present {}\n".format(out_reads)
+        logger.error(error)
+        raise RuntimeError(error)
+    
+    logger.info("Unique sequences stats total reads: {}".format(total_reads))
+    logger.info("Unique sequences stats unique sequences: {}".format(unique_reads))
+    return total_reads, unique_reads
 
-#TODO this approach uses too much memory
-#     find a better solution (maybe Cython or C++)
 def hashDemultiplexedReads(reads,
                            has_umi,
                            umi_start,
                            umi_end,
-                           low_memory):
+                           low_memory,
+                           integer_ids=False,
+                           whitelist=None,
+                           compact=False,
+                           partitions=0,
+                           temp_folder=None):
     """
     This function extracts the read name and the x,y coordinates
     from the reads given as input and returns a hash
     with the clean read name as key and (x,y,umi) as
     values (umi is optional). X and Y correspond
     to the array coordinates of the barcode of the read.
+    When a whitelist of barcodes is given the reads with
+    other barcodes are not added to the hash.
+    When compact is True the tags are kept in a ReadTagStore instead of a
+    dictionary and when low_memory is True they are kept on disk in a
+    MappedReadTagStore (the coordinates must be integers). When partitions
+    is given the tags are spilled to disk in that number of partitions
+    (PartitionedReadTags) to be joined to the alignments partition by partition.
     :param reads: path to a file with the fastq reads after demultiplexing
     :param has_umi: True if the read sequence contains UMI
     :param umi_start: the start position of the UMI
     :param umi_end: the end position of the UMI
-    :param low_memory: True to use a key-value db instead of dict
+    :param low_memory: True to keep the tags on disk (MappedReadTagStore)
+    :param integer_ids: True if the reads were renamed to integer ids (used as keys)
+    :param whitelist: a set with the barcodes of the spots to keep (optional)
+    :param compact: True to use a ReadTagStore instead of dict
+    :param partitions: the number of partitions of a PartitionedReadTags (0 to disable)
+    :param temp_folder: the folder where the tags are kept on disk (default: the folder of the reads)
     :type reads: str
     :type has_umi: boolean
     :type umi_start: integer
     :type umi_end: integer
     :type low_memory: boolean
-    :return: a dictionary of read_name -> (x,y,umi) tags where umi is optional
+    :type integer_ids: boolean
+    :type whitelist: set
+    :type compact: boolean
+    :type partitions: integer
+    :type temp_folder: str
+    :return: a dictionary of read_name -> (x,y,umi,multiplicity) tags where umi 
+    and multiplicity are optional
     """
     logger = logging.getLogger("STPipeline")
     
@@ -433,15 +1228,30 @@ def hashDemultiplexedReads(reads,
         raise RuntimeError(error)
     
     assert(umi_start >= 0 and umi_start < umi_end)
-    if low_memory:
-        hash_reads = SqliteDict(autocommit=False, flag='c', journal_mode='OFF')
+    compact = compact or low_memory or partitions > 0
+    if temp_folder is None:
+        temp_folder = os.path.dirname(os.path.abspath(reads))
+    if compact:
+        umi_length = umi_end - umi_start if has_umi else 0
+        if partitions > 0:
+            hash_reads = PartitionedReadTags(partitions, temp_folder, umi_length)
+        elif low_memory:
+            hash_reads = MappedReadTagStore(temp_folder, umi_length)
+        else:
+            hash_reads = ReadTagStore(umi_length)
     else:
         hash_reads = dict()
     
+    total_reads = 0
+    dropped_reads = 0
+    has_multiplicities = False
     fastq_file = safeOpenFile(reads, "rU")
-    for name, sequence, _ in readfq(fastq_file):
+    for name, sequence, _ in readfq_fast(fastq_file):
         # Assumes the header ends like this B0:Z:GTCCCACTGGAACGACTGTCCCGCATC B1:Z:678 B2:Z:678
         header_tokens = name.split()
+        if whitelist is not None and header_tokens[-3][5:] not in whitelist:
+            dropped_reads += 1
+            continue
         # TODO add an error check here
         x = header_tokens[-2]
         y = header_tokens[-1]
@@ -453,10 +1263,198 @@ def hashDemultiplexedReads(reads,
             # Add the UMI as an extra tag
             umi = sequence[umi_start:umi_end]
             tags.append("B3:Z:%s" % umi)
+        # Add the multiplicity of collapsed duplicates if present
+        multiplicity = 1
+        if "B4:i:" in name:
+            for token in header_tokens[1:-2]:
+                if token.startswith("B4:i:"):
+                    tags.append(token)
+                    multiplicity = int(token[5:])
+                    has_multiplicities = True
+        total_reads += multiplicity
         # The probability of a collision is very very low
-        key = hash(header_tokens[0])
-        hash_reads[key] = tags
+        key = int(header_tokens[0]) if integer_ids else hash(header_tokens[0])
+        if compact:
+            try:
+                hash_reads.add(key, int(x[5:]), int(y[5:]), umi if has_umi else None, multiplicity)
+            except (ValueError, OverflowError):
+                fastq_file.close()
+                hash_reads.close()
+                error = "Error, the coordinates of the read {} are not valid " \
+                "16 bits integers\n".format(name)
+                logger.error(error)
+                raise RuntimeError(error)
+        else:
+            hash_reads[key] = tags
         
-    if low_memory: hash_reads.commit()
-    fastq_file.close()    
-    return hash_reads
\ No newline at end of file
+    if compact: hash_reads.freeze()
+    fastq_file.close()
+    if whitelist is not None:
+        logger.info("Demultiplexed reads with a barcode not present " \
+                    "in the spot whitelist: {}".format(dropped_reads))
+    # Collapsed reads count as many times as their multiplicity
+    if has_multiplicities or whitelist is not None:
+        qa_stats.reads_after_demultiplexing = total_reads
+    return hash_reads
+
+def iterDemultiplexedTags(reads,
+                          has_umi,
+                          umi_start,
+                          umi_end,
+                          whitelist=None):
+    """
+    Generator of the tags of the demultiplexed reads in the order of the file
+    (the streaming counterpart of hashDemultiplexedReads() used to merge-join
+    the reads and the alignments, see OrdinalTagJoin).
+    The reads must have been renamed to integer ids.
+    :param reads: path to a file with the fastq reads after demultiplexing
+    :param has_umi: True if the read sequence contains UMI
+    :param umi_start: the start position of the UMI
+    :param umi_end: the end position of the UMI
+    :param whitelist: a set with the barcodes of the spots to keep (optional)
+    :type reads: str
+    :type has_umi: boolean
+    :type umi_start: integer
+    :type umi_end: integer
+    :type whitelist: set
+    :return: yields (read id, tags) where tags is a list of (tag, value, type) tuples
+    :raises: RuntimeError
+    """
+    logger = logging.getLogger("STPipeline")
+    
+    if not os.path.isfile(reads):
+        error = "Error, input file not present {}\n".format(reads)
+        logger.error(error)
+        raise RuntimeError(error)
+    
+    assert(umi_start >= 0 and umi_start < umi_end)
+    total_reads = 0
+    dropped_reads = 0
+    has_multiplicities = False
+    fastq_file = safeOpenFile(reads, "rU")
+    try:
+        for name, sequence, _ in readfq_fast(fastq_file):
+            # Assumes the header ends like this B0:Z:GTCCCACTGGAACGACTGTCCCGCATC B1:Z:678 B2:Z:678
+            header_tokens = name.split()
+            if whitelist is not None and header_tokens[-3][5:] not in whitelist:
+                dropped_reads += 1
+                continue
+            tags = [(header_tokens[-2][:2], header_tokens[-2][5:], "Z"),
+                    (header_tokens[-1][:2], header_tokens[-1][5:], "Z")]
+            if has_umi:
+                tags.append(("B3", sequence[umi_start:umi_end], "Z"))
+            multiplicity = 1
+            if "B4:i:" in name:
+                for token in header_tokens[1:-2]:
+                    if token.startswith("B4:i:"):
+                        multiplicity = int(token[5:])
+                        tags.append(("B4", multiplicity, "i"))
+                        has_multiplicities = True
+            total_reads += multiplicity
+            yield int(header_tokens[0]), tags
+    finally:
+        fastq_file.close()
+    if whitelist is not None:
+        logger.info("Demultiplexed reads with a barcode not present " \
+                    "in the spot whitelist: {}".format(dropped_reads))
+    # Collapsed reads count as many times as their multiplicity
+    if has_multiplicities or whitelist is not None:
+        qa_stats.reads_after_demultiplexing = total_reads
+
+def embedTagsInName(name, tags):
+    """
+    Adds the tags of a demultiplexed read to its name as
+    readid|x|y|UMI or readid|x|y|UMI|multiplicity (when it is bigger than 1)
+    so they are kept by the mapping step (see parseTagsFromName())
+    :param name: the name of the read (first token)
+    :param tags: a list of (tag, value, type) tuples (B1, B2 and optionally B3 and B4)
+    :return: the name with the tags
+    """
+    values = dict((tag, value) for tag, value, _ in tags)
+    fields = [name, values["B1"], values["B2"], values.get("B3", "")]
+    if values.get("B4", 1) > 1:
+        fields.append(values["B4"])
+    return READ_TAGS_SEPARATOR.join(str(field) for field in fields)
+
+def parseTagsFromName(name):
+    """
+    Parses the tags of a read from its name (see embedTagsInName())
+    :param name: the name of the read with the tags
+    :return: a tuple with the name of the read without the tags
+    and a list of (tag, value, type) tuples
+    """
+    fields = name.split(READ_TAGS_SEPARATOR)
+    tags = [("B1", fields[1], "Z"), ("B2", fields[2], "Z")]
+    if fields[3]:
+        tags.append(("B3", fields[3], "Z"))
+    if len(fields) > 4:
+        tags.append(("B4", int(fields[4]), "i"))
+    return fields[0], tags
+
+def filterDemultiplexedReads(reads,
+                             out_reads,
+                             hash_reads,
+                             integer_ids=False,
+                             out_discards=None,
+                             embed_tags=False):
+    """
+    Writes only the reads whose read pair was demultiplexed (present
+    in the hash of hashDemultiplexedReads()) so the reads without a
+    valid barcode are not mapped.
+    :param reads: the fastq file with the reverse reads
+    :param out_reads: the name of the output file for the kept reads
+    :param hash_reads: the hash of demultiplexed reads (read_name -> tags),
+    a ReadTagStore or an OrdinalTagJoin
+    :param integer_ids: True if the reads were renamed to integer ids (used as keys)
+    :param out_discards: when given a binary record of every discarded read
+    is appended to this file (see stpipeline.common.discards)
+    :param embed_tags: True to add the tags to the names of the kept reads
+    (see embedTagsInName())
+    :type reads: str
+    :type out_reads: str
+    :type integer_ids: boolean
+    :type embed_tags: boolean
+    :return: a tuple with the number of reads and the number of reads kept
+    :raises: RuntimeError
+    """
+    logger = logging.getLogger("STPipeline")
+    
+    if not os.path.isfile(reads):
+        error = "Error, input file not present {}\n".format(reads)
+        logger.error(error)
+        raise RuntimeError(error)
+    
+    total_reads = 0
+    kept_reads = 0
+    discarded = []
+    with safeOpenFile(reads, "rU") as in_file, FastqWriter(out_reads) as out_writer:
+        records = readfq_fast(in_file)
+        for chunk in iter(lambda: list(islice(records, FILTER_CHUNK_SIZE)), []):
+            total_reads += len(chunk)
+            # Assumes STAR will only output the first token of the read name
+            names = [header.split(None, 1)[0] for header, _, _ in chunk]
+            keys = [int(name) for name in names] if integer_ids else [hash(name) for name in names]
+            for (header, sequence, quality), name, key, tags in izip(chunk, names, keys,
+                                                                    lookupTags(hash_reads, keys)):
+                if tags is not None:
+                    if embed_tags:
+                        header = embedTagsInName(name, tags) + header[len(name):]
+                    out_writer.write((header, sequence, quality))
+                    kept_reads += 1
+                elif out_discards is not None:
+                    discarded.append(key)
+    if isinstance(hash_reads, OrdinalTagJoin):
+        hash_reads.close()
+    if out_discards is not None:
+        from stpipeline.common.discards import writeDiscards
+        writeDiscards(out_discards, discarded, "demultiplexing", "barcode")
+    
+    if not fileOk(out_reads):
+        error = "Error filtering demultiplexed reads.\n" \
+        "Output file is not present {}\n".format(out_reads)
+        logger.error(error)
+        raise RuntimeError(error)
+    
+    logger.info("Demultiplexed reads stats total reads: {}".format(total_reads))
+    logger.info("Demultiplexed reads stats reads kept for mapping: {}".format(kept_reads))
+    return total_reads, kept_reads
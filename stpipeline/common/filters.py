@@ -0,0 +1,295 @@
+"""
+This module contains the filters applied to the raw read pairs.
+The filters are assembled once from the pipeline parameters
+into an ordered plan. Every filter works on a batch of read
+pairs at once and keeps track of how many reads it processed,
+how many reads it dropped and how much time it spent.
+"""
+
+from stpipeline.common.fastq_utils import to_uint8_array, quality_trim_index_batch, \
+umi_low_quality_bases_batch, at_count_batch
+from stpipeline.common.adaptors import AdaptorFinder
+from stpipeline.common.contaminants import KmerScreen
+import numpy as np
+import time
+import re
+
+class ReadBatch(object):
+    """
+    A batch of read pairs to be filtered. It holds the
+    reads and the arrays shared by the filters. The filters
+    mark the discarded reads in the mask discard and can shorten
+    the reverse reads by changing trimmed_lengths. The index in the
+    plan of the filter that discarded every read is kept in dropped_by.
+    """
+    def __init__(self, pairs):
+        self.size = len(pairs)
+        self.records_fw, self.records_rv = zip(*pairs)
+        self.headers_fw, self.sequences_fw, self.qualities_fw = zip(*self.records_fw)
+        self.headers_rv, self.sequences_rv, self.qualities_rv = zip(*self.records_rv)
+        self.discard = np.zeros(self.size, dtype=np.bool)
+        self.dropped_by = np.full(self.size, -1, dtype=np.int8)
+        self.sequences_rv_array, self.lengths_rv = to_uint8_array(self.sequences_rv)
+        self.trimmed_lengths = self.lengths_rv.copy()
+        self._qualities_fw_array = None
+        self._qualities_rv_array = None
+
+    @property
+    def qualities_fw_array(self):
+        if self._qualities_fw_array is None:
+            self._qualities_fw_array, _ = to_uint8_array(self.qualities_fw)
+        return self._qualities_fw_array
+
+    @property
+    def qualities_rv_array(self):
+        if self._qualities_rv_array is None:
+            self._qualities_rv_array, _ = to_uint8_array(self.qualities_rv)
+        return self._qualities_rv_array
+
+class ReadFilter(object):
+    """
+    Base class for the read filters. Subclasses must define the method
+    apply(batch, active) that returns a mask of the reads of the batch
+    to discard, active is the mask of the reads not discarded yet.
+    """
+    name = None
+    description = None
+
+    def __init__(self):
+        self.reads_in = 0
+        self.reads_dropped = 0
+        self.time = 0.0
+
+    def run(self, batch):
+        """
+        Runs the filter over the batch and updates the mask of discarded reads
+        :return: a tuple (reads in, reads dropped, time) for the batch
+        """
+        start = time.time()
+        active = ~batch.discard
+        dropped = self.apply(batch, active) & active
+        batch.discard |= dropped
+        return int(np.sum(active)), int(np.sum(dropped)), time.time() - start
+
+    def update(self, reads_in, reads_dropped, elapsed):
+        self.reads_in += reads_in
+        self.reads_dropped += reads_dropped
+        self.time += elapsed
+
+class UMITemplateFilter(ReadFilter):
+    """
+    Discards reads whose UMI does not match the UMI template
+    (a regular expression that is compiled once).
+    """
+    name = "umi_template"
+    description = "incorrect UMI"
+
+    def __init__(self, template, mc_start, mc_end):
+        ReadFilter.__init__(self)
+        self.pattern = re.compile(template)
+        self.mc_start = mc_start
+        self.mc_end = mc_end
+
+    def apply(self, batch, active):
+        match = self.pattern.match
+        mc_start, mc_end = self.mc_start, self.mc_end
+        return np.fromiter((match(sequence[mc_start:mc_end]) is None for sequence in batch.sequences_fw),
+                           dtype=np.bool, count=batch.size)
+
+class UMIQualityFilter(ReadFilter):
+    """
+    Discards reads with too many low quality bases in the UMI
+    """
+    name = "umi_quality"
+    description = "low quality UMI"
+
+    def __init__(self, mc_start, mc_end, min_qual, phred, umi_quality_bases):
+        ReadFilter.__init__(self)
+        self.mc_start = mc_start
+        self.mc_end = mc_end
+        self.min_qual = min_qual
+        self.phred = phred
+        self.umi_quality_bases = umi_quality_bases
+
+    def apply(self, batch, active):
+        return umi_low_quality_bases_batch(batch.qualities_fw_array, self.mc_start, self.mc_end,
+                                           self.min_qual, self.phred) > self.umi_quality_bases
+
+class ATContentFilter(ReadFilter):
+    """
+    Discards reverse reads with a high content of A and T bases
+    """
+    name = "at_content"
+    description = "high AT content"
+
+    def __init__(self, filter_AT_content):
+        ReadFilter.__init__(self)
+        self.filter_AT_content = filter_AT_content
+
+    def apply(self, batch, active):
+        return (at_count_batch(batch.sequences_rv_array) / batch.lengths_rv) * 100 >= self.filter_AT_content
+
+class AdaptorFilter(ReadFilter):
+    """
+    Removes the adaptors and everything after them from the reverse
+    reads and discards the reads that become too short.
+    All the adaptors are searched in one scan of the read.
+    """
+    name = "adaptors"
+    description = "presence of artifacts"
+
+    def __init__(self, adaptors, min_length, error_rate=0.0):
+        ReadFilter.__init__(self)
+        self.finder = AdaptorFinder(adaptors, error_rate)
+        self.min_length = min_length
+
+    def apply(self, batch, active):
+        # The adaptors and everything after them are removed so only the length changes
+        # (without adaptors it only discards the reads that are too short)
+        if len(self.finder.adaptors) == 0:
+            pass
+        elif self.finder.exact:
+            find = self.finder.find
+            sequences_rv, qualities_rv = batch.sequences_rv, batch.qualities_rv
+            for i in np.flatnonzero(active):
+                if len(sequences_rv[i]) == len(qualities_rv[i]):
+                    pos = find(sequences_rv[i])
+                    if pos != -1:
+                        batch.trimmed_lengths[i] = pos
+        else:
+            positions = self.finder.findBatch(batch.sequences_rv_array, batch.trimmed_lengths)
+            batch.trimmed_lengths = np.where(active, positions, batch.trimmed_lengths)
+        return batch.trimmed_lengths < self.min_length
+
+class QualityTrimmingFilter(ReadFilter):
+    """
+    Performs a BWA quality trimming of the reverse reads and discards
+    the reads that are shorter than the minimum length after trimming
+    """
+    name = "quality_trimming"
+    description = "short read after quality trimming"
+
+    def __init__(self, min_qual, min_length, phred):
+        ReadFilter.__init__(self)
+        self.min_qual = min_qual
+        self.min_length = min_length
+        self.phred = phred
+
+    def apply(self, batch, active):
+        cut_index = quality_trim_index_batch(batch.sequences_rv_array, batch.qualities_rv_array,
+                                             batch.trimmed_lengths, self.min_qual, self.phred)
+        batch.trimmed_lengths = cut_index
+        return cut_index < self.min_length
+
+class ContaminantFilter(ReadFilter):
+    """
+    Discards reverse reads (after trimming) that share a high fraction
+    of their k-mers with the contaminant sequences (see KmerScreen)
+    """
+    name = "contaminant"
+    description = "contaminant sequence"
+
+    def __init__(self, screen, kmer_fraction):
+        ReadFilter.__init__(self)
+        self.screen = screen
+        self.kmer_fraction = kmer_fraction
+
+    def apply(self, batch, active):
+        rows = np.flatnonzero(active)
+        hits, total = self.screen.hits(batch.sequences_rv_array[rows], batch.trimmed_lengths[rows])
+        contaminated = np.zeros(batch.size, dtype=np.bool)
+        contaminated[rows] = (total > 0) & (hits >= self.kmer_fraction * total)
+        return contaminated
+
+class FilterPlan(object):
+    """
+    An ordered list of filters that are applied to batches of read pairs.
+    The plan can be run in worker processes, the counters of the filters
+    are aggregated with update() in the main process.
+    """
+    def __init__(self, filters):
+        self.filters = filters
+
+    def run(self, batch):
+        """
+        Runs all the filters on the batch in order
+        :return: a list of (reads in, reads dropped, time) for every filter
+        """
+        stats = []
+        for index, read_filter in enumerate(self.filters):
+            stats.append(read_filter.run(batch))
+            batch.dropped_by[batch.discard & (batch.dropped_by == -1)] = index
+        return stats
+
+    def update(self, stats):
+        for read_filter, filter_stats in zip(self.filters, stats):
+            read_filter.update(*filter_stats)
+
+    def dropped(self, name):
+        """
+        Returns the number of reads dropped by the filter with the given name
+        """
+        for read_filter in self.filters:
+            if read_filter.name == name:
+                return read_filter.reads_dropped
+        return 0
+
+    def stats(self):
+        """
+        Returns the counters of the filters as a list of dictionaries
+        """
+        return [{"filter" : read_filter.name,
+                 "reads_in" : read_filter.reads_in,
+                 "reads_dropped" : read_filter.reads_dropped,
+                 "time" : round(read_filter.time, 3)} for read_filter in self.filters]
+
+def createFilterPlan(umi_filter=False,
+                     umi_filter_template="WSNNWSNNV",
+                     iscorrect_mc=False,
+                     mc_start=18,
+                     mc_end=27,
+                     umi_quality_bases=3,
+                     filter_AT_content=90,
+                     adaptors=[],
+                     min_qual=20,
+                     min_length=28,
+                     phred=33,
+                     adaptor_error_rate=0.0,
+                     contaminant_fasta=None,
+                     contaminant_kmer_size=25,
+                     contaminant_kmer_fraction=0.5):
+    """
+    Creates the plan of filters to apply to the read pairs
+    from the given parameters. The filters are applied in this order:
+    UMI template, UMI quality, AT content, adaptors, quality trimming
+    and contaminant sequences.
+    :param umi_filter: performs a UMI quality filter when True
+    :param umi_filter_template: the template (reg-exp) to use for the UMI filter
+    :param iscorrect_mc: True if the forward reads contain valid UMIs
+    :param mc_start: the start position of the UMIs
+    :param mc_end: the end position of the UMIs
+    :param umi_quality_bases: the number of low quality bases allowed in an UMI
+    :param filter_AT_content: the max allowed percentage of A and T bases in a read
+    :param adaptors: a list of adaptors to remove from the reverse reads
+    :param min_qual: the min quality value to use to trim quality
+    :param min_length: the min valid length for a read after trimming
+    :param phred: the format of the quality string (33 or 64)
+    :param adaptor_error_rate: the max allowed rate of mismatches in the adaptors
+    :param contaminant_fasta: a fasta file with contaminant sequences (optional)
+    :param contaminant_kmer_size: the size of the k-mers used to screen the contaminants
+    :param contaminant_kmer_fraction: the min fraction of the k-mers of a read found 
+    in the contaminant sequences to discard the read
+    :return: a FilterPlan object
+    """
+    filters = []
+    if iscorrect_mc and umi_filter:
+        filters.append(UMITemplateFilter(umi_filter_template, mc_start, mc_end))
+    if iscorrect_mc:
+        filters.append(UMIQualityFilter(mc_start, mc_end, min_qual, phred, umi_quality_bases))
+    filters.append(ATContentFilter(filter_AT_content))
+    filters.append(AdaptorFilter(adaptors, min_length, adaptor_error_rate))
+    filters.append(QualityTrimmingFilter(min_qual, min_length, phred))
+    if contaminant_fasta is not None:
+        filters.append(ContaminantFilter(KmerScreen.fromFasta(contaminant_fasta, contaminant_kmer_size),
+                                         contaminant_kmer_fraction))
+    return FilterPlan(filters)
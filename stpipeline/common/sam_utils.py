@@ -4,10 +4,22 @@ This module contains some functions and utilities for ST SAM/BAM files
 
 from stpipeline.common.utils import fileOk
 from stpipeline.common.stats import qa_stats
+from stpipeline.common.discards import writeDiscards
+from stpipeline.common.tag_store import ReadTagStore, OrdinalTagJoin, PartitionedReadTags, \
+RECORD_DTYPE, lookupTags, partitionsOf
+from stpipeline.common.fastq_utils import parseTagsFromName, DUPLICATE_DTYPE, READ_TAGS_SEPARATOR
+from itertools import izip, islice
 import os
 import logging 
+import multiprocessing
+import numpy as np
 import pysam
 
+# Number of alignments per chunk when looking up the tags of the reads
+MAPPED_CHUNK_SIZE = 20000
+# Size of the genomic regions filtered in parallel
+REGION_SIZE = 10000000
+
 def sortSamFile(input_sam, outputFolder=None):
     """
     It simply sorts by position a sam/bam file containing mapped reads 
@@ -38,64 +50,165 @@ def sortSamFile(input_sam, outputFolder=None):
         
     return output_sam
 
-def filterMappedReads(mapped_reads,
-                      hash_reads,
+def sortByCoordinate(input_sam, output_sam, threads=1):
+    """
+    Sorts by position a SAM/BAM file containing mapped reads
+    :param input_sam: a SAM/BAM file with mapped reads
+    :param output_sam: the path of the sorted SAM/BAM file
+    :param threads: the number of threads to use
+    :type input_sam: str
+    :type output_sam: str
+    :type threads: int
+    :raises: RuntimeError
+    """
+    logger = logging.getLogger("STPipeline")
+    
+    if not os.path.isfile(input_sam):
+        error = "Error, input file not present {}\n".format(input_sam)
+        logger.error(error)
+        raise RuntimeError(error)
+    
+    sam_type = os.path.splitext(output_sam)[1].lower()[1:]
+    pysam.sort("-o", output_sam, "-O", sam_type, "-@", str(max(threads - 1, 0)),
+               "-T", output_sam, input_sam)
+    
+    if not fileOk(output_sam):
+        error = "Error sorting the SAM/BAM file.\n" \
+        "Output file is not present\n {}".format(output_sam)
+        logger.error(error)
+        raise RuntimeError(error)
+
+def expandMappedReads(mapped_reads,
+                      index_file,
                       file_output,
-                      file_output_discarded=None,
-                      min_length=28):
-    """ 
-    Iterate a SAM/BAM file containing mapped reads 
-    and discards the reads that are secondary or too short.
-    It also discards reads that do not contain a valid barcode.
-    It will add the barcode, coordinates and UMI as extra tags
-    to the output SAM/BAM file. The UMI will be added only if it is present.
-    It assumes all the reads are mapped (do not contain un-aligned reads).
+                      low_memory=False):
+    """
+    Expands the alignments of the unique sequences written by
+    writeUniqueSequences() back to all the reads with the same sequence.
+    Every alignment record is written once for its own read and once
+    for every read in the index file that had the same sequence
+    (the records are identical except for the read id).
+    The index is sorted by the id of the read that was mapped and the
+    reads with the same sequence are looked up in chunks of alignments.
     :param mapped_reads: path to a SAM/BAM file containing the alignments
-    :param hash_reads: a hash table of read_names to (x,y,umi) tags
-    :param min_length: the min number of mapped bases we enforce in an alignment
+    :param index_file: path to the binary index file (records of DUPLICATE_DTYPE
+    with the id of the read that was mapped and the id of the read with the same sequence)
     :param file_output: the path where to put the records
-    :param file_output_discarded: the path where to put discarded files
+    :param low_memory: True to sort the index in place in a memory-mapped file
     :type mapped_reads: str
-    :type hash_reads: dict
-    :type min_length: integer
+    :type index_file: str
     :type file_output: str
-    :type file_output_discarded: str
+    :type low_memory: boolean
+    :return: a tuple with the number of records before and after expanding them
     :raises: RuntimeError
     """
     logger = logging.getLogger("STPipeline")
     
-    if not os.path.isfile(mapped_reads):
-        error = "Error, input file not present {}\n".format(mapped_reads)
+    if not os.path.isfile(mapped_reads) or not os.path.isfile(index_file):
+        error = "Error, input file/s not present {}\n{}\n".format(mapped_reads, index_file)
         logger.error(error)
         raise RuntimeError(error)
     
-    # Create output files handlers
-    flag_read = "rb"
-    flag_write = "wb"
-    infile = pysam.AlignmentFile(mapped_reads, flag_read)
-    outfile = pysam.AlignmentFile(file_output, flag_write, template=infile)
-    if file_output_discarded is not None:
-        outfile_discarded = pysam.AlignmentFile(file_output_discarded, 
-                                                flag_write, template=infile)
+    if os.path.getsize(index_file) == 0:
+        index = np.zeros(0, dtype=DUPLICATE_DTYPE)
+    elif low_memory:
+        index = np.memmap(index_file, dtype=DUPLICATE_DTYPE, mode="r+")
+    else:
+        index = np.fromfile(index_file, dtype=DUPLICATE_DTYPE)
+    index.sort(order=["first", "ordinal"])
+    firsts = index["first"]
+    ordinals = index["ordinal"]
+    
+    present = 0
+    written = 0
+    infile = pysam.AlignmentFile(mapped_reads, "rb")
+    outfile = pysam.AlignmentFile(file_output, "wb", template=infile)
+    records = infile.fetch(until_eof=True)
+    for chunk in iter(lambda: list(islice(records, MAPPED_CHUNK_SIZE)), []):
+        names = [record.query_name.partition(READ_TAGS_SEPARATOR) for record in chunk]
+        keys = np.array([int(read_id) for read_id, _, _ in names], dtype=np.uint64)
+        starts = np.searchsorted(firsts, keys, side="left").tolist()
+        ends = np.searchsorted(firsts, keys, side="right").tolist()
+        for sam_record, (_, separator, tags), start, end in izip(chunk, names, starts, ends):
+            present += 1
+            outfile.write(sam_record)
+            written += 1
+            # The record is written with the id of every other read (and its own tags)
+            for ordinal in ordinals[start:end].tolist():
+                sam_record.query_name = "{}{}{}".format(ordinal, separator, tags)
+                outfile.write(sam_record)
+                written += 1
+    infile.close()
+    outfile.close()
+    del firsts, ordinals, index
+    
+    if not fileOk(file_output):
+        error = "Error expanding mapped reads.\n" \
+        "Output file is not present\n {}".format(file_output)
+        logger.error(error)
+        raise RuntimeError(error)
+    
+    logger.info("Expanding mapped reads, records mapped: {}, " \
+                "records after expanding: {}".format(present, written))
+    return present, written
+
+def _iterTags(records, hash_reads, integer_ids):
+    """
+    Generator of (alignment, tags) tuples that looks up
+    the tags of the alignments in chunks (see lookupTags()).
+    When there is no hash the tags are parsed from the read names
+    (see embedTagsInName()) and the names are restored.
+    """
+    if hash_reads is None:
+        for record in records:
+            record.query_name, tags = parseTagsFromName(record.query_name)
+            yield record, tags
+        return
+    for chunk in iter(lambda: list(islice(records, MAPPED_CHUNK_SIZE)), []):
+        names = [record.query_name for record in chunk]
+        # The probability of a collision is very very low
+        keys = [int(name) for name in names] if integer_ids else [hash(name) for name in names]
+        for record, tags in izip(chunk, lookupTags(hash_reads, keys)):
+            yield record, tags
+
+def _filterRecords(tagged_records, outfile, outfile_discarded, min_length, keep_discards):
+    """
+    Adds the tags to the alignments and discards the alignments
+    without tags, secondary or too short (see filterMappedReads())
+    :param tagged_records: an iterator of (alignment, tags) tuples (see _iterTags())
+    :param outfile: the SAM/BAM file where to write the kept alignments
+    :param outfile_discarded: the SAM/BAM file where to write the discarded alignments (optional)
+    :param min_length: the min number of mapped bases we enforce in an alignment
+    :param keep_discards: True to return the ids of the discarded reads
+    :return: a dictionary with the counters of the reads (present, dropped_secondary,
+    dropped_short and dropped_barcode) and the lists of ids of the discarded
+    reads (discarded_barcode and discarded_short)
+    """
     # Create some counters and loop the records
     dropped_secondary = 0
     dropped_short = 0
     dropped_barcode = 0
     present = 0
-    for sam_record in infile.fetch(until_eof=True):
-        present += 1
+    discarded_barcode = []
+    discarded_short = []
+    for sam_record, tags in tagged_records:
         discard_read = False
         
         # Add the barcode and coordinates info if present otherwise discard
-        try:
-            # The probability of a collision is very very low
-            key = hash(sam_record.query_name)
-            for tag in hash_reads[key]:
-                tag_tokens = tag.split(":")
-                sam_record.set_tag(tag_tokens[0], tag_tokens[2], tag_tokens[1])
-        except KeyError:
+        # Collapsed duplicates (B4 tag) count as many reads as their multiplicity
+        # (reads without barcode count once as their multiplicity is not known)
+        multiplicity = 1
+        if tags is None:
+            present += 1
             dropped_barcode += 1
+            if keep_discards and not sam_record.is_secondary:
+                discarded_barcode.append(int(sam_record.query_name))
             continue
+        for tag, value, value_type in tags:
+            if value_type == "i":
+                multiplicity = value
+            sam_record.set_tag(tag, value, value_type)
+        present += multiplicity
             
         # Get how many bases were mapped
         mapped_bases = 0
@@ -109,23 +222,296 @@ def filterMappedReads(mapped_reads,
             
         # Discard if secondary alignment or only few bases mapped  
         if sam_record.is_secondary:
-            dropped_secondary += 1
+            dropped_secondary += multiplicity
             discard_read = True
         elif mapped_bases != 0 and mapped_bases < min_length:
-            dropped_short += 1
+            dropped_short += multiplicity
             discard_read = True
+            if keep_discards:
+                discarded_short.append(int(sam_record.query_name))
 
         if discard_read:
-            if file_output_discarded is not None:
+            if outfile_discarded is not None:
                 outfile_discarded.write(sam_record)
         else:
             outfile.write(sam_record)
+    return {"present" : present,
+            "dropped_secondary" : dropped_secondary,
+            "dropped_short" : dropped_short,
+            "dropped_barcode" : dropped_barcode,
+            "discarded_barcode" : discarded_barcode,
+            "discarded_short" : discarded_short}
+
+def _filterPartition(task):
+    """
+    Joins and filters the alignments of a partition in a worker process
+    (see _filterPartitions())
+    :param task: a tuple with the BAM file of the alignments of the partition,
+    the file of records of the tags of the partition, the length of the UMIs, 
+    the UMIs with other bases than ACGT, the output files (kept and discarded),
+    the min length, integer_ids and keep_discards (see _filterRecords())
+    :return: the counters and the discarded reads of the partition
+    """
+    alignments, tags, umi_length, other_umis, output, output_discarded, \
+    min_length, integer_ids, keep_discards = task
+    hash_reads = ReadTagStore.fromRecords(np.fromfile(tags, dtype=RECORD_DTYPE), umi_length, other_umis)
+    infile = pysam.AlignmentFile(alignments, "rb")
+    outfile = pysam.AlignmentFile(output, "wb", template=infile)
+    outfile_discarded = None
+    if output_discarded is not None:
+        outfile_discarded = pysam.AlignmentFile(output_discarded, "wb", template=infile)
+    stats = _filterRecords(_iterTags(infile.fetch(until_eof=True), hash_reads, integer_ids),
+                           outfile, outfile_discarded, min_length, keep_discards)
+    infile.close()
+    outfile.close()
+    if outfile_discarded is not None:
+        outfile_discarded.close()
+    return stats
+
+def _filterPartitions(mapped_reads, hash_reads, file_output, file_output_discarded,
+                      min_length, integer_ids, keep_discards, threads):
+    """
+    Joins the alignments and the tags of a PartitionedReadTags (grace hash join).
+    The alignments are written to one BAM file per partition (by the same hash
+    of the read names as the tags) and then every partition is joined and
+    filtered in a pool of processes so only the tags of one partition are
+    in memory in every process. The outputs of the partitions are merged
+    with samtools merge (the alignments keep the order of the input file in every partition
+    so they are merged by coordinate when the input file is sorted).
+    :return: the counters and the discarded reads (see _filterRecords())
+    """
+    prefix = os.path.join(hash_reads.folder, "alignments_{}")
+    infile = pysam.AlignmentFile(mapped_reads, "rb")
+    partitions = [prefix.format(i) + ".bam" for i in xrange(hash_reads.partitions)]
+    writers = [pysam.AlignmentFile(partition, "wb", template=infile) for partition in partitions]
+    records = infile.fetch(until_eof=True)
+    for chunk in iter(lambda: list(islice(records, MAPPED_CHUNK_SIZE)), []):
+        names = [record.query_name for record in chunk]
+        keys = [int(name) for name in names] if integer_ids else [hash(name) for name in names]
+        for record, partition in izip(chunk, partitionsOf(keys, hash_reads.partitions).tolist()):
+            writers[partition].write(record)
+    for writer in writers:
+        writer.close()
+    infile.close()
+    
+    outputs = [prefix.format(i) + "_filtered.bam" for i in xrange(hash_reads.partitions)]
+    outputs_discarded = [prefix.format(i) + "_discarded.bam" if file_output_discarded is not None else None
+                         for i in xrange(hash_reads.partitions)]
+    tasks = [(partitions[i], hash_reads.filenames[i], hash_reads.umi_length, hash_reads.other_umis[i],
+              outputs[i], outputs_discarded[i], min_length, integer_ids, keep_discards)
+             for i in xrange(hash_reads.partitions)]
+    try:
+        if threads > 1:
+            pool = multiprocessing.Pool(min(threads, hash_reads.partitions))
+            try:
+                results = pool.map(_filterPartition, tasks)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            results = map(_filterPartition, tasks)
+        # The threads option must be the last one as glibc getopt() keeps a pointer
+        # to the last option without argument after samtools merge returns
+        # and the next samtools command of the process would parse it
+        pysam.merge("-f", "-c", "-p", "-@", str(threads), file_output, *outputs)
+        if file_output_discarded is not None:
+            pysam.merge("-f", "-c", "-p", "-@", str(threads), file_output_discarded, *outputs_discarded)
+    finally:
+        for filename in partitions + outputs + outputs_discarded:
+            if filename is not None and os.path.isfile(filename):
+                os.remove(filename)
     
-    # Close handlers           
+    stats = dict()
+    for key in ["present", "dropped_secondary", "dropped_short", "dropped_barcode"]:
+        stats[key] = sum(result[key] for result in results)
+    for key in ["discarded_barcode", "discarded_short"]:
+        stats[key] = [ordinal for result in results for ordinal in result[key]]
+    return stats
+
+def _initFilterWorker(hash_reads, settings):
+    """
+    Stores the hash of demultiplexed reads and the settings in the
+    process that will run _filterRegion() (the hash is shared by fork)
+    """
+    global _filter_hash_reads, _filter_settings
+    _filter_hash_reads = hash_reads
+    _filter_settings = settings
+
+def _filterRegion(task):
+    """
+    Joins and filters the alignments that start in a genomic region
+    in a worker process (see _filterRegions())
+    :param task: a tuple with the index of the region, the reference, the start
+    and the end of the region
+    :return: the counters and the discarded reads of the region
+    """
+    index, reference, start, end = task
+    settings = _filter_settings
+    infile = pysam.AlignmentFile(settings["mapped_reads"], "rb")
+    outfile = pysam.AlignmentFile(settings["outputs"][index], "wb", template=infile)
+    outfile_discarded = None
+    if settings["outputs_discarded"][index] is not None:
+        outfile_discarded = pysam.AlignmentFile(settings["outputs_discarded"][index], "wb", template=infile)
+    # The alignments that start before the region belong to the previous region
+    records = (record for record in infile.fetch(reference, start, end) if record.reference_start >= start)
+    stats = _filterRecords(_iterTags(records, _filter_hash_reads, settings["integer_ids"]),
+                           outfile, outfile_discarded, settings["min_length"], settings["keep_discards"])
     infile.close()
     outfile.close()
-    if file_output_discarded is not None:
+    if outfile_discarded is not None:
         outfile_discarded.close()
+    return stats
+
+def _sortedRegions(mapped_reads):
+    """
+    Returns the genomic regions (reference, start, end) with alignments of a BAM
+    file sorted by coordinate (it is indexed if needed) in the order of the file 
+    or None if the file is not sorted or it contains alignments without coordinates
+    """
+    infile = pysam.AlignmentFile(mapped_reads, "rb")
+    try:
+        if infile.header.to_dict().get("HD", {}).get("SO") != "coordinate":
+            return None
+        if not infile.has_index():
+            infile.close()
+            pysam.index(mapped_reads)
+            infile = pysam.AlignmentFile(mapped_reads, "rb")
+        if infile.nocoordinate > 0:
+            return None
+        regions = []
+        for stats in infile.get_index_statistics():
+            if stats.total == 0:
+                continue
+            length = infile.get_reference_length(stats.contig)
+            for start in xrange(0, length, REGION_SIZE):
+                regions.append((stats.contig, start, min(start + REGION_SIZE, length)))
+        return regions
+    finally:
+        infile.close()
+
+def _filterRegions(mapped_reads, hash_reads, regions, file_output, file_output_discarded,
+                   min_length, integer_ids, keep_discards, threads):
+    """
+    Joins and filters the alignments of a BAM file sorted by coordinate
+    by genomic regions in a pool of processes. Every region is written to
+    a partial BAM file and the partial files are concatenated in the order
+    of the regions (the output is the same as the sequential filter).
+    :return: the counters and the discarded reads (see _filterRecords())
+    """
+    outputs = ["{}.region{}.bam".format(file_output, i) for i in xrange(len(regions))]
+    outputs_discarded = ["{}.region{}.bam".format(file_output_discarded, i) 
+                         if file_output_discarded is not None else None for i in xrange(len(regions))]
+    settings = {"mapped_reads" : mapped_reads,
+                "outputs" : outputs,
+                "outputs_discarded" : outputs_discarded,
+                "min_length" : min_length,
+                "integer_ids" : integer_ids,
+                "keep_discards" : keep_discards}
+    tasks = [(i, reference, start, end) for i, (reference, start, end) in enumerate(regions)]
+    try:
+        pool = multiprocessing.Pool(min(threads, len(tasks)), _initFilterWorker, (hash_reads, settings))
+        try:
+            results = pool.map(_filterRegion, tasks, chunksize=1)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        pysam.cat("-o", file_output, *outputs)
+        if file_output_discarded is not None:
+            pysam.cat("-o", file_output_discarded, *outputs_discarded)
+    finally:
+        for filename in outputs + outputs_discarded:
+            if filename is not None and os.path.isfile(filename):
+                os.remove(filename)
+
+    stats = dict()
+    for key in ["present", "dropped_secondary", "dropped_short", "dropped_barcode"]:
+        stats[key] = sum(result[key] for result in results)
+    for key in ["discarded_barcode", "discarded_short"]:
+        stats[key] = [ordinal for result in results for ordinal in result[key]]
+    return stats
+
+def filterMappedReads(mapped_reads,
+                      hash_reads,
+                      file_output,
+                      file_output_discarded=None,
+                      min_length=28,
+                      integer_ids=False,
+                      out_discards=None,
+                      threads=1):
+    """ 
+    Iterate a SAM/BAM file containing mapped reads 
+    and discards the reads that are secondary or too short.
+    It also discards reads that do not contain a valid barcode.
+    It will add the barcode, coordinates and UMI as extra tags
+    to the output SAM/BAM file. The UMI will be added only if it is present.
+    It assumes all the reads are mapped (do not contain un-aligned reads).
+    :param mapped_reads: path to a SAM/BAM file containing the alignments
+    :param hash_reads: a hash table of read_names to (x,y,umi,multiplicity) tags
+    or a ReadTagStore (the tags are looked up in chunks of alignments)
+    or an OrdinalTagJoin (the alignments must be in the order of the reads)
+    or None when the tags are carried in the read names (see embedTagsInName())
+    or a PartitionedReadTags (the partitions are joined in parallel, see _filterPartitions())
+    :param min_length: the min number of mapped bases we enforce in an alignment
+    :param file_output: the path where to put the records
+    :param file_output_discarded: the path where to put discarded files
+    :param integer_ids: True if the reads were renamed to integer ids (used as keys)
+    :param out_discards: when given a binary record of every discarded read (primary
+    alignments only) is appended to this file (the reads must have integer ids)
+    :param threads: the number of processes to use to join the partitions of a PartitionedReadTags
+    or the genomic regions of a BAM file sorted by coordinate (when the hash is a dictionary,
+    a ReadTagStore or None)
+    :type mapped_reads: str
+    :type hash_reads: dict, SqliteDict, ReadTagStore, OrdinalTagJoin or PartitionedReadTags
+    :type min_length: integer
+    :type file_output: str
+    :type file_output_discarded: str
+    :type integer_ids: bool
+    :type out_discards: str
+    :type threads: int
+    :raises: RuntimeError
+    """
+    logger = logging.getLogger("STPipeline")
+    
+    if not os.path.isfile(mapped_reads):
+        error = "Error, input file not present {}\n".format(mapped_reads)
+        logger.error(error)
+        raise RuntimeError(error)
+    
+    # The genomic regions are filtered in parallel when the hash can be shared by the processes
+    regions = None
+    if threads > 1 and (hash_reads is None or isinstance(hash_reads, (dict, ReadTagStore))):
+        regions = _sortedRegions(mapped_reads)
+    if isinstance(hash_reads, PartitionedReadTags):
+        stats = _filterPartitions(mapped_reads, hash_reads, file_output, file_output_discarded,
+                                  min_length, integer_ids, out_discards is not None, threads)
+    elif regions:
+        stats = _filterRegions(mapped_reads, hash_reads, regions, file_output, file_output_discarded,
+                               min_length, integer_ids, out_discards is not None, threads)
+    else:
+        # Create output files handlers
+        flag_read = "rb"
+        flag_write = "wb"
+        infile = pysam.AlignmentFile(mapped_reads, flag_read)
+        outfile = pysam.AlignmentFile(file_output, flag_write, template=infile)
+        outfile_discarded = None
+        if file_output_discarded is not None:
+            outfile_discarded = pysam.AlignmentFile(file_output_discarded, 
+                                                    flag_write, template=infile)
+        records = infile.fetch(until_eof=True)
+        stats = _filterRecords(_iterTags(records, hash_reads, integer_ids), outfile, outfile_discarded,
+                               min_length, out_discards is not None)
+        if isinstance(hash_reads, OrdinalTagJoin):
+            hash_reads.close()
+        # Close handlers           
+        infile.close()
+        outfile.close()
+        if file_output_discarded is not None:
+            outfile_discarded.close()
+    if out_discards is not None:
+        writeDiscards(out_discards, stats["discarded_barcode"], "filter_mapped", "barcode")
+        writeDiscards(out_discards, stats["discarded_short"], "filter_mapped", "too_short")
 
     if not fileOk(file_output):
         error = "Error filtering mapped reads.\n" \
@@ -133,6 +519,10 @@ def filterMappedReads(mapped_reads,
         logger.error(error)
         raise RuntimeError(error)
             
+    present = stats["present"]
+    dropped_secondary = stats["dropped_secondary"]
+    dropped_short = stats["dropped_short"]
+    dropped_barcode = stats["dropped_barcode"]
     logger.info("Finish filtering mapped reads, stats:" \
                 "\nPresent: {0}" \
                 "\nDropped - secondary alignment: {1}" \
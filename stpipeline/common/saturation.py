@@ -28,6 +28,7 @@ def computeSaturation(nreads,
     compute the saturation points information that is then added
     to the log file.
     :param nreads: the number of reads present in the annotated_reads file
+    (collapsed duplicates count as many times as their multiplicity)
     :param annotated_reads: path to a SAM/BAM file with the annotated reads
     :param molecular_barcodes: True is the reads contain UMIs
     :param mc_allowed_mismatches: the number of miss matches allowed to remove
@@ -87,16 +88,25 @@ def computeSaturation(nreads,
         subsampling[spoint] = subbed
                  
     # Write subsamples (SAM/BAM records) to each saturation point file
+    # Collapsed duplicates (B4 tag) span as many indexes as their multiplicity
+    # and they are written with the number of their reads that were sampled
     index = 0
     sub_indexes = defaultdict(int)
     for read in annotated_sam.fetch(until_eof=True):
+        multiplicity = read.get_tag("B4") if read.has_tag("B4") else 1
         for spoint in saturation_points:
             sub_index = sub_indexes[spoint]
-            if sub_index < len(subsampling[spoint]) \
-            and subsampling[spoint][sub_index] == index:
+            sampled = 0
+            while sub_index < len(subsampling[spoint]) \
+            and subsampling[spoint][sub_index] < index + multiplicity:
+                sampled += 1
+                sub_index += 1
+            if sampled > 0:
+                if multiplicity > 1:
+                    read.set_tag("B4", sampled, "i")
                 files[spoint].write(read)
-                sub_indexes[spoint] += 1
-        index += 1  
+                sub_indexes[spoint] = sub_index
+        index += multiplicity
                  
     # Close the files
     annotated_sam.close()
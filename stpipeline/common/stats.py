@@ -29,6 +29,9 @@ class Stats():
         self.annotation_tool = "HTSeq 0.6.1"
         self.demultiplex_tool = "TAGGD 0.2.2"
         self.input_parameters = []
+        self.input_filters = []
+        self.subsample_fraction = 1.0
+        self.input_lanes = []
         self.max_genes_feature = 0
         self.min_genes_feature = 0
         self.max_reads_feature = 0
@@ -54,6 +57,9 @@ class Stats():
         "\nannotation_tool: " + str(self.annotation_tool) + \
         "\ndemultiplex_tool: " + str(self.demultiplex_tool) + \
         "\ninput_parameters: " + ''.join([str(x) for x in self.input_parameters]) + \
+        "\ninput_filters: " + str(self.input_filters) + \
+        "\nsubsample_fraction: " + str(self.subsample_fraction) + \
+        "\ninput_lanes: " + str(self.input_lanes) + \
         "\nmax_genes_feature: " + str(self.max_genes_feature) + \
         "\nmin_genes_feature: " + str(self.min_genes_feature) + \
         "\nmax_reads_feature: " + str(self.max_reads_feature) + \
@@ -79,6 +85,9 @@ class Stats():
                          "annotation_tool" : self.annotation_tool,
                          "demultiplex_tool" : self.demultiplex_tool,
                          "input_parameters" : ''.join([str(x) for x in self.input_parameters]),
+                         "input_filters" : self.input_filters,
+                         "subsample_fraction" : self.subsample_fraction,
+                         "input_lanes" : self.input_lanes,
                          "max_genes_feature" : self.max_genes_feature,
                          "min_genes_feature" : self.min_genes_feature,
                          "max_reads_feature" : self.max_reads_feature,
@@ -0,0 +1,524 @@
+"""
+This module contains a compact store of the tags of the
+demultiplexed reads (x, y, UMI and multiplicity) that is used
+instead of a dictionary of read_name -> list of tags.
+The tags are kept in NumPy arrays sorted by the key of the
+read (64 bits) and they are looked up in batches.
+The store can also be kept on disk as an open-addressing hash table
+of fixed-width records in a memory-mapped file (low memory mode) or
+spilled to disk in partitions that are joined one at a time.
+It also contains a merge-join of the tags of the demultiplexed
+reads and the alignments when both are in the order of the reads.
+"""
+
+from array import array
+import logging
+import tempfile
+import os
+import numpy as np
+
+# Keys are stored as unsigned 64 bits integers
+_KEY_MASK = (1 << 64) - 1
+# Bases of the UMIs are encoded in 2 bits (the max UMI length is 32)
+MAX_UMI_LENGTH = 32
+_UMI_BASES = np.array([ord(base) for base in "ACGT"], dtype=np.uint8)
+_UMI_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _base in enumerate("ACGT"):
+    _UMI_CODES[ord(_base)] = _code
+
+# Fixed-width record of a read in the on-disk table (empty slots have multiplicity 0)
+RECORD_DTYPE = np.dtype([("key", "<u8"), ("umi", "<u8"), ("multiplicity", "<u4"),
+                         ("x", "<i2"), ("y", "<i2")])
+# The coordinates of the spots are stored as 16 bits integers
+MIN_COORDINATE = -(1 << 15)
+MAX_COORDINATE = (1 << 15) - 1
+# Number of reads buffered in memory before they are written to disk
+MAPPED_BUFFER_SIZE = 1000000
+# Multiplier of the Fibonacci hashing of the keys to the slots of the table
+_FIBONACCI_MULTIPLIER = np.uint64(11400714819323198485)
+
+def _toRecords(keys, x, y, multiplicities, umis):
+    """
+    Returns an array of fixed-width records (see RECORD_DTYPE)
+    """
+    records = np.empty(len(keys), dtype=RECORD_DTYPE)
+    records["key"] = keys
+    records["umi"] = umis
+    records["multiplicity"] = multiplicities
+    records["x"] = x
+    records["y"] = y
+    return records
+
+def parseCoordinate(value):
+    """
+    Converts a coordinate of a spot to an integer that can be stored
+    :param value: the coordinate (a string or an integer)
+    :return: the coordinate as an integer
+    :raises: ValueError when it is not a 16 bits integer
+    """
+    coordinate = int(value)
+    if coordinate < MIN_COORDINATE or coordinate > MAX_COORDINATE:
+        raise ValueError("The coordinate {} is not a 16 bits integer".format(value))
+    return coordinate
+
+class ReadTagStore(object):
+    """
+    A store of the tags of the demultiplexed reads. Reads are added with
+    add() and the store is sorted with freeze() before it is used.
+    Every read takes 24 bytes: the key (the integer id of the read or the
+    hash of its name), the x and y coordinates (int16), the UMI packed
+    in 2 bits per base and the multiplicity of collapsed duplicates.
+    UMIs with other bases than ACGT are kept apart.
+    It can be used like the dictionary of read_name -> list of tags (read only).
+    """
+    def __init__(self, umi_length=0):
+        if umi_length < 0 or umi_length > MAX_UMI_LENGTH:
+            raise ValueError("The length of the UMIs must be between 0 and {}".format(MAX_UMI_LENGTH))
+        self.umi_length = umi_length
+        self._keys = array("L")
+        self._x = array("h")
+        self._y = array("h")
+        self._umis = bytearray()
+        self._multiplicities = array("I")
+        self.keys = None
+
+    def add(self, key, x, y, umi=None, multiplicity=1):
+        """
+        Adds the tags of a read
+        :param key: the integer id of the read or the hash of its name
+        :param x: the x coordinate of the spot (integer)
+        :param y: the y coordinate of the spot (integer)
+        :param umi: the UMI of the read (if the store has UMIs)
+        :param multiplicity: the number of collapsed reads
+        """
+        self._keys.append(key & _KEY_MASK)
+        self._x.append(x)
+        self._y.append(y)
+        if self.umi_length > 0:
+            # Short UMIs are padded with zeroes
+            self._umis.extend(umi[:self.umi_length].ljust(self.umi_length, "\0"))
+        self._multiplicities.append(multiplicity)
+
+    def _packRecords(self):
+        """
+        Returns the reads added so far (in the order they were added) as
+        arrays of keys, x, y, multiplicities and packed UMIs and a dictionary
+        with the index and the UMI of the reads with other bases than ACGT
+        """
+        keys = np.frombuffer(self._keys, dtype="u{}".format(self._keys.itemsize)).astype(np.uint64)
+        x = np.frombuffer(self._x, dtype=np.int16)
+        y = np.frombuffer(self._y, dtype=np.int16)
+        multiplicities = np.frombuffer(self._multiplicities, dtype=np.uint32)
+        umis = np.zeros(len(keys), dtype=np.uint64)
+        other_umis = dict()
+        if self.umi_length > 0:
+            bases = np.frombuffer(bytes(self._umis), dtype=np.uint8).reshape(-1, self.umi_length)
+            codes = _UMI_CODES[bases]
+            for i in xrange(self.umi_length):
+                umis = (umis << np.uint64(2)) | (codes[:, i] & 3).astype(np.uint64)
+            for i in np.flatnonzero((codes > 3).any(axis=1)).tolist():
+                other_umis[i] = bases[i].tostring().rstrip("\0")
+        return keys, x, y, multiplicities, umis, other_umis
+
+    def freeze(self):
+        """
+        Sorts the reads by key and packs the UMIs
+        """
+        keys, x, y, multiplicities, umis, other_umis = self._packRecords()
+        order = np.argsort(keys, kind="mergesort")
+        self.keys = keys[order]
+        self.x = x[order]
+        self.y = y[order]
+        self.multiplicities = multiplicities[order]
+        self.umis = umis[order]
+        position = np.empty(len(order), dtype=np.int64)
+        position[order] = np.arange(len(order))
+        self.other_umis = dict((int(position[i]), umi) for i, umi in other_umis.iteritems())
+        self._keys = self._x = self._y = self._umis = self._multiplicities = None
+        return self
+
+    @classmethod
+    def fromRecords(cls, records, umi_length=0, other_umis=None):
+        """
+        Creates a store (frozen) from an array of records
+        :param records: an array of records (see RECORD_DTYPE)
+        :param umi_length: the length of the UMIs
+        :param other_umis: a dictionary of key -> UMI of the reads
+        with other bases than ACGT (optional)
+        """
+        store = cls(umi_length)
+        records = records[np.argsort(records["key"], kind="mergesort")]
+        store.keys = records["key"]
+        store.x = records["x"]
+        store.y = records["y"]
+        store.multiplicities = records["multiplicity"]
+        store.umis = records["umi"]
+        store.other_umis = dict()
+        if other_umis:
+            keys = np.array(sorted(other_umis), dtype=np.uint64)
+            for position, key in zip(store.lookup(keys).tolist(), keys.tolist()):
+                store.other_umis[position] = other_umis[key]
+        store._keys = store._x = store._y = store._umis = store._multiplicities = None
+        return store
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, keys):
+        """
+        Looks up many reads at once
+        :param keys: a list or array of keys of reads
+        :return: an array with the position of every read in the store (-1 if not present)
+        """
+        keys = np.array([key & _KEY_MASK for key in keys], dtype=np.uint64) \
+        if not isinstance(keys, np.ndarray) else keys.astype(np.uint64)
+        if len(self.keys) == 0:
+            return np.full(len(keys), -1, dtype=np.int64)
+        position = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[position] == keys, position, -1)
+
+    def umisBatch(self, positions):
+        """
+        Returns the UMIs of the reads in the given positions
+        """
+        codes = self.umis[positions]
+        bases = np.empty((len(positions), self.umi_length), dtype=np.uint8)
+        for i in xrange(self.umi_length - 1, -1, -1):
+            bases[:, i] = _UMI_BASES[(codes & np.uint64(3)).astype(np.int64)]
+            codes = codes >> np.uint64(2)
+        umis = bases.view("S{}".format(self.umi_length)).ravel().tolist()
+        return [self.other_umis.get(position, umi) for position, umi in zip(positions, umis)]
+
+    def tagsBatch(self, positions):
+        """
+        Returns the tags of the reads in the given positions as lists of
+        (tag, value, type) tuples (None for the reads that are not present)
+        :param positions: an array of positions (see lookup())
+        """
+        positions = np.asarray(positions)
+        found = np.flatnonzero(positions >= 0)
+        present = positions[found].tolist()
+        xs = self.x[present].tolist()
+        ys = self.y[present].tolist()
+        multiplicities = self.multiplicities[present].tolist()
+        umis = self.umisBatch(present) if self.umi_length > 0 else None
+        tags = [None] * len(positions)
+        for i, index in enumerate(found.tolist()):
+            read_tags = [("B1", str(xs[i]), "Z"), ("B2", str(ys[i]), "Z")]
+            if umis is not None:
+                read_tags.append(("B3", umis[i], "Z"))
+            if multiplicities[i] > 1:
+                read_tags.append(("B4", multiplicities[i], "i"))
+            tags[index] = read_tags
+        return tags
+
+    def __getitem__(self, key):
+        position = self.lookup([key])
+        if position[0] < 0:
+            raise KeyError(key)
+        return ["{}:{}:{}".format(tag, value_type, value)
+                for tag, value, value_type in self.tagsBatch(position)[0]]
+
+    def __contains__(self, key):
+        return self.lookup([key])[0] >= 0
+
+    def close(self):
+        pass
+
+class MappedReadTagStore(ReadTagStore):
+    """
+    A ReadTagStore kept on disk. The reads are buffered and written
+    sequentially to a file of fixed-width records (see RECORD_DTYPE) and
+    freeze() builds an open-addressing hash table (linear probing, at most
+    half full) in a memory-mapped file so only the pages of the table that
+    are used are kept in memory. The reads are inserted and looked up
+    in vectorized batches. The files are created in the given folder
+    (the temp folder of the pipeline) and removed with close().
+    """
+    def __init__(self, folder, umi_length=0):
+        ReadTagStore.__init__(self, umi_length)
+        fd, self._records_filename = tempfile.mkstemp(dir=folder, suffix=".records")
+        self._records_file = os.fdopen(fd, "wb")
+        self.filename = None
+        self.table = None
+        self.count = 0
+        # The reads with UMIs with other bases than ACGT (by key)
+        self._other_umis = dict()
+
+    def add(self, key, x, y, umi=None, multiplicity=1):
+        ReadTagStore.add(self, key, x, y, umi, multiplicity)
+        if len(self._keys) >= MAPPED_BUFFER_SIZE:
+            self._flush()
+
+    def _flush(self):
+        """
+        Writes the buffered reads to the file of records
+        """
+        keys, x, y, multiplicities, umis, other_umis = self._packRecords()
+        records = _toRecords(keys, x, y, multiplicities, umis)
+        records.tofile(self._records_file)
+        for i, umi in other_umis.iteritems():
+            self._other_umis[int(keys[i])] = umi
+        self.count += len(records)
+        self._keys = array("L")
+        self._x = array("h")
+        self._y = array("h")
+        self._umis = bytearray()
+        self._multiplicities = array("I")
+
+    def _slots(self, keys):
+        """
+        Returns the first slot of the given keys in the table
+        """
+        return ((keys * _FIBONACCI_MULTIPLIER) >> np.uint64(64 - self._bits)).astype(np.int64)
+
+    def freeze(self):
+        """
+        Builds the hash table from the file of records
+        """
+        self._flush()
+        self._records_file.close()
+        self._bits = max(4, int(2 * self.count - 1).bit_length())
+        capacity = 1 << self._bits
+        fd, self.filename = tempfile.mkstemp(dir=os.path.dirname(self._records_filename), suffix=".table")
+        os.close(fd)
+        self.table = np.memmap(self.filename, dtype=RECORD_DTYPE, mode="w+", shape=(capacity,))
+        mask = capacity - 1
+        if self.count > 0:
+            records = np.memmap(self._records_filename, dtype=RECORD_DTYPE, mode="r")
+            for start in xrange(0, self.count, MAPPED_BUFFER_SIZE):
+                chunk = np.array(records[start:start + MAPPED_BUFFER_SIZE])
+                slots = self._slots(chunk["key"])
+                pending = np.arange(len(chunk))
+                while len(pending) > 0:
+                    # The first read of every free slot takes it, the others probe the next slot
+                    free = pending[self.table["multiplicity"][slots[pending]] == 0]
+                    _, first = np.unique(slots[free], return_index=True)
+                    placed = free[first]
+                    self.table[slots[placed]] = chunk[placed]
+                    pending = np.setdiff1d(pending, placed, assume_unique=True)
+                    slots[pending] = (slots[pending] + 1) & mask
+            del records
+        os.remove(self._records_filename)
+        self.table.flush()
+        self.keys = self.table["key"]
+        self.x = self.table["x"]
+        self.y = self.table["y"]
+        self.multiplicities = self.table["multiplicity"]
+        self.umis = self.table["umi"]
+        self.other_umis = dict()
+        if len(self._other_umis) > 0:
+            keys = np.array(sorted(self._other_umis), dtype=np.uint64)
+            for position, key in zip(self.lookup(keys).tolist(), keys.tolist()):
+                self.other_umis[position] = self._other_umis[key]
+        self._other_umis = None
+        self._keys = self._x = self._y = self._umis = self._multiplicities = None
+        return self
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, keys):
+        """
+        Looks up many reads at once
+        :param keys: a list or array of keys of reads
+        :return: an array with the position of every read in the table (-1 if not present)
+        """
+        keys = np.array([key & _KEY_MASK for key in keys], dtype=np.uint64) \
+        if not isinstance(keys, np.ndarray) else keys.astype(np.uint64)
+        mask = len(self.table) - 1
+        positions = np.full(len(keys), -1, dtype=np.int64)
+        slots = self._slots(keys)
+        pending = np.arange(len(keys))
+        while len(pending) > 0:
+            records = self.table[slots[pending]]
+            found = (records["multiplicity"] > 0) & (records["key"] == keys[pending])
+            positions[pending[found]] = slots[pending[found]]
+            # The search of a read ends in its slot or in an empty slot
+            pending = pending[~found & (records["multiplicity"] > 0)]
+            slots[pending] = (slots[pending] + 1) & mask
+        return positions
+
+    def close(self):
+        """
+        Removes the files of the table
+        """
+        if self.table is not None:
+            self.keys = self.x = self.y = self.multiplicities = self.umis = None
+            self.table = None
+        else:
+            self._records_file.close()
+        for filename in [self.filename, self._records_filename]:
+            if filename is not None and os.path.isfile(filename):
+                os.remove(filename)
+
+def partitionsOf(keys, partitions):
+    """
+    Returns the partition of many reads at once (by the prefix of the hash of the keys)
+    :param keys: a list or array of keys of reads
+    :param partitions: the number of partitions
+    :return: an array with the partition of every read
+    """
+    keys = np.array([key & _KEY_MASK for key in keys], dtype=np.uint64) \
+    if not isinstance(keys, np.ndarray) else keys.astype(np.uint64)
+    return (((keys * _FIBONACCI_MULTIPLIER) >> np.uint64(32)) % np.uint64(partitions)).astype(np.int64)
+
+class PartitionedReadTags(object):
+    """
+    The tags of the demultiplexed reads spilled to disk in partitions by the
+    prefix of the hash of the keys of the reads (see partitionsOf()). 
+    Every partition is a file of fixed-width records (see RECORD_DTYPE) that
+    is loaded as a ReadTagStore with load() so the reads can be joined to
+    the alignments of the same partition (a grace hash join).
+    The reads are buffered and written in bulk to a folder created in the given
+    folder (the temp folder of the pipeline) and removed with close().
+    """
+    def __init__(self, partitions, folder, umi_length=0):
+        if partitions < 1:
+            raise ValueError("The number of partitions must be at least 1")
+        self.partitions = partitions
+        self.umi_length = umi_length
+        self.folder = tempfile.mkdtemp(prefix="read_tags_", dir=folder)
+        self.filenames = [os.path.join(self.folder, "partition_{}.records".format(i))
+                          for i in xrange(partitions)]
+        self._files = [open(filename, "wb") for filename in self.filenames]
+        # The reads with UMIs with other bases than ACGT (by partition and key)
+        self.other_umis = [dict() for _ in xrange(partitions)]
+        self.count = 0
+        self._buffer = ReadTagStore(umi_length)
+
+    def add(self, key, x, y, umi=None, multiplicity=1):
+        """
+        Adds the tags of a read (see ReadTagStore.add())
+        """
+        self._buffer.add(key, x, y, umi, multiplicity)
+        if len(self._buffer._keys) >= MAPPED_BUFFER_SIZE:
+            self._flush()
+
+    def _flush(self):
+        """
+        Writes the buffered reads to the files of their partitions
+        """
+        keys, x, y, multiplicities, umis, other_umis = self._buffer._packRecords()
+        records = _toRecords(keys, x, y, multiplicities, umis)
+        partitions = partitionsOf(keys, self.partitions)
+        for i, filehandler in enumerate(self._files):
+            records[partitions == i].tofile(filehandler)
+        for i, umi in other_umis.iteritems():
+            self.other_umis[partitions[i]][int(keys[i])] = umi
+        self.count += len(records)
+        self._buffer = ReadTagStore(self.umi_length)
+
+    def freeze(self):
+        """
+        Writes the remaining reads and closes the files of the partitions
+        """
+        self._flush()
+        for filehandler in self._files:
+            filehandler.close()
+        self._buffer = None
+        return self
+
+    def __len__(self):
+        return self.count
+
+    def load(self, partition):
+        """
+        Loads the reads of a partition
+        :param partition: the index of the partition
+        :return: a ReadTagStore
+        """
+        return ReadTagStore.fromRecords(np.fromfile(self.filenames[partition], dtype=RECORD_DTYPE),
+                                        self.umi_length, self.other_umis[partition])
+
+    def close(self):
+        """
+        Removes the files of the partitions
+        """
+        for filehandler in self._files:
+            filehandler.close()
+        for filename in self.filenames:
+            if os.path.isfile(filename):
+                os.remove(filename)
+        if os.path.isdir(self.folder):
+            os.rmdir(self.folder)
+
+class OrdinalTagJoin(object):
+    """
+    Joins the tags of the demultiplexed reads and the alignments
+    when both are sorted by the integer id (ordinal) of the reads.
+    The tags are given as an iterator of (read id, tags) in increasing
+    order of read id and they are consumed as the alignments are joined
+    (only the current read is kept in memory).
+    The alignments of a read must be consecutive and in increasing order
+    of read id (the unsorted output of STAR that keeps the input order).
+    """
+    def __init__(self, tags):
+        self._tags = iter(tags)
+        self._key = -1
+        self._current = None
+        self._last = -1
+
+    def join(self, keys):
+        """
+        Joins many reads at once
+        :param keys: a list of read ids in increasing order
+        :return: a list with the tags of every read as lists of (tag, value, type)
+        tuples (None for the reads that are not present)
+        :raises: ValueError if the reads are not in increasing order
+        """
+        tags = []
+        for key in keys:
+            if key < self._last:
+                raise ValueError("The reads are not sorted by id ({} after {})".format(key, self._last))
+            self._last = key
+            while self._key < key:
+                previous = self._key
+                try:
+                    self._key, self._current = next(self._tags)
+                except StopIteration:
+                    self._key, self._current = float("inf"), None
+                if self._key <= previous:
+                    raise ValueError("The demultiplexed reads are not sorted " \
+                                     "by id ({} after {})".format(self._key, previous))
+            tags.append(self._current if self._key == key else None)
+        return tags
+
+    def close(self):
+        # The remaining reads are consumed so the iterator can finish (and log its stats)
+        for _ in self._tags:
+            pass
+
+def lookupTags(hash_reads, keys):
+    """
+    Looks up the tags of many reads at once
+    :param hash_reads: a ReadTagStore, an OrdinalTagJoin or a hash table 
+    of read_names to (x,y,umi,multiplicity) tags
+    :param keys: a list with the keys of the reads (integer ids or hashes of the names)
+    :return: a list with the tags of every read as lists of (tag, value, type)
+    tuples (None for the reads that are not present)
+    :raises: RuntimeError
+    """
+    if isinstance(hash_reads, ReadTagStore):
+        return hash_reads.tagsBatch(hash_reads.lookup(keys))
+    if isinstance(hash_reads, OrdinalTagJoin):
+        try:
+            return hash_reads.join(keys)
+        except ValueError as e:
+            error = "Error joining the reads and the demultiplexed reads\n{}".format(e)
+            logging.getLogger("STPipeline").error(error)
+            raise RuntimeError(error)
+    tags = []
+    for key in keys:
+        try:
+            read_tags = []
+            for tag in hash_reads[key]:
+                tag_tokens = tag.split(":")
+                if tag_tokens[1] == "i":
+                    read_tags.append((tag_tokens[0], int(tag_tokens[2]), tag_tokens[1]))
+                else:
+                    read_tags.append((tag_tokens[0], tag_tokens[2], tag_tokens[1]))
+            tags.append(read_tags)
+        except KeyError:
+            tags.append(None)
+    return tags
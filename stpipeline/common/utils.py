@@ -97,6 +97,17 @@ def fileOk(_file):
     """
     return _file is not None and os.path.isfile(_file) and not os.path.getsize(_file) == 0
         
+def readBarcodes(filename):
+    """
+    Reads the barcodes of a tab delimited file (BARCODE - X - Y)
+    :param filename: the path of the file
+    :type filename: str
+    :return: a set with the barcodes (first column)
+    :raises: IOError
+    """
+    with safeOpenFile(filename, "rU") as filehandler:
+        return set(line.split()[0] for line in filehandler if line.strip())
+        
 def getSTARVersion():
     """
     Tries to find the STAR binary
@@ -85,7 +85,9 @@ def count_reads_in_features(sam_filename,
                 sam_record = read.to_pysam_AlignedRead(count_reads_in_features.samoutfile)
                 sam_record.set_tag("XF", assignment, "Z")
                 count_reads_in_features.samoutfile.write(sam_record)
-                count_reads_in_features.annotated +=1
+                # Collapsed duplicates count as many reads as their multiplicity
+                count_reads_in_features.annotated += sam_record.get_tag("B4") \
+                if sam_record.has_tag("B4") else 1
                 
     # Annotation objects
     features = HTSeq.GenomicArrayOfSets("auto", stranded != "no")
@@ -108,7 +108,8 @@ def alignReads(reverse_reads,
                disable_multimap=False,
                diable_softclipping=False,
                invTrimReverse=0,
-               sortedBAMOutput=True):
+               sortedBAMOutput=True,
+               keepInputOrder=False):
     """
     This function will perform a sequence alignment using STAR.
     Mapped and unmapped reads are written to the paths given as
@@ -129,6 +130,8 @@ def alignReads(reverse_reads,
     :param diable_softclipping: it True no local alignment allowed
     :param invTrimReverse: number of bases to trim in the 5' of the read2
     :param sortedBAMOutput: True if the BAM output must be sorted
+    :param keepInputOrder: True to write the alignments of the unsorted
+    BAM output in the same order as the input reads
     :type reverse_reads: str
     :type ref_map: str
     :type outputFile: str
@@ -145,6 +148,7 @@ def alignReads(reverse_reads,
     :type diable_softclipping: bool
     :type invTrimReverse: int
     :type sortedBAMOutput: bool
+    :type keepInputOrder: bool
     :raises: RuntimeError,ValueError,OSError,CalledProcessError
     """
     logger = logging.getLogger("STPipeline")
@@ -176,6 +180,7 @@ def alignReads(reverse_reads,
     # outFilterType(BySJout) this will keep only reads 
     #     that contains junctions present in SJ.out.tab
     # outSamOrder(Paired) one mate after the other 
+    #     (PairedKeepInputOrder keeps also the order of the input reads) 
     # outSAMprimaryFlag(OneBestScore) only one alignment with the best score is primary
     # outFilterMultimapNmax 
     #     read alignments will be output only if the read maps fewer than this value
@@ -200,6 +205,7 @@ def alignReads(reverse_reads,
     alignment_mode = "EndToEnd" if diable_softclipping else "Local"
     sjdb_overhang = 100 if use_splice_juntions else 0
     bam_sorting = "SortedByCoordinate" if sortedBAMOutput else "Unsorted"
+    sam_order = "PairedKeepInputOrder" if keepInputOrder and not sortedBAMOutput else "Paired"
     
     core_flags = ["--runThreadN", str(max(cores, 1))]
     trim_flags = ["--clip5pNbases", trimReverse, 
@@ -208,7 +214,7 @@ def alignReads(reverse_reads,
                   "--outSAMtype", "BAM", bam_sorting, 
                   "--alignEndsType", alignment_mode, 
                   "--outSAMunmapped", "None", # unmapped reads not included in main output
-                  "--outSAMorder", "Paired",    
+                  "--outSAMorder", sam_order,    
                   "--outSAMprimaryFlag", "OneBestScore", 
                   "--outFilterMultimapNmax", multi_map_number, 
                   "--alignSJoverhangMin", 5, # default is 5
@@ -8,29 +8,44 @@ do sanity check and ultimately run the pipeline.
 from stpipeline.common.utils import *
 from stpipeline.core.mapping import alignReads, barcodeDemultiplexing, createIndex
 from stpipeline.core.annotation import annotateReads
-from stpipeline.common.fastq_utils import filterInputReads, hashDemultiplexedReads
-from stpipeline.common.sam_utils import filterMappedReads
+from stpipeline.common.fastq_utils import filterInputReads, hashDemultiplexedReads, filterDemultiplexedReads, \
+collapseDuplicateReads, writeUniqueSequences, iterDemultiplexedTags
+from stpipeline.common.sam_utils import filterMappedReads, expandMappedReads, sortByCoordinate
+from stpipeline.common.tag_store import OrdinalTagJoin, parseCoordinate
 from stpipeline.common.stats import qa_stats
 from stpipeline.common.dataset import createDataset
 from stpipeline.common.saturation import computeSaturation
+from stpipeline.common.compression import openInputFile
+from stpipeline.common.adaptors import MAX_ADAPTOR_LENGTH
+from stpipeline.common.contaminants import MAX_KMER_SIZE
+from stpipeline.common.discards import discardsFromAlignments, discardsFromReads
+from stpipeline.common.demultiplex import demultiplexBarcodes
 from stpipeline.version import version_number
 import logging
 import argparse
+import re
 import sys
 import shutil
 import os
-import gzip
-import bz2
 from subprocess import check_call
 
 FILENAMES = {"mapped" : "mapped.bam",
+             "mapped_index" : "mapped.bam.bai",
              "annotated" : "annotated.bam",
              "contaminated_clean" : "contaminated_clean.fastq",
              "demultiplexed_prefix" : "demultiplexed",
              "demultiplexed_matched" : "demultiplexed_matched.fastq",
+             "demultiplexed_R2" : "R2_demultiplexed.fastq",
              "mapped_filtered" : "mapped_filtered.bam",
+             "mapped_filtered_unsorted" : "mapped_filtered_unsorted.bam",
              "quality_trimmed_R1" : "R1_quality_trimmed.fastq",
              "quality_trimmed_R2" : "R2_quality_trimmed.fastq",
+             "collapsed_R1" : "R1_collapsed.fastq",
+             "collapsed_R2" : "R2_collapsed.fastq",
+             "unique_R2" : "R2_unique.fastq",
+             "unique_R2_index" : "R2_unique_index.bin",
+             "mapped_expanded" : "mapped_expanded.bam",
+             "mapped_expanded_index" : "mapped_expanded.bam.bai",
              "two_pass_splices" : "SJ.out.tab"}
 
 FILENAMES_DISCARDED = {"mapped_discarded" : "mapping_discarded.fastq",
@@ -69,8 +84,8 @@ class Pipeline():
         self.htseq_no_ambiguous = False
         self.qual64 = False
         self.contaminant_index = None
-        self.fastq_fw = None
-        self.fastq_rv = None
+        self.fastq_fw = []
+        self.fastq_rv = []
         self.logger = None
         self.logfile = None
         self.output_folder = None
@@ -85,6 +100,8 @@ class Pipeline():
         self.remove_polyT_distance = 0
         self.remove_polyG_distance = 0
         self.remove_polyC_distance = 0
+        self.adaptor_sequences = []
+        self.adaptor_error_rate = 0.0
         self.filter_AT_content = 90
         self.disable_clipping = False
         self.disable_multimap = False
@@ -102,6 +119,23 @@ class Pipeline():
         self.two_pass_mode_genome = None
         self.strandness = "yes"
         self.umi_quality_bases = 3
+        self.collapse_duplicates = False
+        self.map_unique_sequences = False
+        self.compact_read_ids = False
+        self.truncate_fw_reads = False
+        self.compact_discarded_files = False
+        self.max_reads = None
+        self.fraction = None
+        self.seed = None
+        self.contaminant_fasta = None
+        self.contaminant_kmer_size = 25
+        self.contaminant_kmer_fraction = 0.5
+        self.demultiplex_first = False
+        self.spot_whitelist = None
+        self.demultiplexer = "taggd"
+        self.merge_join = False
+        self.tags_in_read_names = False
+        self.join_partitions = 0
     
     def clean_filenames(self):
         """ Just makes sure to remove
@@ -114,6 +148,15 @@ class Pipeline():
             for file_name in FILENAMES_DISCARDED.itervalues():
                 safeRemove(file_name)
             
+    def fastqLanes(self):
+        """ 
+        Returns the list of (forward, reverse) fastq files of every lane
+        (the attributes fastq_fw and fastq_rv can be a list of files or one file)
+        """
+        lanes_fw = [self.fastq_fw] if isinstance(self.fastq_fw, basestring) else self.fastq_fw
+        lanes_rv = [self.fastq_rv] if isinstance(self.fastq_rv, basestring) else self.fastq_rv
+        return zip(lanes_fw, lanes_rv) if len(lanes_fw) == len(lanes_rv) else []
+    
     def sanityCheck(self):
         """ 
         Performs some basic sanity checks on the input parameters
@@ -128,30 +171,78 @@ class Pipeline():
             self.logger.error(error)
             raise RuntimeError(error)
           
-        if not os.path.isfile(self.fastq_fw) or not os.path.isfile(self.fastq_rv):
+        lanes = self.fastqLanes()
+        if len(lanes) == 0 or not all(os.path.isfile(fastq) for lane in lanes for fastq in lane):
             error = "Error parsing parameters.\n" \
             "Invalid input files {} {}".format(self.fastq_fw, self.fastq_rv)
             self.logger.error(error)
             raise RuntimeError(error)
                      
-        if (not self.fastq_fw.endswith(".fastq") \
-        and not self.fastq_fw.endswith(".fq") \
-        and not self.fastq_fw.endswith(".gz") \
-        and not self.fastq_rv.endswith(".bz2")) \
-        or (not self.fastq_rv.endswith(".fastq") \
-        and not self.fastq_rv.endswith(".fq") \
-        and not self.fastq_rv.endswith(".gz") \
-        and not self.fastq_rv.endswith(".bz2")):
-            error = "Error parsing parameters.\n" \
-            "Incorrect format for input files {} {}".format(self.fastq_fw, self.fastq_rv)
-            self.logger.error(error)
-            raise RuntimeError(error)
+        # The input files can be compressed (gzip or bzip2), the format
+        # is detected from the content of the files and not from their names
+        for fastq in [fastq for lane in lanes for fastq in lane]:
+            try:
+                with openInputFile(fastq) as filehandler:
+                    first_char = filehandler.read(1)
+            except IOError:
+                first_char = None
+            if first_char != "@":
+                error = "Error parsing parameters.\n" \
+                "Incorrect format for input files {} {}".format(self.fastq_fw, self.fastq_rv)
+                self.logger.error(error)
+                raise RuntimeError(error)
              
         if not os.path.isfile(self.ids):
             error = "Error parsing parameters.\n" \
             "Invalid IDs file {}".format(self.ids)
             self.logger.error(error)
             raise RuntimeError(error)
+        
+        # The tags of the demultiplexed reads keep the coordinates as 16 bits integers
+        with safeOpenFile(self.ids, "rU") as filehandler:
+            for line in filehandler:
+                row = line.split()
+                if not row:
+                    continue
+                try:
+                    parseCoordinate(row[1])
+                    parseCoordinate(row[2])
+                except (ValueError, IndexError):
+                    error = "Error parsing parameters.\n" \
+                    "The coordinates of the IDs file {} are not valid 16 bits integers " \
+                    "(line {})".format(self.ids, line.strip())
+                    self.logger.error(error)
+                    raise RuntimeError(error)
+                  
+        if self.spot_whitelist is not None:
+            if not os.path.isfile(self.spot_whitelist):
+                error = "Error parsing parameters.\n" \
+                "Invalid spot whitelist file {}".format(self.spot_whitelist)
+                self.logger.error(error)
+                raise RuntimeError(error)
+            unknown_barcodes = readBarcodes(self.spot_whitelist) - readBarcodes(self.ids)
+            if len(unknown_barcodes) > 0:
+                error = "Error parsing parameters.\n" \
+                "The spot whitelist contains {} barcodes not present in the IDs file {}".format(len(unknown_barcodes),
+                                                                                              self.ids)
+                self.logger.error(error)
+                raise RuntimeError(error)
+                  
+        # The reads not mapped to the contaminant genome are not written in the order
+        # of the input so the alignments would not be in the order of the reads
+        if self.merge_join and (self.demultiplex_first or self.map_unique_sequences
+                                or self.contaminant_index is not None):
+            error = "Error, --merge-join cannot be used with --demultiplex-first " \
+            "(or --tags-in-read-names), --map-unique-sequences or --contaminant-index.\n"
+            self.logger.error(error)
+            raise RuntimeError(error)
+                  
+        if self.join_partitions < 0 or \
+        (self.join_partitions > 0 and (self.demultiplex_first or self.merge_join)):
+            error = "Error, invalid number of partitions {}, --join-partitions cannot be used " \
+            "with --demultiplex-first (or --tags-in-read-names) or --merge-join.\n".format(self.join_partitions)
+            self.logger.error(error)
+            raise RuntimeError(error)
                   
         if self.two_pass_mode and self.two_pass_mode_genome \
         and not os.path.isfile(self.two_pass_mode_genome):
@@ -159,6 +250,47 @@ class Pipeline():
             self.logger.error(error)
             raise RuntimeError(error)        
            
+        if self.contaminant_fasta is not None and not os.path.isfile(self.contaminant_fasta):
+            error = "Error parsing parameters.\n" \
+            "Invalid contaminant fasta file {}".format(self.contaminant_fasta)
+            self.logger.error(error)
+            raise RuntimeError(error)
+        
+        if self.contaminant_fasta is not None and self.contaminant_index is not None:
+            error = "Error, --contaminant-fasta and --contaminant-index cannot be used at the same time.\n"
+            self.logger.error(error)
+            raise RuntimeError(error)
+            
+        if not 1 <= self.contaminant_kmer_size <= MAX_KMER_SIZE \
+        or not 0.0 < self.contaminant_kmer_fraction <= 1.0:
+            error = "Error invalid contaminant k-mer parameters given {} {}.\n".format(self.contaminant_kmer_size,
+                                                                                      self.contaminant_kmer_fraction)
+            self.logger.error(error)
+            raise RuntimeError(error)
+            
+        for adaptor in self.adaptor_sequences:
+            if re.search("[^ACGTN]", adaptor) is not None or not 0 < len(adaptor) <= MAX_ADAPTOR_LENGTH:
+                error = "Error invalid adaptor sequence given {}.\n".format(adaptor)
+                self.logger.error(error)
+                raise RuntimeError(error)
+            
+        if self.max_reads is not None and self.fraction is not None:
+            error = "Error, --max-reads and --fraction cannot be used at the same time.\n"
+            self.logger.error(error)
+            raise RuntimeError(error)
+            
+        if (self.max_reads is not None and self.max_reads <= 0) \
+        or (self.fraction is not None and not 0.0 < self.fraction <= 1.0):
+            error = "Error invalid preview mode parameters given {} {}.\n".format(self.max_reads,
+                                                                                  self.fraction)
+            self.logger.error(error)
+            raise RuntimeError(error)
+            
+        if self.adaptor_error_rate < 0.0 or self.adaptor_error_rate >= 1.0:
+            error = "Error invalid adaptor error rate given {}.\n".format(self.adaptor_error_rate)
+            self.logger.error(error)
+            raise RuntimeError(error)
+            
         if self.umi_filter and self.molecular_barcodes:
             # Check template validity
             import re
@@ -241,7 +373,16 @@ class Pipeline():
                 else:
                     raise argparse.ArgumentTypeError("{0} is not a readable dir".format(prospective_dir))
 
-        parser.add_argument('fastq_files', nargs=2)
+        parser.add_argument('fastq_files', nargs="*", metavar="FASTQ",
+                            help="The fastq files with the forward and the reverse reads")
+        parser.add_argument('--fastq-fw', metavar="[FILE]", action="append", default=[],
+                            help="Fastq file with the forward reads of another lane of the sample " \
+                            "(it can be given several times, once per lane). " \
+                            "Every lane is read by its own process and the lanes are filtered " \
+                            "and merged into one dataset in the order they are given")
+        parser.add_argument('--fastq-rv', metavar="[FILE]", action="append", default=[],
+                            help="Fastq file with the reverse reads of another lane of the sample " \
+                            "(it can be given several times, in the same order as --fastq-fw)")
         parser.add_argument('--ids', metavar="[FILE]", required=True,
                             help='Path to the file containing the barcodes and the array coordinates.')
         parser.add_argument('--ref-map', metavar="[FOLDER]", action=readable_dir, required=True,
@@ -269,6 +410,15 @@ class Pipeline():
         parser.add_argument('--contaminant-index', metavar="[FOLDER]", action=readable_dir, default=None,
                             help="Path to the folder with a STAR index with a contaminant genome. Reads will be filtered "
                             "against the specified genome and mapping reads will be descarded")
+        parser.add_argument('--contaminant-fasta', metavar="[FILE]", default=None,
+                            help="Path to a fasta file with contaminant sequences (e.g. rRNA). Reads that share " \
+                            "many k-mers with these sequences are discarded when filtering the input reads " \
+                            "(an alternative to --contaminant-index that does not need a STAR alignment)")
+        parser.add_argument('--contaminant-kmer-size', default=25, metavar="[INT]", type=int,
+                            help="Size of the k-mers used with --contaminant-fasta (default: %(default)s)")
+        parser.add_argument('--contaminant-kmer-fraction', default=0.5, metavar="[FLOAT]", type=float,
+                            help="Min fraction of the k-mers of a read present in the contaminant " \
+                            "sequences to discard the read (default: %(default)s)")
         parser.add_argument('--qual-64', action="store_true", default=False,
                             help="Use phred-64 quality instead of phred-33(default)")
         parser.add_argument('--htseq-mode', default="intersection-nonempty", type=str, metavar="[STRING]",
@@ -284,7 +434,7 @@ class Pipeline():
         parser.add_argument('--verbose', action="store_true", default=False,
                             help="Show extra information on the log file")
         parser.add_argument('--mapping-threads', default=4, metavar="[INT]", type=int, choices=range(1, 17),
-                            help="Number of threads to use in the mapping step (default: %(default)s)")
+                            help="Number of threads to use in the mapping and filtering steps (default: %(default)s)")
         parser.add_argument('--min-quality-trimming', default=20, metavar="[INT]", type=int, choices=range(10, 61),
                             help="Minimum phred quality for trimming bases in the trimming step (default: %(default)s)")
         parser.add_argument('--bin-path', metavar="[FOLDER]", action=readable_dir, default=None,
@@ -324,6 +474,12 @@ class Pipeline():
         parser.add_argument('--remove-polyC', default=0, metavar="[INT]", type=int, choices=range(0, 25),
                             help="Remove PolyCs and everything after it in the reads of a " \
                             "length at least as given number (default: %(default)s)")
+        parser.add_argument('--adaptor-sequence', default=[], metavar="[STRING]", type=str, action="append",
+                            help="Remove the given adaptor sequence (e.g. TSO or Nextera) and everything " \
+                            "after it in the reads. It can be given several times")
+        parser.add_argument('--adaptor-error-rate', default=0.0, metavar="[FLOAT]", type=float,
+                            help="Max allowed rate of mismatches when searching for the adaptors " \
+                            "(including the PolyA/T/G/C adaptors) (default: %(default)s)")
         parser.add_argument('--filter-AT-content', default=90, metavar="[INT%]", type=int, choices=range(1, 99),
                             help="Discards reads whose number of A and T bases in total are more " \
                             "or equal than the number given in percentage (default: %(default)s)")
@@ -365,6 +521,59 @@ class Pipeline():
                             help="What strandness mode to use when annotating with htseq-count [no, yes(default), reverse]")
         parser.add_argument('--umi-quality-bases', default=3, metavar="[INT]", type=int, choices=range(0, 10),
                             help="Maximum number of low quality bases allowed in an UMI (default: %(default)s)")        
+        parser.add_argument('--collapse-duplicates', default=False, action="store_true",
+                            help="Collapses the read pairs with the same barcode, UMI and reverse sequence " \
+                            "before the mapping step (they are counted as many times as they are present)")
+        parser.add_argument('--demultiplex-first', default=False, action="store_true",
+                            help="Performs the demultiplexing of the forward reads before the mapping step " \
+                            "so only the reverse reads with a valid barcode are mapped")
+        parser.add_argument('--demultiplexer', default="taggd", type=str, metavar="[STRING]",
+                            choices=["taggd", "native"],
+                            help="Tool used to demultiplex the reads against the barcodes [taggd(default), native]. " \
+                            "The native demultiplexer runs in process and allows only mismatches " \
+                            "(--allowed-missed) and shifts of the barcode (--overhang)")
+        parser.add_argument('--merge-join', default=False, action="store_true",
+                            help="Joins the alignments and the demultiplexed reads by read id in one streaming " \
+                            "pass (the alignments are kept in the order of the reads) instead of building a hash " \
+                            "of the demultiplexed reads. The alignments are sorted by coordinate afterwards. " \
+                            "It enables --compact-read-ids and it cannot be used with --demultiplex-first, " \
+                            "--map-unique-sequences or --contaminant-index")
+        parser.add_argument('--tags-in-read-names', default=False, action="store_true",
+                            help="Carries the coordinates and the UMI of the demultiplexed reads through the " \
+                            "mapping step in the names of the reverse reads (readid|x|y|UMI) instead of building " \
+                            "a hash of the demultiplexed reads. It enables --demultiplex-first and --compact-read-ids")
+        parser.add_argument('--join-partitions', default=0, metavar="[INT]", type=int,
+                            help="Spills the demultiplexed reads to disk in this number of partitions and joins " \
+                            "them to the alignments partition by partition in parallel, so only the demultiplexed " \
+                            "reads of one partition are kept in memory by every process (default: 0, disabled). " \
+                            "It cannot be used with --demultiplex-first or --merge-join")
+        parser.add_argument('--spot-whitelist', metavar="[FILE]", default=None,
+                            help="Path to a file with a subset of the IDs file (e.g. the spots under the tissue). " \
+                            "Reads with other barcodes are discarded before the mapping step. " \
+                            "It enables --demultiplex-first (unless --merge-join is used)")
+        parser.add_argument('--map-unique-sequences', default=False, action="store_true",
+                            help="Maps only one read of every distinct reverse sequence and copies " \
+                            "its alignments to the other reads with the same sequence after the mapping step. " \
+                            "It enables --compact-read-ids")
+        parser.add_argument('--compact-read-ids', default=False, action="store_true",
+                            help="Renames the reads to compact integer ids after the filtering step. " \
+                            "The original names are written to the file <expName>_read_ids.tsv in the output folder")
+        parser.add_argument('--truncate-fw-reads', default=False, action="store_true",
+                            help="Truncates the forward reads after the filtering step to the region " \
+                            "that contains the barcode (plus the overhang) and the UMI")
+        parser.add_argument('--compact-discarded-files', default=False, action="store_true",
+                            help="Writes a compact binary file (<expName>_discarded.bin in the output folder) " \
+                            "with the read id, step and reason of every discarded read. The discarded reads " \
+                            "can be recovered from the input files with rehydrateDiscarded.py. " \
+                            "It enables --compact-read-ids")
+        parser.add_argument('--max-reads', default=None, metavar="[INT]", type=int,
+                            help="Preview mode, processes only a random subset of this number " \
+                            "of read pairs (reservoir sampling)")
+        parser.add_argument('--fraction', default=None, metavar="[FLOAT]", type=float,
+                            help="Preview mode, processes only a random subset of the read pairs " \
+                            "where every read pair is selected with this probability (Bernoulli sampling)")
+        parser.add_argument('--seed', default=None, metavar="[INT]", type=int,
+                            help="Seed of the random selection of read pairs in preview mode")
         parser.add_argument('--version', action='version', version='%(prog)s ' + str(version_number))
         return parser
          
@@ -392,13 +601,19 @@ class Pipeline():
         self.htseq_no_ambiguous = options.htseq_no_ambiguous
         self.qual64 = options.qual_64
         self.contaminant_index = options.contaminant_index
+        self.contaminant_fasta = options.contaminant_fasta
+        self.contaminant_kmer_size = options.contaminant_kmer_size
+        self.contaminant_kmer_fraction = options.contaminant_kmer_fraction
         # Load the given path into the system PATH
         if options.bin_path is not None and os.path.isdir(options.bin_path): 
             os.environ["PATH"] += os.pathsep + options.bin_path
         if options.log_file is not None:
             self.logfile = os.path.abspath(options.log_file)  
-        self.fastq_fw = os.path.abspath(options.fastq_files[0])
-        self.fastq_rv = os.path.abspath(options.fastq_files[1])
+        # The fastq files of every lane (the positional pair is the first lane)
+        self.fastq_fw = [os.path.abspath(fastq) for fastq in options.fastq_files[:1] + options.fastq_fw]
+        self.fastq_rv = [os.path.abspath(fastq) for fastq in options.fastq_files[1:2] + options.fastq_rv]
+        if len(options.fastq_files) not in [0, 2]:
+            self.fastq_fw = self.fastq_rv = []
         if options.output_folder is not None and os.path.isdir(options.output_folder):
             self.output_folder = os.path.abspath(options.output_folder)
         else:
@@ -417,6 +632,8 @@ class Pipeline():
         self.remove_polyT_distance = options.remove_polyT
         self.remove_polyG_distance = options.remove_polyG
         self.remove_polyC_distance = options.remove_polyC
+        self.adaptor_sequences = [adaptor.upper() for adaptor in options.adaptor_sequence]
+        self.adaptor_error_rate = options.adaptor_error_rate
         self.filter_AT_content = options.filter_AT_content
         self.disable_multimap = options.disable_multimap
         self.disable_clipping = options.disable_clipping
@@ -434,6 +651,32 @@ class Pipeline():
         self.two_pass_mode_genome = options.two_pass_mode_genome
         self.strandness = options.strandness
         self.umi_quality_bases = options.umi_quality_bases
+        self.collapse_duplicates = options.collapse_duplicates
+        self.map_unique_sequences = options.map_unique_sequences
+        self.demultiplex_first = options.demultiplex_first
+        self.spot_whitelist = options.spot_whitelist
+        self.demultiplexer = options.demultiplexer
+        self.merge_join = options.merge_join
+        self.tags_in_read_names = options.tags_in_read_names
+        self.join_partitions = options.join_partitions
+        self.compact_read_ids = options.compact_read_ids
+        self.truncate_fw_reads = options.truncate_fw_reads
+        self.compact_discarded_files = options.compact_discarded_files
+        self.max_reads = options.max_reads
+        self.fraction = options.fraction
+        self.seed = options.seed
+        # The discarded reads are identified by their integer ids
+        # (and so are the reads with the same sequence)
+        if self.compact_discarded_files or self.merge_join or self.tags_in_read_names \
+        or self.map_unique_sequences:
+            self.compact_read_ids = True
+        # The reads of other spots are discarded before the mapping step
+        # (or when they are joined to the alignments with --merge-join)
+        if self.spot_whitelist is not None and not self.merge_join:
+            self.demultiplex_first = True
+        # The tags are added to the names of the reads before the mapping step
+        if self.tags_in_read_names:
+            self.demultiplex_first = True
         # Assign class parameters to the QA stats object
         import inspect
         attributes = inspect.getmembers(self, lambda a:not(inspect.isroutine(a)))
@@ -441,7 +684,10 @@ class Pipeline():
         # Assign general parameters to the qa_stats object
         qa_stats.input_parameters = attributes_filtered
         qa_stats.annotation_tool = "htseq-count {}".format(getHTSeqCountVersion())
-        qa_stats.demultiplex_tool = "Taggd {}".format(getTaggdCountVersion())
+        if self.demultiplexer == "native":
+            qa_stats.demultiplex_tool = "Native {}".format(version_number)
+        else:
+            qa_stats.demultiplex_tool = "Taggd {}".format(getTaggdCountVersion())
         qa_stats.pipeline_version = version_number
         qa_stats.mapper_tool = getSTARVersion()    
         
@@ -462,12 +708,17 @@ class Pipeline():
         self.logger.info("Output directory: {}".format(self.output_folder))
         self.logger.info("Temp directory: {}".format(self.temp_folder))
         self.logger.info("Experiment name: {}".format(self.expName))
-        self.logger.info("Forward input file: {}".format(self.fastq_fw))
-        self.logger.info("Reverse input file: {}".format(self.fastq_rv))
+        for fastq_fw, fastq_rv in self.fastqLanes():
+            self.logger.info("Forward input file: {}".format(fastq_fw))
+            self.logger.info("Reverse input file: {}".format(fastq_rv))
         self.logger.info("Reference mapping index folder: {}".format(self.ref_map))
         self.logger.info("Reference annotation file: {}".format(self.ref_annotation))
         if self.contaminant_index is not None:
             self.logger.info("Using contamination filter: {}".format(self.contaminant_index))
+        if self.contaminant_fasta is not None:
+            self.logger.info("Using k-mer contamination filter: {}".format(self.contaminant_fasta))
+            self.logger.info("Contamination filter k-mer size: {} min fraction of k-mers: {}".format(
+                self.contaminant_kmer_size, self.contaminant_kmer_fraction))
         self.logger.info("CPU Nodes: {}".format(self.threads))
         self.logger.info("Ids file: {}".format(self.ids))
         self.logger.info("TaggD allowed mismatches: {}".format(self.allowed_missed))
@@ -510,11 +761,110 @@ class Pipeline():
             self.logger.info("Removing polyG adaptors of a length of at least: {}".format(self.remove_polyG_distance))
         if self.remove_polyC_distance > 0:
             self.logger.info("Removing polyC adaptors of a length of at least: {}".format(self.remove_polyC_distance))
+        for adaptor in self.adaptor_sequences:
+            self.logger.info("Removing adaptor: {}".format(adaptor))
+        if self.adaptor_error_rate > 0:
+            self.logger.info("Adaptor mismatches rate allowed: {}".format(self.adaptor_error_rate))
+        if self.collapse_duplicates:
+            self.logger.info("Collapsing duplicated reads before the mapping step")
+        if self.demultiplex_first:
+            self.logger.info("Demultiplexing the reads before the mapping step")
+        if self.spot_whitelist is not None:
+            self.logger.info("Using a whitelist of spots: {}".format(self.spot_whitelist))
+        self.logger.info("Demultiplexing tool: {}".format(self.demultiplexer))
+        if self.merge_join:
+            self.logger.info("Joining the alignments and the demultiplexed reads in the order of the reads")
+        if self.tags_in_read_names:
+            self.logger.info("Carrying the coordinates and the UMI of the reads in the read names")
+        if self.join_partitions > 0:
+            self.logger.info("Joining the alignments and the demultiplexed reads " \
+                             "in {} partitions".format(self.join_partitions))
+        if self.map_unique_sequences:
+            self.logger.info("Mapping only the unique reverse sequences")
+        if self.compact_read_ids:
+            self.logger.info("Renaming the reads to compact integer ids")
+        if self.truncate_fw_reads:
+            self.logger.info("Truncating the forward reads to the barcode and UMI region")
+        if self.compact_discarded_files:
+            self.logger.info("Writing a compact record of the discarded reads")
+        if self.max_reads is not None:
+            self.logger.info("Preview mode, using a random subset of {} read pairs".format(self.max_reads))
+        if self.fraction is not None:
+            self.logger.info("Preview mode, using a random subset of {} of the read pairs".format(self.fraction))
         if self.low_memory:
-            self.logger.info("Using a SQL based container to save memory")
+            self.logger.info("Using containers on disk to save memory")
         if self.two_pass_mode :
             self.logger.info("Using the STAR 2-pass mode with the genome: {}".format(self.two_pass_mode_genome))
         
+    def demultiplexReads(self, reads, globaltime, stream=False):
+        """ 
+        Demultiplexes the given forward reads against the barcodes
+        and returns the hash of read_name => (barcode,x,y,umi) tags
+        of the demultiplexed reads
+        :param reads: the fastq file with the forward reads
+        :param globaltime: the TimeStamper of the pipeline run
+        :param stream: True to return a generator of (read id, tags)
+        in the order of the reads instead of the hash
+        """
+        whitelist = readBarcodes(self.spot_whitelist) if self.spot_whitelist is not None else None
+        #=================================================================
+        # STEP: DEMULTIPLEX READS Map against the barcodes
+        #=================================================================
+        self.logger.info("Starting barcode demultiplexing {}".format(globaltime.getTimestamp()))
+        if self.demultiplexer == "native":
+            # The hash of demultiplexed reads is obtained directly
+            return demultiplexBarcodes(reads,
+                                       self.ids,
+                                       self.allowed_missed,
+                                       self.barcode_start,
+                                       self.overhang,
+                                       self.molecular_barcodes,
+                                       self.mc_start_position,
+                                       self.mc_end_position,
+                                       self.low_memory,
+                                       self.compact_read_ids,
+                                       whitelist,
+                                       self.threads,
+                                       self.temp_folder,
+                                       compact=True,
+                                       stream=stream,
+                                       partitions=self.join_partitions,
+                                       temp_folder=self.temp_folder)
+        try:
+            barcodeDemultiplexing(reads,
+                                  self.ids,
+                                  self.allowed_missed,
+                                  self.allowed_kmer,
+                                  self.barcode_start,
+                                  self.overhang,
+                                  self.threads,
+                                  FILENAMES["demultiplexed_prefix"], # Prefix for output files
+                                  self.keep_discarded_files)
+        except Exception:
+            raise
+        
+        #=================================================================
+        # STEP: OBTAIN HASH OF DEMULTIPLEXED READS
+        # Hash demultiplexed reads to obtain a hash of read_name => (barcode,x,y,umi) 
+        #=================================================================
+        self.logger.info("Parsing demultiplexed reads {}".format(globaltime.getTimestamp()))
+        if stream:
+            return iterDemultiplexedTags(FILENAMES["demultiplexed_matched"],
+                                         self.molecular_barcodes,
+                                         self.mc_start_position,
+                                         self.mc_end_position,
+                                         whitelist)
+        return hashDemultiplexedReads(FILENAMES["demultiplexed_matched"], 
+                                      self.molecular_barcodes, 
+                                      self.mc_start_position,
+                                      self.mc_end_position,
+                                      self.low_memory,
+                                      self.compact_read_ids,
+                                      whitelist,
+                                      compact=True,
+                                      partitions=self.join_partitions,
+                                      temp_folder=self.temp_folder)
+        
     def run(self):
         """ 
         Runs the whole pipeline given the parameters present.
@@ -538,49 +888,20 @@ class Pipeline():
         start_exe_time = globaltime.getTimestamp()
         self.logger.info("Starting the pipeline: {}".format(start_exe_time))
 
-        # Check if input fastq files are compressed
-        # TODO it is faster to make a system call with gunzip
-        # TODO reliable way to test if files are compressed (something more robust than just file name endings)
-        try:
-            if self.fastq_fw.endswith(".gz"):
-                temp_fastq_fw = os.path.join(self.temp_folder, "unzipped_fastq_fw.fastq")
-                with gzip.open(self.fastq_fw, "rb") as filehandler_read:
-                    with open(temp_fastq_fw, "w") as filehandler_write:
-                        for line in filehandler_read:
-                            filehandler_write.write(line)
-                self.fastq_fw = temp_fastq_fw
-                if self.fastq_rv.endswith(".gz"):
-                    temp_fastq_rv = os.path.join(self.temp_folder, "unzipped_fastq_rv.fastq")
-                    with gzip.open(self.fastq_rv, "rb") as filehandler_read:
-                        with open(temp_fastq_rv, "w") as filehandler_write:
-                            for line in filehandler_read:
-                                filehandler_write.write(line)
-                    self.fastq_rv = temp_fastq_rv
-        except Exception as e:
-            self.logger.error("Error decompressing gzipped input files {0} {1}".format(self.fastq_fw, self.fastq_rv))
-            raise e
-        try:
-            if self.fastq_fw.endswith(".bz2"):
-                temp_fastq_fw = os.path.join(self.temp_folder, "unzipped_fastq_fw.fastq")
-                with bz2.BZ2File(self.fastq_fw, "rb") as filehandler_read:
-                    with open(temp_fastq_fw, "w") as filehandler_write:
-                        for line in filehandler_read:
-                            filehandler_write.write(line)
-                self.fastq_fw = temp_fastq_fw
-                if self.fastq_rv.endswith(".bz2"):
-                    temp_fastq_rv = os.path.join(self.temp_folder, "unzipped_fastq_rv.fastq")
-                    with bz2.BZ2File(self.fastq_rv, "rb") as filehandler_read:
-                        with open(temp_fastq_rv, "w") as filehandler_write:
-                            for line in filehandler_read:
-                                filehandler_write.write(line)
-                    self.fastq_rv = temp_fastq_rv
-        except Exception as e:
-            self.logger.error("Error decompressing bzip2'ed input files {0} {1}".format(self.fastq_fw, self.fastq_rv))
-            raise e
         #=================================================================
         # STEP: FILTERING 
         # Applies different filters : sanity, quality, short, adaptors, UMI...
         #=================================================================
+        # The records of the discarded reads are appended by every step
+        discards = None
+        if self.compact_discarded_files:
+            discards = os.path.join(self.output_folder, self.expName + "_discarded.bin")
+            safeRemove(discards)
+        # Only this region of the forward reads is used (barcode 
+        # with the overhang for taggd and UMI)
+        fw_length = self.barcode_start + self.barcode_length + self.overhang
+        if self.molecular_barcodes:
+            fw_length = max(fw_length, self.mc_end_position)
         self.logger.info("Start filtering raw reads {}".format(globaltime.getTimestamp()))
         try: 
             filterInputReads(self.fastq_fw,
@@ -603,9 +924,81 @@ class Pipeline():
                              self.qual64,
                              self.umi_filter,
                              self.umi_filter_template,
-                             self.umi_quality_bases)
+                             self.umi_quality_bases,
+                             self.adaptor_sequences,
+                             self.adaptor_error_rate,
+                             os.path.join(self.output_folder, self.expName + "_read_ids.tsv") \
+                             if self.compact_read_ids else None,
+                             fw_length if self.truncate_fw_reads else None,
+                             discards,
+                             self.fraction,
+                             self.max_reads,
+                             self.seed,
+                             self.contaminant_fasta,
+                             self.contaminant_kmer_size,
+                             self.contaminant_kmer_fraction,
+                             self.threads)
         except Exception:
             raise
+        
+        #=================================================================
+        # CONDITIONAL STEP: Collapse duplicated reads (same barcode, UMI and R2 sequence)
+        #=================================================================
+        trimmed_R1 = FILENAMES["quality_trimmed_R1"]
+        trimmed_R2 = FILENAMES["quality_trimmed_R2"]
+        if self.collapse_duplicates:
+            self.logger.info("Start collapsing duplicated reads {}".format(globaltime.getTimestamp()))
+            try:
+                collapseDuplicateReads(trimmed_R1,
+                                       trimmed_R2,
+                                       FILENAMES["collapsed_R1"],
+                                       FILENAMES["collapsed_R2"],
+                                       fw_length,
+                                       self.low_memory,
+                                       discards)
+            except Exception:
+                raise
+            trimmed_R1 = FILENAMES["collapsed_R1"]
+            trimmed_R2 = FILENAMES["collapsed_R2"]
+            
+        #=================================================================
+        # CONDITIONAL STEP: Demultiplex the reads first and map only the matched reads
+        #=================================================================
+        if self.demultiplex_first:
+            if self.tags_in_read_names:
+                # The demultiplexed reads are joined to the reverse reads as they are read
+                hash_reads = OrdinalTagJoin(self.demultiplexReads(trimmed_R1, globaltime, stream=True))
+            else:
+                hash_reads = self.demultiplexReads(trimmed_R1, globaltime)
+            self.logger.info("Start removing non demultiplexed reads {}".format(globaltime.getTimestamp()))
+            try:
+                filterDemultiplexedReads(trimmed_R2,
+                                         FILENAMES["demultiplexed_R2"],
+                                         hash_reads,
+                                         self.compact_read_ids,
+                                         discards,
+                                         self.tags_in_read_names)
+            except Exception:
+                if self.low_memory and not self.tags_in_read_names: hash_reads.close()
+                raise
+            trimmed_R2 = FILENAMES["demultiplexed_R2"]
+            # The tags are parsed from the read names after the mapping step
+            if self.tags_in_read_names:
+                hash_reads = None
+            
+        #=================================================================
+        # CONDITIONAL STEP: Keep only one read of every distinct R2 sequence for mapping
+        #=================================================================
+        if self.map_unique_sequences:
+            self.logger.info("Start writing unique sequences {}".format(globaltime.getTimestamp()))
+            try:
+                writeUniqueSequences(trimmed_R2,
+                                     FILENAMES["unique_R2"],
+                                     FILENAMES["unique_R2_index"],
+                                     self.low_memory)
+            except Exception:
+                raise
+            trimmed_R2 = FILENAMES["unique_R2"]
           
         #=================================================================
         # CONDITIONAL STEP: Filter out contaminated reads, e.g. typically bacterial rRNA
@@ -615,7 +1008,7 @@ class Pipeline():
             # and keep the un-mapped reads
             self.logger.info("Starting contaminant filter alignment {}".format(globaltime.getTimestamp()))
             try:
-                alignReads(FILENAMES["quality_trimmed_R2"], # input
+                alignReads(trimmed_R2, # input
                            self.contaminant_index,
                            FILENAMES_DISCARDED["contaminated_discarded"], # output mapped
                            FILENAMES["contaminated_clean"], # output un-mapped
@@ -633,12 +1026,18 @@ class Pipeline():
                            )
             except Exception:
                 raise
+            if discards is not None:
+                discardsFromAlignments(FILENAMES_DISCARDED["contaminated_discarded"],
+                                       discards,
+                                       "contaminant_filter",
+                                       "contaminant",
+                                       FILENAMES["unique_R2_index"] if self.map_unique_sequences else None)
             
         #=================================================================
         # STEP: Maps against the genome using STAR
         #=================================================================
         self.logger.info("Starting genome alignment {}".format(globaltime.getTimestamp()))
-        input_reads = FILENAMES["contaminated_clean"] if self.contaminant_index else FILENAMES["quality_trimmed_R2"]
+        input_reads = FILENAMES["contaminated_clean"] if self.contaminant_index else trimmed_R2
         try:
             alignReads(input_reads,
                        self.ref_map,
@@ -654,7 +1053,8 @@ class Pipeline():
                        self.disable_multimap,
                        self.disable_clipping,
                        self.inverse_trimming_rv,
-                       True)
+                       not self.merge_join, # sorted BAM unless joined in the order of the reads
+                       self.merge_join)
         except Exception:
             raise
         
@@ -681,54 +1081,73 @@ class Pipeline():
                            True, # enable splice variants alignments
                            self.disable_multimap,
                            self.disable_clipping,
-                           self.inverse_trimming_rv)
+                           self.inverse_trimming_rv,
+                           not self.merge_join,
+                           self.merge_join)
             except Exception:
                 raise
             finally:
                 if os.path.exists(tmp_index): shutil.rmtree(tmp_index)
             
+        # Record the reads that were not mapped
+        if discards is not None:
+            discardsFromReads(FILENAMES_DISCARDED["mapped_discarded"],
+                              discards,
+                              "mapping",
+                              "unmapped",
+                              FILENAMES["unique_R2_index"] if self.map_unique_sequences else None)
+            
         #=================================================================
-        # STEP: DEMULTIPLEX READS Map against the barcodes
+        # CONDITIONAL STEP: Copy the alignments of the unique sequences to all the reads
         #=================================================================
-        self.logger.info("Starting barcode demultiplexing {}".format(globaltime.getTimestamp()))
-        try:
-            barcodeDemultiplexing(FILENAMES["quality_trimmed_R1"],
-                                  self.ids,
-                                  self.allowed_missed,
-                                  self.allowed_kmer,
-                                  self.barcode_start,
-                                  self.overhang,
-                                  self.threads,
-                                  FILENAMES["demultiplexed_prefix"], # Prefix for output files
-                                  self.keep_discarded_files)
-        except Exception:
-            raise
-        
+        mapped_reads = FILENAMES["mapped"]
+        if self.map_unique_sequences:
+            self.logger.info("Start expanding mapped reads {}".format(globaltime.getTimestamp()))
+            try:
+                expandMappedReads(FILENAMES["mapped"],
+                                  FILENAMES["unique_R2_index"],
+                                  FILENAMES["mapped_expanded"],
+                                  self.low_memory)
+            except Exception:
+                raise
+            mapped_reads = FILENAMES["mapped_expanded"]
+            
         #=================================================================
-        # STEP: OBTAIN HASH OF DEMULTIPLEXED READS
-        # Hash demultiplexed reads to obtain a hash of read_name => (barcode,x,y,umi) 
+        # STEP: DEMULTIPLEX READS Map against the barcodes 
+        # (it is done before the mapping step with --demultiplex-first)
         #=================================================================
-        self.logger.info("Parsing demultiplexed reads {}".format(globaltime.getTimestamp()))
-        hash_reads = hashDemultiplexedReads(FILENAMES["demultiplexed_matched"], 
-                                            self.molecular_barcodes, 
-                                            self.mc_start_position,
-                                            self.mc_end_position,
-                                            self.low_memory)
+        if self.merge_join:
+            # The demultiplexed reads are joined to the alignments as they are read
+            hash_reads = OrdinalTagJoin(self.demultiplexReads(trimmed_R1, globaltime, stream=True))
+        elif not self.demultiplex_first:
+            hash_reads = self.demultiplexReads(trimmed_R1, globaltime)
         
         #================================================================
         # STEP: filters mapped reads and add the (Barcode,x,y,umi) as SAM tags
         #================================================================
         self.logger.info("Starting processing aligned reads {}".format(globaltime.getTimestamp()))
         try:
-            filterMappedReads(FILENAMES["mapped"],
+            filterMappedReads(mapped_reads,
                               hash_reads,
-                              FILENAMES["mapped_filtered"],
+                              FILENAMES["mapped_filtered_unsorted"] if self.merge_join \
+                              else FILENAMES["mapped_filtered"],
                               FILENAMES_DISCARDED["mapped_filtered_discarded"] if self.keep_discarded_files else None,
-                              self.min_length_trimming)
+                              self.min_length_trimming,
+                              self.compact_read_ids,
+                              discards,
+                              self.threads)
         except Exception:
             raise
         finally:
-            if self.low_memory: hash_reads.close() 
+            if (self.low_memory or self.join_partitions > 0) \
+            and not (self.merge_join or self.tags_in_read_names): hash_reads.close() 
+            
+        # The alignments are sorted by coordinate only after the tags were added
+        if self.merge_join:
+            self.logger.info("Sorting the filtered alignments {}".format(globaltime.getTimestamp()))
+            sortByCoordinate(FILENAMES["mapped_filtered_unsorted"],
+                             FILENAMES["mapped_filtered"],
+                             self.threads)
                 
         #=================================================================
         # STEP: annotate using htseq-count
@@ -4,7 +4,9 @@ Unit-test the package adaptors
 """
 
 import unittest
-from stpipeline.common.adaptors import removeAdaptor
+from stpipeline.common.adaptors import removeAdaptor, AdaptorFinder
+from stpipeline.common.fastq_utils import to_uint8_array
+import random
 
 class TestAdaptors(unittest.TestCase):
        
@@ -40,5 +42,44 @@ class TestAdaptors(unittest.TestCase):
         #self.assertRaises(ValueError, removeAdaptor, seq_adaptor_middle, "TTTTT", 21, "3")
         #self.assertRaises(ValueError, removeAdaptor, (fake_name,fake_qual), "TTTTT", 0, "3")
 
+    def test_AdaptorFinder(self):
+        """
+        Test that AdaptorFinder finds the leftmost adaptor in one scan
+        with and without mismatches and that the vectorized search
+        gives the same positions as the per read search
+        """
+        finder = AdaptorFinder(["AAAAA", "TTTTT", "CTGTCTCTTATA"])
+        self.assertTrue(finder.exact)
+        self.assertEqual(finder.find("GGGGGTTTTTGGAAAAA"), 5)
+        self.assertEqual(finder.find("GGCTGTCTCTTATAAAAAA"), 2)
+        self.assertEqual(finder.find("GGGGGGGGGG"), -1)
+        self.assertEqual(finder.trim("GGAAAAAGG", "IIIIIIIII"), ("GG", "II"))
+        # Same result as removing the homopolymers one by one
+        random.seed(1)
+        homopolymers = ["AAAA", "TTTT", "GGGG", "CCCC"]
+        finder = AdaptorFinder(homopolymers)
+        for _ in xrange(1000):
+            sequence = "".join(random.choice("ACGT") for _ in xrange(50))
+            quality = "I" * 50
+            expected = (sequence, quality)
+            for adaptor in homopolymers:
+                expected = removeAdaptor(expected[0], expected[1], adaptor)
+            self.assertEqual(finder.trim(sequence, quality), expected)
+        # One mismatch allowed in adaptors of length 10
+        finder = AdaptorFinder(["AAAAAAAAAA", "CTGTCTCTTATA"], 0.1)
+        self.assertFalse(finder.exact)
+        self.assertEqual(finder.find("GGGGGAAAAACAAAAGG"), 5)
+        self.assertEqual(finder.find("GGGGGAAAACCAAAAGG"), -1)
+        self.assertEqual(finder.find("GGCTGTCTGTTATAGGGG"), 2)
+        self.assertEqual(finder.find("GGAAAAAAAAAC"), 1)
+        sequences = ["".join(random.choice("ACGT") for _ in xrange(random.randint(5, 60))) + 
+                     "".join(random.choice(["A"] * 9 + ["C"]) for _ in xrange(12))
+                     for _ in xrange(500)]
+        sequences_array, lengths = to_uint8_array(sequences)
+        expected = [finder.find(sequence) for sequence in sequences]
+        expected = [pos if pos != -1 else len(sequence) for pos, sequence in zip(expected, sequences)]
+        self.assertEqual(finder.findBatch(sequences_array, lengths).tolist(), expected)
+        self.assertRaises(ValueError, AdaptorFinder, ["A" * 65])
+
 if __name__ == '__main__':
     unittest.main()    
\ No newline at end of file
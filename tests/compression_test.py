@@ -0,0 +1,113 @@
+#! /usr/bin/env python
+"""
+Unit-test the package compression
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+import gzip
+import bz2
+import zlib
+import struct
+from stpipeline.common.compression import compressionFormat, openInputFile, ProcessStream, _bzip2Chunks
+import stpipeline.common.compression as compression
+from stpipeline.common.fastq_utils import readfq
+
+def _bgzfBlock(data):
+    """
+    Creates a BGZF block (a gzip member with the BC extra field)
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    block_size = 12 + 6 + len(cdata) + 8
+    header = "\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff" + struct.pack("<H", 6) \
+    + "BC" + struct.pack("<HH", 2, block_size - 1)
+    return header + cdata + struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+
+class TestCompression(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="st_pipeline_test_compression")
+        self.data = "".join("@read{0} 1:N:0\nACGTACGTAC\n+\nIIIIIIIIII\n".format(i) for i in xrange(20000))
+        half = len(self.data) / 2
+        self.plain = os.path.join(self.tmpdir, "reads.fastq")
+        with open(self.plain, "w") as filehandler:
+            filehandler.write(self.data)
+        # Multi-member gzip file with a misleading suffix
+        self.gzip = os.path.join(self.tmpdir, "reads_gzip.txt")
+        with open(self.gzip, "wb") as filehandler:
+            for part in [self.data[:half], self.data[half:]]:
+                member = gzip.GzipFile(fileobj=filehandler, mode="wb")
+                member.write(part)
+                member.close()
+        # Multi-stream bzip2 file
+        self.bzip2 = os.path.join(self.tmpdir, "reads.fastq.bz2")
+        with open(self.bzip2, "wb") as filehandler:
+            filehandler.write(bz2.compress(self.data[:half]))
+            filehandler.write(bz2.compress(self.data[half:]))
+        # BGZF file
+        self.bgzf = os.path.join(self.tmpdir, "reads.fastq.gz")
+        with open(self.bgzf, "wb") as filehandler:
+            for i in xrange(0, len(self.data), 60000):
+                filehandler.write(_bgzfBlock(self.data[i:i + 60000]))
+            filehandler.write(_bgzfBlock(""))
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_compressionFormat(self):
+        self.assertEqual(compressionFormat(self.plain), None)
+        self.assertEqual(compressionFormat(self.gzip), "gzip")
+        self.assertEqual(compressionFormat(self.bzip2), "bzip2")
+        self.assertEqual(compressionFormat(self.bgzf), "bgzf")
+
+    def test_openInputFile(self):
+        """
+        Test that all the formats are decompressed to the original
+        content with and without external tools
+        """
+        for filename in [self.plain, self.gzip, self.bzip2, self.bgzf]:
+            for use_external_tools in [True, False]:
+                filehandler = openInputFile(filename, 4, use_external_tools)
+                self.assertEqual(filehandler.read(), self.data)
+                filehandler.close()
+        filehandler = openInputFile(self.bgzf)
+        records = list(readfq(filehandler))
+        filehandler.close()
+        self.assertEqual(len(records), 20000)
+        self.assertEqual(records[-1], ("read19999 1:N:0", "ACGTACGTAC", "IIIIIIIIII"))
+
+    def test_bzip2_stream_boundary(self):
+        """
+        Test a bzip2 file whose second stream starts exactly at a read boundary
+        """
+        half = len(self.data) / 2
+        first = bz2.compress(self.data[:half])
+        buffer_size = compression.BUFFER_SIZE
+        compression.BUFFER_SIZE = len(first)
+        try:
+            with open(self.bzip2, "rb") as filehandler:
+                self.assertEqual("".join(_bzip2Chunks(filehandler)), self.data)
+        finally:
+            compression.BUFFER_SIZE = buffer_size
+
+    def test_early_close(self):
+        filehandler = openInputFile(self.bgzf, 2, False)
+        self.assertEqual(filehandler.readline(), "@read0 1:N:0\n")
+        filehandler.close()
+        self.assertTrue(filehandler.closed)
+
+    def test_ProcessStream(self):
+        filehandler = ProcessStream(self.gzip, ["gzip", "-dc"])
+        self.assertEqual(filehandler.read(), self.data)
+        filehandler.close()
+        filehandler = ProcessStream(self.plain, ["gzip", "-dc"])
+        self.assertRaises(IOError, filehandler.read)
+        filehandler.close()
+
+if __name__ == '__main__':
+    unittest.main()
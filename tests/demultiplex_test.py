@@ -0,0 +1,95 @@
+#! /usr/bin/env python
+"""
+Unit-test the package demultiplex
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+from stpipeline.common.fastq_utils import FastqWriter, to_uint8_array
+from stpipeline.common.demultiplex import BarcodeIndex, encode_barcodes_batch, homopolymer_batch, \
+demultiplexBarcodes, UNMATCHED, AMBIGUOUS
+
+class TestDemultiplex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="st_pipeline_test_demultiplex")
+        self.ids = os.path.join(self.tmpdir, "ids.txt")
+        self.barcodes = ["ACGTACGTAC", "TTGCATGCAA", "ACGTACGTGG"]
+        with open(self.ids, "w") as filehandler:
+            for i, barcode in enumerate(self.barcodes):
+                filehandler.write("{}\t{}\t{}\n".format(barcode, i + 1, i + 10))
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.tmpdir)
+
+    def lookup(self, index, barcodes):
+        return index.lookup(encode_barcodes_batch(to_uint8_array(barcodes)[0])).tolist()
+
+    def test_BarcodeIndex(self):
+        """
+        Test the look-up of the barcodes with mismatches and the ambiguous variants
+        """
+        index = BarcodeIndex.fromIdsFile(self.ids, 1)
+        self.assertEqual(index.coordinates[1], ("2", "11"))
+        self.assertEqual(self.lookup(index, self.barcodes), [0, 1, 2])
+        self.assertEqual(self.lookup(index, ["ACGTACCTAC", "TTGCATGCAT", "ACGTACGTAG", "GGGGGGGGGG"]),
+                         [0, 1, AMBIGUOUS, UNMATCHED])
+        self.assertEqual(self.lookup(BarcodeIndex.fromIdsFile(self.ids, 0), ["ACGTACCTAC"]), [UNMATCHED])
+        self.assertEqual(homopolymer_batch(to_uint8_array(["ACAAAAAAAAGT", "ACAAAAAAAGGT"])[0], 8).tolist(),
+                         [True, False])
+        # The index is cached by the checksum of the IDs file
+        cached = BarcodeIndex.fromIdsFile(self.ids, 1, self.tmpdir)
+        self.assertEqual(len([name for name in os.listdir(self.tmpdir) if name.endswith(".npz")]), 1)
+        self.assertEqual(BarcodeIndex.fromIdsFile(self.ids, 1, self.tmpdir).codes.tolist(),
+                         cached.codes.tolist())
+        self.assertEqual(len(cached), len(index))
+
+    def test_demultiplexBarcodes(self):
+        """
+        Test that the reads are assigned to their spots with the UMI,
+        the multiplicity and the barcode shifted by the overhang
+        """
+        reads = os.path.join(self.tmpdir, "reads.fastq")
+        sequences = [("0", "ACGTACGTAC" + "GGGCC" + "TTTT"),
+                     ("1 B4:i:3", "TTGCATGCAT" + "CCCAA" + "TTTT"),
+                     ("2", "A" + "ACGTACGTGG" + "AACCC" + "TTT"),
+                     ("3", "ACGTACGTAG" + "AAAAA" + "TTTT"),
+                     ("4", "GGGGGGGGGG" + "AAAAA" + "TTTT")]
+        with FastqWriter(reads) as writer:
+            for name, sequence in sequences:
+                writer.write((name, sequence, "I" * len(sequence)))
+        for threads in [1, 2]:
+            hash_reads = demultiplexBarcodes(reads, self.ids, 1, 0, 2, True, 10, 15, False, True,
+                                             threads=threads)
+            self.assertEqual(hash_reads, {0 : ["B1:Z:1", "B2:Z:10", "B3:Z:GGGCC"],
+                                          1 : ["B1:Z:2", "B2:Z:11", "B3:Z:CCCAA", "B4:i:3"],
+                                          2 : ["B1:Z:3", "B2:Z:12", "B3:Z:GAACC"]})
+            # The compact store holds the same tags
+            compact = demultiplexBarcodes(reads, self.ids, 1, 0, 2, True, 10, 15, False, True,
+                                          threads=threads, compact=True)
+            self.assertEqual(dict((key, compact[key]) for key in hash_reads), hash_reads)
+            self.assertEqual(len(compact), 3)
+            # The tags are also given in the order of the reads
+            stream = demultiplexBarcodes(reads, self.ids, 1, 0, 2, True, 10, 15, False, True,
+                                         threads=threads, stream=True)
+            self.assertEqual([(key, ["{}:{}:{}".format(tag, value_type, value)
+                                     for tag, value, value_type in tags]) for key, tags in stream],
+                             sorted(hash_reads.items()))
+        hash_reads = demultiplexBarcodes(reads, self.ids, 1, 0, 0, False, 10, 15, False, True,
+                                         whitelist=set(["TTGCATGCAA"]))
+        self.assertEqual(hash_reads, {1 : ["B1:Z:2", "B2:Z:11", "B4:i:3"]})
+        # The coordinates of the compact store must be 16 bits integers
+        ids = os.path.join(self.tmpdir, "ids_large.txt")
+        with open(ids, "w") as filehandler:
+            filehandler.write("ACGTACGTAC\t40000\t1\n")
+        with self.assertRaisesRegexp(RuntimeError, "not valid 16 bits integers"):
+            demultiplexBarcodes(reads, ids, 1, 0, 0, False, 10, 15, False, True, compact=True)
+        self.assertEqual(demultiplexBarcodes(reads, ids, 1, 0, 0, False, 10, 15, False, True),
+                         {0 : ["B1:Z:40000", "B2:Z:1"], 3 : ["B1:Z:40000", "B2:Z:1"]})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+"""
+Unit-test the package discards
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+from stpipeline.common.fastq_utils import FastqWriter, filterInputReads, readfq, LANE_ORDINAL_SHIFT
+from stpipeline.common.discards import readDiscards, writeDiscards, discardsFromReads, \
+rehydrateDiscards, STEPS, REASONS
+
+class TestDiscards(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="st_pipeline_test_discards")
+        self.fw = os.path.join(self.tmpdir, "R1.fastq")
+        self.rw = os.path.join(self.tmpdir, "R2.fastq")
+        sequence = "ACGTTGCAGCTAGCATCGACTAGCTACGACTACG"
+        with FastqWriter(self.fw) as fw_writer, FastqWriter(self.rw) as rw_writer:
+            for i in xrange(20):
+                # Every third read is too short after quality trimming
+                # and every fifth read has a high AT content
+                sequence_rw = "A" * len(sequence) if i % 5 == 0 else sequence
+                quality = "#" * len(sequence) if i % 3 == 0 else "I" * len(sequence)
+                fw_writer.write(("read{}".format(i), sequence, "I" * len(sequence)))
+                rw_writer.write(("read{}".format(i), sequence_rw, quality))
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_discards(self):
+        """
+        Test that the discarded reads are recorded with the step and reason
+        and that they can be recovered from the input files
+        """
+        discards = os.path.join(self.tmpdir, "discarded.bin")
+        out_fw = os.path.join(self.tmpdir, "R1_filtered.fastq")
+        out_rw = os.path.join(self.tmpdir, "R2_filtered.fastq")
+        out_ids = os.path.join(self.tmpdir, "ids.tsv")
+        filterInputReads(self.fw, self.rw, out_fw, out_rw, None,
+                         out_ids=out_ids, out_discards=discards)
+        records = readDiscards(discards)
+        self.assertTrue(all(records["step"] == STEPS["filter_input"]))
+        by_reason = dict((reason, sorted(records["ordinal"][records["reason"] == code].tolist()))
+                         for reason, code in REASONS.iteritems())
+        self.assertEqual(by_reason["at_content"], [0, 5, 10, 15])
+        self.assertEqual(by_reason["quality_trimming"], [3, 6, 9, 12, 18])
+        # Records of later steps are appended
+        self.assertEqual(discardsFromReads(out_rw, discards, "mapping", "unmapped"), 11)
+        writeDiscards(discards, [1], "filter_mapped", "barcode")
+        self.assertEqual(len(readDiscards(discards)), 9 + 11 + 1)
+        rehydrated_fw = os.path.join(self.tmpdir, "R1_discarded.fastq")
+        rehydrated_rw = os.path.join(self.tmpdir, "R2_discarded.fastq")
+        written = rehydrateDiscards(discards, self.fw, self.rw, rehydrated_fw, rehydrated_rw,
+                                    steps=["filter_input"], reasons=["at_content"])
+        self.assertEqual(written, 4)
+        with open(rehydrated_rw) as filehandler:
+            self.assertEqual([record[0] for record in readfq(filehandler)],
+                             ["read0", "read5", "read10", "read15"])
+        # The index of the lane is in the high bits of the ordinals
+        lanes = os.path.join(self.tmpdir, "discarded_lanes.bin")
+        writeDiscards(lanes, [3, (1 << LANE_ORDINAL_SHIFT) + 2], "filter_input", "adaptors")
+        written = rehydrateDiscards(lanes, [self.fw, self.fw], [self.rw, self.rw], 
+                                    rehydrated_fw, rehydrated_rw)
+        self.assertEqual(written, 2)
+        with open(rehydrated_fw) as filehandler:
+            self.assertEqual([record[0] for record in readfq(filehandler)], ["read3", "read2"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,318 @@
+#! /usr/bin/env python
+"""
+Unit-test the package fastq_utils
+"""
+
+import unittest
+import tempfile
+import os
+import random
+from itertools import izip
+from StringIO import StringIO
+from stpipeline.common.fastq_utils import readfq, readfq_blocks, readfq_fast, FastqWriter, \
+quality_trim_index, quality_trim_index_batch, to_uint8_array, \
+umi_low_quality_bases_batch, at_count_batch, collapseDuplicateReads, hashDemultiplexedReads, \
+filterInputReads, filterDemultiplexedReads, parseTagsFromName, LANE_ORDINAL_SHIFT
+from stpipeline.common.tag_store import OrdinalTagJoin
+from stpipeline.common.stats import qa_stats
+from stpipeline.common.discards import readDiscards, STEPS
+
+class TestFastqUtils(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.fastq = "".join("@read{0} 1:N:0\n{1}\n+\n{2}\n".format(i, "ACGT" * (i % 7 + 1), "I" * 4 * (i % 7 + 1))
+                             for i in xrange(1000))
+        self.fasta = ">seq1\nACGT\nACGT\n>seq2\nTTTT\n"
+
+    @classmethod
+    def tearDownClass(self):
+        return
+
+    def test_readfq_blocks(self):
+        """
+        Test that the block based parser returns the same
+        records as readfq() for different block sizes
+        """
+        expected = list(readfq(StringIO(self.fastq)))
+        for block_size in [100, 1000, 4096, 1024 * 1024]:
+            records = list(readfq_fast(StringIO(self.fastq), block_size))
+            self.assertEqual(records, expected)
+        # The last record does not end with a new line
+        records = list(readfq_fast(StringIO(self.fastq[:-1])))
+        self.assertEqual(records, expected)
+        # The records are returned in batches
+        batches = list(readfq_blocks(StringIO(self.fastq), 1000))
+        self.assertTrue(len(batches) > 1)
+
+    def test_readfq_blocks_fallback(self):
+        """
+        Test that non strict fastq files are parsed with readfq()
+        and that truncated or invalid files raise an error
+        """
+        records = list(readfq_fast(StringIO(self.fasta)))
+        self.assertEqual(records, [("seq1", "ACGTACGT", None), ("seq2", "TTTT", None)])
+        self.assertRaises(RuntimeError, list, readfq_fast(StringIO(self.fastq + "@read\nACGT\n")))
+        # Blank lines are allowed at the end of the file
+        expected = list(readfq(StringIO(self.fastq)))
+        self.assertEqual(list(readfq_fast(StringIO(self.fastq + "\n\n"), 1000)), expected)
+        self.assertEqual(list(readfq_fast(StringIO(self.fastq + "@empty\n\n+\n\n\n"), 1000)),
+                         expected + [("empty", "", "")])
+        # The error reports the invalid record (a header without @)
+        with self.assertRaisesRegexp(RuntimeError, "invalid record 501 \\['read500 1:N:0'"):
+            list(readfq_fast(StringIO(self.fastq.replace("@read500 ", "read500 ")), 1000))
+
+    def test_FastqWriter(self):
+        """
+        Test that the buffered writer writes the records in order
+        and in the same format as the input
+        """
+        records = list(readfq(StringIO(self.fastq)))
+        filename = tempfile.mktemp(prefix="st_pipeline_test_writer")
+        with FastqWriter(filename, batch_size=64) as writer:
+            for record in records[:500]:
+                writer.write(record)
+            writer.writeRecords(records[500:900])
+            writer.writeText("".join("@%s\n%s\n+\n%s\n" % record for record in records[900:]))
+        with open(filename) as filehandler:
+            self.assertEqual(filehandler.read(), self.fastq)
+        self.assertEqual(writer.bytes_written, os.path.getsize(filename))
+        os.remove(filename)
+
+    def test_batch_functions(self):
+        """
+        Test that the vectorized quality functions give
+        the same results as the per read functions
+        """
+        random.seed(1)
+        sequences = ["".join(random.choice("ACGTN") for _ in xrange(random.randint(1, 150))) 
+                     for _ in xrange(2000)]
+        qualities = ["".join(chr(33 + random.choice([2, 10, 19, 20, 21, 30, 40])) for _ in sequence)
+                     for sequence in sequences]
+        sequences_array, lengths = to_uint8_array(sequences)
+        qualities_array, _ = to_uint8_array(qualities)
+        self.assertEqual(lengths.tolist(), [len(sequence) for sequence in sequences])
+        for cutoff in [10, 20, 30]:
+            expected = [quality_trim_index(sequence, quality, cutoff, 33) 
+                        for sequence, quality in izip(sequences, qualities)]
+            result = quality_trim_index_batch(sequences_array, qualities_array, lengths, cutoff, 33)
+            self.assertEqual(result.tolist(), expected)
+        # Trimming positions on shorter reads (after removing adaptors)
+        short_lengths = lengths / 2
+        expected = [quality_trim_index(sequence[:length], quality[:length], 20, 33) 
+                    for sequence, quality, length in izip(sequences, qualities, short_lengths)]
+        result = quality_trim_index_batch(sequences_array, qualities_array, short_lengths, 20, 33)
+        self.assertEqual(result.tolist(), expected)
+        expected = [len([b for b in quality[18:27] if (ord(b) - 33) < 20]) for quality in qualities]
+        result = umi_low_quality_bases_batch(qualities_array, 18, 27, 20, 33)
+        self.assertEqual(result.tolist(), expected)
+        expected = [sequence.count("A") + sequence.count("T") for sequence in sequences]
+        self.assertEqual(at_count_batch(sequences_array).tolist(), expected)
+
+    def test_collapseDuplicateReads(self):
+        """
+        Test that exact duplicates are collapsed into the first read pair
+        and that the multiplicity is carried to the hash of demultiplexed reads
+        """
+        fw = tempfile.mktemp(prefix="st_pipeline_test_fw")
+        rw = tempfile.mktemp(prefix="st_pipeline_test_rw")
+        out_fw = tempfile.mktemp(prefix="st_pipeline_test_out_fw")
+        out_rw = tempfile.mktemp(prefix="st_pipeline_test_out_rw")
+        # Barcode + UMI (8 bases) + tail that is not part of the key
+        reads = [("r1", "AAAACCCCGG", "ACGTACGT"),
+                 ("r2", "AAAACCCCTT", "ACGTACGT"),
+                 ("r3", "AAAACCCAGG", "ACGTACGT"),
+                 ("r4", "AAAACCCCGG", "ACGTACGA"),
+                 ("r5", "AAAACCCCGG", "ACGTACGT")]
+        with FastqWriter(fw) as fw_writer, FastqWriter(rw) as rw_writer:
+            for name, sequence_fw, sequence_rw in reads:
+                fw_writer.write((name, sequence_fw, "I" * len(sequence_fw)))
+                rw_writer.write((name, sequence_rw, "I" * len(sequence_rw)))
+        total, unique = collapseDuplicateReads(fw, rw, out_fw, out_rw, 8)
+        self.assertEqual((total, unique), (5, 3))
+        with open(out_fw) as filehandler:
+            records_fw = list(readfq(filehandler))
+        with open(out_rw) as filehandler:
+            records_rw = list(readfq(filehandler))
+        self.assertEqual([record[0] for record in records_fw], ["r1 B4:i:3", "r3", "r4"])
+        self.assertEqual([record[0] for record in records_rw], ["r1", "r3", "r4"])
+        # Simulate the output of taggd
+        with FastqWriter(fw) as fw_writer:
+            for name, sequence, quality in records_fw:
+                fw_writer.write((name + " B0:Z:AAAA B1:Z:1 B2:Z:2", sequence, quality))
+        hash_reads = hashDemultiplexedReads(fw, True, 4, 8, False)
+        self.assertEqual(hash_reads[hash("r1")], ["B1:Z:1", "B2:Z:2", "B3:Z:CCCC", "B4:i:3"])
+        self.assertEqual(hash_reads[hash("r3")], ["B1:Z:1", "B2:Z:2", "B3:Z:CCCA"])
+        # The low memory store is a table in a memory-mapped file
+        temp_folder = tempfile.mkdtemp(prefix="st_pipeline_test_tags")
+        mapped_reads = hashDemultiplexedReads(fw, True, 4, 8, True, temp_folder=temp_folder)
+        self.assertEqual(os.path.dirname(mapped_reads.filename), temp_folder)
+        self.assertEqual(len(mapped_reads), len(hash_reads))
+        self.assertEqual(mapped_reads[hash("r1")], hash_reads[hash("r1")])
+        self.assertEqual(mapped_reads[hash("r3")], hash_reads[hash("r3")])
+        self.assertFalse(hash("r2") in mapped_reads)
+        mapped_reads.close()
+        self.assertFalse(os.path.isfile(mapped_reads.filename))
+        self.assertEqual(os.listdir(temp_folder), [])
+        os.rmdir(temp_folder)
+        for filename in [fw, rw, out_fw, out_rw]:
+            os.remove(filename)
+
+    def test_filterInputReads_compact_ids(self):
+        """
+        Test that the kept read pairs are renamed to their ordinal
+        in the input files and that the original names are written out.
+        It also tests the truncation of the forward reads
+        """
+        fw = tempfile.mktemp(prefix="st_pipeline_test_fw")
+        rw = tempfile.mktemp(prefix="st_pipeline_test_rw")
+        out_fw = tempfile.mktemp(prefix="st_pipeline_test_out_fw")
+        out_rw = tempfile.mktemp(prefix="st_pipeline_test_out_rw")
+        out_ids = tempfile.mktemp(prefix="st_pipeline_test_ids")
+        sequence = "ACGTTGCAGCTAGCATCGACTAGCTACGACTACG"
+        with FastqWriter(fw) as fw_writer, FastqWriter(rw) as rw_writer:
+            for i in xrange(10):
+                # Odd reads are discarded (too short after quality trimming)
+                quality = "I" * len(sequence) if i % 2 == 0 else "#" * len(sequence)
+                fw_writer.write(("read{} 1:N:0".format(i), sequence, "I" * len(sequence)))
+                rw_writer.write(("read{} 2:N:0".format(i), sequence, quality))
+        filterInputReads(fw, rw, out_fw, out_rw, None, out_ids=out_ids)
+        with open(out_rw) as filehandler:
+            self.assertEqual([record[0] for record in readfq(filehandler)], ["0", "2", "4", "6", "8"])
+        with open(out_ids) as filehandler:
+            self.assertEqual(filehandler.read(), "".join("{0}\tread{0}\n".format(i) for i in xrange(0, 10, 2)))
+        # Truncated forward reads
+        filterInputReads(fw, rw, out_fw, out_rw, None, fw_length=10)
+        with open(out_fw) as filehandler:
+            self.assertEqual([record[1:] for record in readfq(filehandler)], [(sequence[:10], "I" * 10)] * 5)
+        with FastqWriter(fw) as fw_writer:
+            fw_writer.write(("2 B0:Z:AAAA B1:Z:1 B2:Z:2", sequence, "I" * len(sequence)))
+        hash_reads = hashDemultiplexedReads(fw, False, 4, 8, False, True)
+        self.assertEqual(hash_reads, {2 : ["B1:Z:1", "B2:Z:2"]})
+        # Reads of spots that are not in the whitelist are not kept
+        self.assertEqual(hashDemultiplexedReads(fw, False, 4, 8, False, True, set(["AAAA"])),
+                         {2 : ["B1:Z:1", "B2:Z:2"]})
+        self.assertEqual(hashDemultiplexedReads(fw, False, 4, 8, False, True, set(["CCCC"])), {})
+        for filename in [fw, rw, out_fw, out_rw, out_ids]:
+            os.remove(filename)
+
+    def test_filterInputReads_subsample(self):
+        """
+        Test that a random subset of the read pairs is processed
+        in preview mode and that the read pairs keep their ordinals
+        """
+        fw = tempfile.mktemp(prefix="st_pipeline_test_fw")
+        rw = tempfile.mktemp(prefix="st_pipeline_test_rw")
+        out_fw = tempfile.mktemp(prefix="st_pipeline_test_out_fw")
+        out_rw = tempfile.mktemp(prefix="st_pipeline_test_out_rw")
+        out_ids = tempfile.mktemp(prefix="st_pipeline_test_ids")
+        sequence = "ACGTTGCAGCTAGCATCGACTAGCTACGACTACG"
+        with FastqWriter(fw) as fw_writer, FastqWriter(rw) as rw_writer:
+            for i in xrange(1000):
+                fw_writer.write(("read{}".format(i), sequence, "I" * len(sequence)))
+                rw_writer.write(("read{}".format(i), sequence, "I" * len(sequence)))
+        def subsample(**kwargs):
+            filterInputReads(fw, rw, out_fw, out_rw, None, out_ids=out_ids, **kwargs)
+            with open(out_rw) as filehandler:
+                ordinals = [int(record[0]) for record in readfq(filehandler)]
+            with open(out_ids) as filehandler:
+                self.assertEqual(filehandler.read(),
+                                 "".join("{0}\tread{0}\n".format(i) for i in ordinals))
+            return ordinals
+        # Reservoir sampling selects exactly the given number of read pairs
+        ordinals = subsample(subsample_reads=100, seed=1)
+        self.assertEqual(len(ordinals), 100)
+        self.assertEqual(ordinals, sorted(set(ordinals)))
+        self.assertTrue(ordinals[-1] >= 500)
+        self.assertEqual(subsample(subsample_reads=100, seed=1), ordinals)
+        self.assertEqual(subsample(subsample_reads=2000, seed=1), range(1000))
+        # Bernoulli sampling selects every read pair with the given probability
+        ordinals = subsample(subsample_fraction=0.2, seed=1)
+        self.assertTrue(100 < len(ordinals) < 300)
+        self.assertEqual(subsample(subsample_fraction=0.2, seed=1), ordinals)
+        self.assertNotEqual(subsample(subsample_fraction=0.2, seed=2), ordinals)
+        for filename in [fw, rw, out_fw, out_rw, out_ids]:
+            os.remove(filename)
+
+    def test_filterInputReads_lanes(self):
+        """
+        Test that several lanes are filtered (with one and several processes)
+        into one output in the order of the lanes with per-lane counters
+        """
+        sequence = "ACGTTGCAGCTAGCATCGACTAGCTACGACTACG"
+        lanes_fw = []
+        lanes_rw = []
+        for lane, num_reads in enumerate([5, 3]):
+            lanes_fw.append(tempfile.mktemp(prefix="st_pipeline_test_fw"))
+            lanes_rw.append(tempfile.mktemp(prefix="st_pipeline_test_rw"))
+            with FastqWriter(lanes_fw[-1]) as fw_writer, FastqWriter(lanes_rw[-1]) as rw_writer:
+                for i in xrange(num_reads):
+                    # Odd reads are discarded (too short after quality trimming)
+                    quality = "I" * len(sequence) if i % 2 == 0 else "#" * len(sequence)
+                    fw_writer.write(("lane{}_{}".format(lane, i), sequence, "I" * len(sequence)))
+                    rw_writer.write(("lane{}_{}".format(lane, i), sequence, quality))
+        out_fw = tempfile.mktemp(prefix="st_pipeline_test_out_fw")
+        out_rw = tempfile.mktemp(prefix="st_pipeline_test_out_rw")
+        out_ids = tempfile.mktemp(prefix="st_pipeline_test_ids")
+        second_lane = 1 << LANE_ORDINAL_SHIFT
+        for threads in [1, 2]:
+            filterInputReads(lanes_fw, lanes_rw, out_fw, out_rw, None, out_ids=out_ids, threads=threads)
+            with open(out_rw) as filehandler:
+                self.assertEqual([record[0] for record in readfq(filehandler)],
+                                 ["0", "2", "4", str(second_lane), str(second_lane + 2)])
+            with open(out_ids) as filehandler:
+                self.assertEqual(filehandler.read().split("\n")[3], "{}\tlane1_0".format(second_lane))
+            self.assertEqual([(lane["input_reads"], lane["reads_after_trimming"]) 
+                              for lane in qa_stats.input_lanes], [(5, 3), (3, 2)])
+            self.assertEqual(qa_stats.reads_after_trimming_reverse, 5)
+        self.assertFalse(os.path.exists(out_rw + ".lane0"))
+        self.assertFalse(os.path.exists(out_rw + ".lane1"))
+        # The number of read pairs is a random subset of all the lanes
+        for subsample_reads, seed in [(4, 1), (4, 2), (8, 1)]:
+            filterInputReads(lanes_fw, lanes_rw, out_fw, out_rw, None,
+                             subsample_reads=subsample_reads, seed=seed, threads=2)
+            self.assertEqual(sum(lane["input_reads"] for lane in qa_stats.input_lanes), subsample_reads)
+            self.assertEqual(qa_stats.subsample_fraction, subsample_reads / 8.0)
+        # The errors of the reader processes of the lanes are raised
+        with self.assertRaises(RuntimeError):
+            filterInputReads(lanes_fw + [out_rw + ".missing"], lanes_rw + [lanes_rw[0]],
+                             out_fw, out_rw, None, threads=2)
+        for filename in lanes_fw + lanes_rw + [out_fw, out_rw, out_ids]:
+            os.remove(filename)
+
+    def test_filterDemultiplexedReads(self):
+        """
+        Test that only the reverse reads with a demultiplexed
+        forward read are kept and that the others are recorded
+        """
+        reads = tempfile.mktemp(prefix="st_pipeline_test_rw")
+        out_reads = tempfile.mktemp(prefix="st_pipeline_test_out_rw")
+        discards = tempfile.mktemp(prefix="st_pipeline_test_discards")
+        with FastqWriter(reads) as writer:
+            for i in xrange(6):
+                writer.write(("{} 2:N:0".format(i), "ACGT", "IIII"))
+        hash_reads = {1 : ["B1:Z:1", "B2:Z:1"], 4 : ["B1:Z:2", "B2:Z:2"]}
+        self.assertEqual(filterDemultiplexedReads(reads, out_reads, hash_reads, True, discards), (6, 2))
+        with open(out_reads) as filehandler:
+            self.assertEqual([record[0] for record in readfq(filehandler)], ["1 2:N:0", "4 2:N:0"])
+        records = readDiscards(discards)
+        self.assertEqual(records["ordinal"].tolist(), [0, 2, 3, 5])
+        self.assertTrue(all(records["step"] == STEPS["demultiplexing"]))
+        # Original read names are hashed
+        hash_reads = {hash("3") : ["B1:Z:1", "B2:Z:1"]}
+        self.assertEqual(filterDemultiplexedReads(reads, out_reads, hash_reads), (6, 1))
+        # The tags of the demultiplexed reads are added to the read names
+        tags = [(1, [("B1", "1", "Z"), ("B2", "1", "Z"), ("B3", "ACGT", "Z")]),
+                (4, [("B1", "2", "Z"), ("B2", "3", "Z"), ("B3", "TTTT", "Z"), ("B4", 2, "i")])]
+        self.assertEqual(filterDemultiplexedReads(reads, out_reads, OrdinalTagJoin(tags), True,
+                                                  embed_tags=True), (6, 2))
+        with open(out_reads) as filehandler:
+            names = [record[0] for record in readfq(filehandler)]
+        self.assertEqual(names, ["1|1|1|ACGT 2:N:0", "4|2|3|TTTT|2 2:N:0"])
+        self.assertEqual([parseTagsFromName(name.split()[0]) for name in names],
+                         [("1", tags[0][1]), ("4", tags[1][1])])
+        for filename in [reads, out_reads, discards]:
+            os.remove(filename)
+
+if __name__ == '__main__':
+    unittest.main()
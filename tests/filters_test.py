@@ -0,0 +1,71 @@
+#! /usr/bin/env python
+"""
+Unit-test the package filters
+"""
+
+import unittest
+import os
+from stpipeline.common.filters import ReadBatch, createFilterPlan
+from stpipeline.common.fastq_utils import readfq
+
+class TestFilters(unittest.TestCase):
+
+    def test_filter_plan(self):
+        """
+        Test that every filter only sees the reads kept by the
+        previous filters and that the counters are aggregated
+        """
+        umi_ok = "A" * 18 + "AGCAAGCAA" + "A" * 3
+        umi_bad = "A" * 18 + "CCCCCCCCC" + "A" * 3
+        good = "ACGTACGTAC" * 4
+        pairs = [(("r1", umi_ok, "I" * 30), ("r1", good, "I" * 40)),
+                 (("r2", umi_bad, "I" * 30), ("r2", good, "I" * 40)),
+                 (("r3", umi_ok, "I" * 18 + "#" * 9 + "III"), ("r3", good, "I" * 40)),
+                 (("r4", umi_ok, "I" * 30), ("r4", "A" * 40, "I" * 40)),
+                 (("r5", umi_ok, "I" * 30), ("r5", good[:30] + "A" * 10, "I" * 40)),
+                 (("r6", umi_ok, "I" * 30), ("r6", good, "I" * 20 + "#" * 20))]
+        plan = createFilterPlan(umi_filter=True, umi_filter_template="[AT][GC]..[AT][GC]..[ACG]",
+                                iscorrect_mc=True, adaptors=["A" * 10],
+                                min_length=28)
+        self.assertEqual([f.name for f in plan.filters],
+                         ["umi_template", "umi_quality", "at_content", "adaptors", "quality_trimming"])
+        batch = ReadBatch(pairs)
+        stats = plan.run(batch)
+        self.assertEqual(batch.discard.tolist(), [False, True, True, True, False, True])
+        self.assertEqual(batch.trimmed_lengths[4], 30)
+        self.assertEqual([(s[0], s[1]) for s in stats], [(6, 1), (5, 1), (4, 1), (3, 0), (3, 1)])
+        plan.update(stats)
+        plan.update(stats)
+        self.assertEqual(plan.dropped("umi_quality"), 2)
+        self.assertEqual(plan.dropped("unknown"), 0)
+        self.assertEqual(plan.stats()[0]["reads_in"], 12)
+
+    def test_contaminant_filter(self):
+        """
+        Test that the reads (either strand) that share many k-mers
+        with the contaminant sequences are discarded
+        """
+        fasta = os.path.join(os.path.dirname(os.path.abspath(__file__)), "config", "contaminant_genomes",
+                             "R45S5_R5S1", "Rn45s_Rn5s.fasta")
+        with open(fasta) as filehandler:
+            contaminant = next(readfq(filehandler))[1][1000:1040]
+        complement = dict(zip("ACGTN", "TGCAN"))
+        reverse = "".join(complement[base] for base in reversed(contaminant))
+        mismatch = contaminant[:35] + ("A" if contaminant[35] != "A" else "C") + contaminant[36:]
+        unrelated = "ACGTTGCAGCTAGCATCGACTAGCTACGACTACGTTAGCA"
+        pairs = [(("r{}".format(i), "A" * 30, "I" * 30), ("r{}".format(i), sequence, "I" * 40))
+                 for i, sequence in enumerate([contaminant, reverse, mismatch, unrelated, "N" * 40])]
+        plan = createFilterPlan(filter_AT_content=100, min_length=28, contaminant_fasta=fasta,
+                                contaminant_kmer_size=15, contaminant_kmer_fraction=0.5)
+        self.assertEqual(plan.filters[-1].name, "contaminant")
+        batch = ReadBatch(pairs)
+        plan.run(batch)
+        self.assertEqual(batch.discard.tolist(), [True, True, True, False, False])
+        # Only the k-mers before the trimming position are used
+        batch = ReadBatch(pairs[:1])
+        batch.trimmed_lengths[0] = 10
+        hits, total = plan.filters[-1].screen.hits(batch.sequences_rv_array, batch.trimmed_lengths)
+        self.assertEqual((hits.tolist(), total.tolist()), ([0], [0]))
+
+if __name__ == '__main__':
+    unittest.main()
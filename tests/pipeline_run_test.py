@@ -9,6 +9,8 @@ import tempfile
 import multiprocessing
 from subprocess import check_call
 from stpipeline.core.pipeline import Pipeline
+import logging
+import shutil
 import os
 
 class TestPipeline(unittest.TestCase):
@@ -191,5 +193,44 @@ class TestPipeline(unittest.TestCase):
  
         self.validateOutputData(self.expname)
  
+class TestPipelineParameters(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="st_pipeline_test_parameters")
+        fastq = os.path.join(self.tmpdir, "reads.fastq")
+        with open(fastq, "w") as filehandler:
+            filehandler.write("@read1\nACGT\n+\nIIII\n")
+        annotation = os.path.join(self.tmpdir, "annotation.gtf")
+        open(annotation, "w").close()
+        self.ids = os.path.join(self.tmpdir, "ids.txt")
+        with open(self.ids, "w") as filehandler:
+            filehandler.write("ACGTACGTAC\t1\t2\n")
+        self.pipeline = Pipeline()
+        self.pipeline.logger = logging.getLogger("STPipeline")
+        self.pipeline.fastq_fw = fastq
+        self.pipeline.fastq_rv = fastq
+        self.pipeline.ref_annotation = annotation
+        self.pipeline.ids = self.ids
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_merge_join_contaminant_index(self):
+        """
+        Tests that --merge-join cannot be used with --contaminant-index (the reads
+        not mapped to the contaminant genome are not in the order of the input)
+        """
+        self.pipeline.merge_join = True
+        self.pipeline.contaminant_index = self.tmpdir
+        with self.assertRaisesRegexp(RuntimeError, "--merge-join cannot be used"):
+            self.pipeline.sanityCheck()
+
+    def test_ids_coordinates(self):
+        for coordinates in ["40000\t2", "a\t2", "1"]:
+            with open(self.ids, "w") as filehandler:
+                filehandler.write("ACGTACGTAC\t{}\n".format(coordinates))
+            with self.assertRaisesRegexp(RuntimeError, "not valid 16 bits integers"):
+                self.pipeline.sanityCheck()
+
 if __name__ == '__main__':
     unittest.main()
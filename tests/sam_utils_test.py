@@ -0,0 +1,250 @@
+#! /usr/bin/env python
+"""
+Unit-test the package sam_utils
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+import pysam
+import numpy as np
+from stpipeline.common.fastq_utils import FastqWriter, writeUniqueSequences, DUPLICATE_DTYPE
+from stpipeline.common.sam_utils import expandMappedReads, filterMappedReads, sortByCoordinate
+import stpipeline.common.sam_utils as sam_utils
+from stpipeline.common.tag_store import ReadTagStore, OrdinalTagJoin, PartitionedReadTags
+from stpipeline.common.stats import qa_stats
+
+class TestSamUtils(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="st_pipeline_test_sam_utils")
+        self.header = {"HD" : {"VN" : "1.0"}, "SQ" : [{"LN" : 1000, "SN" : "chr1"}]}
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_expandMappedReads(self):
+        """
+        Test that only unique sequences are written for mapping and that
+        the alignments are copied back to every read with the same sequence
+        """
+        reads = os.path.join(self.tmpdir, "reads.fastq")
+        unique_reads = os.path.join(self.tmpdir, "unique.fastq")
+        index = os.path.join(self.tmpdir, "index.bin")
+        # Reads with the tags in the names are collapsed only when the tags are the same
+        with FastqWriter(reads) as writer:
+            for name, sequence in [("1", "ACGT"), ("2", "TTTT"), ("3", "ACGT"), ("4", "ACGT"),
+                                   ("5|1|2|AC", "ACGT"), ("6|3|4|AC", "ACGT"), ("7|1|2|AC", "ACGT")]:
+                writer.write((name + " 2:N:0", sequence, "IIII"))
+        self.assertEqual(writeUniqueSequences(reads, unique_reads, index), (7, 4))
+        self.assertEqual(np.fromfile(index, dtype=DUPLICATE_DTYPE).tolist(), [(1, 3), (1, 4), (5, 7)])
+        # Simulate the alignments of the unique reads
+        mapped = os.path.join(self.tmpdir, "mapped.bam")
+        expanded = os.path.join(self.tmpdir, "expanded.bam")
+        outfile = pysam.AlignmentFile(mapped, "wb", header=self.header)
+        for name, start in [("1", 10), ("2", 100), ("5|1|2|AC", 150), ("1", 200)]:
+            record = pysam.AlignedSegment()
+            record.query_name = name
+            record.query_sequence = "ACGT"
+            record.flag = 0 if start != 200 else 256
+            record.reference_id = 0
+            record.reference_start = start
+            record.cigartuples = [(0, 4)]
+            outfile.write(record)
+        outfile.close()
+        for low_memory in [False, True]:
+            self.assertEqual(expandMappedReads(mapped, index, expanded, low_memory), (4, 9))
+            infile = pysam.AlignmentFile(expanded, "rb")
+            records = [(record.query_name, record.reference_start, record.is_secondary)
+                       for record in infile.fetch(until_eof=True)]
+            infile.close()
+            self.assertEqual(records, [("1", 10, False), ("3", 10, False), ("4", 10, False),
+                                       ("2", 100, False),
+                                       ("5|1|2|AC", 150, False), ("7|1|2|AC", 150, False),
+                                       ("1", 200, True), ("3", 200, True), ("4", 200, True)])
+
+    def test_filterMappedReads_tag_store(self):
+        """
+        Test that the tags of the reads are looked up in a ReadTagStore
+        and that the reads without tags are dropped
+        """
+        mapped = os.path.join(self.tmpdir, "mapped_ids.bam")
+        filtered = os.path.join(self.tmpdir, "filtered.bam")
+        outfile = pysam.AlignmentFile(mapped, "wb", header=self.header)
+        for i in xrange(5):
+            record = pysam.AlignedSegment()
+            record.query_name = str(i)
+            record.query_sequence = "ACGT" * 10
+            record.flag = 0
+            record.reference_id = 0
+            record.reference_start = i * 10
+            record.cigartuples = [(0, 40)]
+            outfile.write(record)
+        outfile.close()
+        hash_reads = ReadTagStore(5)
+        hash_reads.add(3, 12, 7, "GGNCC")
+        hash_reads.add(0, 1, 2, "ACGTA", 3)
+        hash_reads.add(4, 5, 6, "TTTTT")
+        hash_reads.freeze()
+        self.assertEqual(hash_reads[0], ["B1:Z:1", "B2:Z:2", "B3:Z:ACGTA", "B4:i:3"])
+        self.assertFalse(1 in hash_reads)
+        filterMappedReads(mapped, hash_reads, filtered, integer_ids=True)
+        infile = pysam.AlignmentFile(filtered, "rb")
+        records = [(record.query_name, sorted(record.get_tags()))
+                   for record in infile.fetch(until_eof=True)]
+        infile.close()
+        self.assertEqual(records, [("0", [("B1", "1"), ("B2", "2"), ("B3", "ACGTA"), ("B4", 3)]),
+                                   ("3", [("B1", "12"), ("B2", "7"), ("B3", "GGNCC")]),
+                                   ("4", [("B1", "5"), ("B2", "6"), ("B3", "TTTTT")])])
+
+    def test_filterMappedReads_merge_join(self):
+        """
+        Test that the alignments in the order of the reads are joined to
+        the demultiplexed reads and sorted by coordinate afterwards
+        """
+        mapped = os.path.join(self.tmpdir, "mapped_unsorted.bam")
+        filtered = os.path.join(self.tmpdir, "filtered_unsorted.bam")
+        sorted_bam = os.path.join(self.tmpdir, "filtered_sorted.bam")
+        outfile = pysam.AlignmentFile(mapped, "wb", header=self.header)
+        for name, start, flag in [("1", 500, 0), ("1", 50, 256), ("2", 300, 0), ("4", 100, 0)]:
+            record = pysam.AlignedSegment()
+            record.query_name = name
+            record.query_sequence = "ACGT" * 10
+            record.flag = flag
+            record.reference_id = 0
+            record.reference_start = start
+            record.cigartuples = [(0, 40)]
+            outfile.write(record)
+        outfile.close()
+        tags = [(0, [("B1", "1", "Z"), ("B2", "1", "Z")]),
+                (1, [("B1", "2", "Z"), ("B2", "3", "Z")]),
+                (4, [("B1", "5", "Z"), ("B2", "8", "Z"), ("B4", 2, "i")])]
+        filterMappedReads(mapped, OrdinalTagJoin(tags), filtered, integer_ids=True)
+        sortByCoordinate(filtered, sorted_bam)
+        infile = pysam.AlignmentFile(sorted_bam, "rb")
+        records = [(record.query_name, record.reference_start, record.get_tag("B1"))
+                   for record in infile.fetch(until_eof=True)]
+        infile.close()
+        self.assertEqual(records, [("4", 100, "5"), ("1", 500, "2")])
+        # The alignments must be in the order of the reads
+        self.assertRaises(RuntimeError, filterMappedReads, sorted_bam,
+                          OrdinalTagJoin(tags), filtered, integer_ids=True)
+
+    def test_filterMappedReads_tags_in_names(self):
+        """
+        Test that the tags carried in the read names are added
+        to the alignments and that the names are restored
+        """
+        mapped = os.path.join(self.tmpdir, "mapped_names.bam")
+        filtered = os.path.join(self.tmpdir, "filtered_names.bam")
+        outfile = pysam.AlignmentFile(mapped, "wb", header=self.header)
+        for name in ["7|10|20|ACGTT", "9|11|21||3"]:
+            record = pysam.AlignedSegment()
+            record.query_name = name
+            record.query_sequence = "ACGT" * 10
+            record.flag = 0
+            record.reference_id = 0
+            record.reference_start = 10
+            record.cigartuples = [(0, 40)]
+            outfile.write(record)
+        outfile.close()
+        filterMappedReads(mapped, None, filtered, integer_ids=True)
+        infile = pysam.AlignmentFile(filtered, "rb")
+        records = [(record.query_name, sorted(record.get_tags()))
+                   for record in infile.fetch(until_eof=True)]
+        infile.close()
+        self.assertEqual(records, [("7", [("B1", "10"), ("B2", "20"), ("B3", "ACGTT")]),
+                                   ("9", [("B1", "11"), ("B2", "21"), ("B4", 3)])])
+
+    def test_filterMappedReads_partitions(self):
+        """
+        Test that joining the partitions of the tags in parallel gives
+        the same alignments and counters as the join with the whole hash
+        """
+        mapped = os.path.join(self.tmpdir, "mapped_sorted.bam")
+        outfile = pysam.AlignmentFile(mapped, "wb", header=self.header)
+        for i in xrange(300):
+            record = pysam.AlignedSegment()
+            record.query_name = str(i)
+            record.query_sequence = "ACGT" * 10
+            record.flag = 256 if i % 7 == 0 else 0
+            record.reference_id = 0
+            record.reference_start = i * 3
+            record.cigartuples = [(0, 40)] if i % 5 != 0 else [(0, 20), (4, 20)]
+            outfile.write(record)
+        outfile.close()
+        hash_reads = ReadTagStore(4)
+        partitioned = PartitionedReadTags(3, self.tmpdir, 4)
+        for i in xrange(0, 300, 2):
+            for store in [hash_reads, partitioned]:
+                store.add(i, i % 30, i % 20, "ACNT" if i % 3 == 0 else "ACGT", 1 + i % 4)
+        hash_reads.freeze()
+        partitioned.freeze()
+        results = []
+        for store, threads in [(hash_reads, 1), (partitioned, 1), (partitioned, 2)]:
+            filtered = os.path.join(self.tmpdir, "filtered_partitions.bam")
+            discarded = os.path.join(self.tmpdir, "discarded_partitions.bam")
+            filterMappedReads(mapped, store, filtered, discarded, 28, True, threads=threads)
+            records = []
+            for filename in [filtered, discarded]:
+                infile = pysam.AlignmentFile(filename, "rb")
+                records.append([(record.query_name, record.reference_start, sorted(record.get_tags()))
+                                for record in infile.fetch(until_eof=True)])
+                infile.close()
+            results.append((records, qa_stats.reads_after_mapping))
+        self.assertEqual([len(records) for records in results[0][0]], [103, 47])
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+        partitioned.close()
+        self.assertEqual(os.path.dirname(partitioned.folder), self.tmpdir)
+        self.assertFalse(os.path.isdir(partitioned.folder))
+
+    def test_filterMappedReads_regions(self):
+        """
+        Test that filtering the genomic regions of a sorted BAM file in
+        parallel gives the same alignments and counters as the sequential filter
+        """
+        mapped = os.path.join(self.tmpdir, "mapped_regions.bam")
+        header = {"HD" : {"VN" : "1.0", "SO" : "coordinate"},
+                  "SQ" : [{"LN" : 1000, "SN" : "chr1"}, {"LN" : 50, "SN" : "chr2"},
+                          {"LN" : 1000, "SN" : "chr3"}]}
+        outfile = pysam.AlignmentFile(mapped, "wb", header=header)
+        for i in xrange(200):
+            record = pysam.AlignedSegment()
+            record.query_name = str(i)
+            record.query_sequence = "ACGT" * 10
+            record.flag = 256 if i % 7 == 0 else 0
+            record.reference_id = 0 if i < 120 else 2
+            record.reference_start = (i % 120) * 8
+            record.cigartuples = [(0, 40)] if i % 5 != 0 else [(0, 20), (4, 20)]
+            outfile.write(record)
+        outfile.close()
+        hash_reads = dict((i, ["B1:Z:{}".format(i % 30), "B2:Z:2", "B4:i:{}".format(1 + i % 3)])
+                          for i in xrange(0, 200, 3))
+        region_size = sam_utils.REGION_SIZE
+        sam_utils.REGION_SIZE = 100
+        try:
+            results = []
+            for threads in [1, 3]:
+                filtered = os.path.join(self.tmpdir, "filtered_regions.bam")
+                discarded = os.path.join(self.tmpdir, "discarded_regions.bam")
+                filterMappedReads(mapped, hash_reads, filtered, discarded, 28, True, threads=threads)
+                records = []
+                for filename in [filtered, discarded]:
+                    infile = pysam.AlignmentFile(filename, "rb")
+                    records.append([(record.query_name, record.reference_id, record.reference_start,
+                                     sorted(record.get_tags())) for record in infile.fetch(until_eof=True)])
+                    infile.close()
+                results.append((records, qa_stats.reads_after_mapping))
+        finally:
+            sam_utils.REGION_SIZE = region_size
+        self.assertTrue(os.path.isfile(mapped + ".bai"))
+        self.assertEqual([name for name in os.listdir(self.tmpdir) if ".region" in name], [])
+        self.assertTrue(len(results[0][0][0]) > 0 and len(results[0][0][1]) > 0)
+        self.assertEqual(results[0], results[1])
+
+if __name__ == '__main__':
+    unittest.main()